@@ -6,6 +6,8 @@ import time
 import glob
 import struct
 
+import numpy as np
+
 import kenshin
 from kenshin.consts import NULL_VALUE
 from kenshin.agg import Agg
@@ -29,6 +31,10 @@ def resize_data_file(schema, data_file):
     retentions = schema.archives
     old_retentions = [(x['sec_per_point'], x['count'])
                       for x in header['archive_list']]
+    if header['cold_path']:
+        with open(header['cold_path']) as f:
+            old_retentions += [(x['sec_per_point'], x['count'])
+                               for x in kenshin.header(f)['archive_list']]
     msg = []
     action = NO_OPERATION
 
@@ -57,7 +63,14 @@ def resize_data_file(schema, data_file):
     elif action == CHANGE_META:
         print 'Change Meta.'
         print '\n'.join(msg)
-        change_meta(data_file, schema, header['max_retention'])
+        change_meta(data_file, schema, header['max_retention'],
+                    header['metadata_offset'])
+        if header['cold_path']:
+            with open(header['cold_path']) as f:
+                cold_header = kenshin.header(f)
+            change_meta(header['cold_path'], schema,
+                        cold_header['max_retention'],
+                        cold_header['metadata_offset'])
         return
 
     elif action == REBUILD:
@@ -69,28 +82,39 @@ def resize_data_file(schema, data_file):
         raise ValueError(action)
 
 
-def change_meta(data_file, schema, max_retention):
+def change_meta(data_file, schema, max_retention, metadata_offset):
     with open(data_file, 'r+b') as f:
+        f.seek(metadata_offset)
         format = '!2Lf'
         agg_id = Agg.get_agg_id(schema.aggregationMethod)
         xff = schema.xFilesFactor
         packed_data = struct.pack(format, agg_id, max_retention, xff)
         f.write(packed_data)
+    kenshin.header_cache.invalidate(data_file)
 
 
 def rebuild(data_file, schema, header, retentions):
     now = int(time.time())
     tmpfile = data_file + '.tmp'
-    if os.path.exists(tmpfile):
-        print "Removing previous temporary database file: %s" % tmpfile
-        os.unlink(tmpfile)
+    # the companion file of a tiered file is rebuilt along
+    cold_file = header['cold_path']
+    cold_tmpfile = cold_file and cold_file + '.tmp'
+    for f in filter(None, [tmpfile, cold_tmpfile]):
+        if os.path.exists(f):
+            print "Removing previous temporary database file: %s" % f
+            os.unlink(f)
 
     print "Creating new kenshin database: %s" % tmpfile
     kenshin.create(tmpfile,
                    header['tag_list'],
                    retentions,
                    schema.xFilesFactor,
-                   schema.aggregationMethod)
+                   schema.aggregationMethod,
+                   header['layout'],
+                   header['compression'],
+                   header['value_type'],
+                   cold_path=cold_tmpfile,
+                   hot_archive_cnt=schema.hot_archives)
 
     size = os.stat(tmpfile).st_size
     old_size = os.stat(data_file).st_size
@@ -99,17 +123,31 @@ def rebuild(data_file, schema, header, retentions):
         tmpfile, size, old_size)
 
     print "Migrating data to new kenshin database ..."
-    for archive in header['archive_list']:
-        from_time = now - archive['retention'] + archive['sec_per_point']
-        until_time = now
-        _, timeinfo, values = kenshin.fetch(data_file, from_time, until_time)
-        datapoints = zip(range(*timeinfo), values)
-        datapoints = [[p[0], list(p[1])] for p in datapoints if p[1]]
-        for _, values in datapoints:
-            for i, v in enumerate(values):
-                if v is None:
-                    values[i] = NULL_VALUE
-        kenshin.update(tmpfile, datapoints)
+    # the history of every new archive, written without propagation
+    metrics = range(len(header['tag_list']))
+    archive_points = []
+    for sec_per_point, count in retentions:
+        from_time = now - sec_per_point * count + sec_per_point
+        rs = kenshin.fetch_many(data_file, metrics, from_time, now, now)
+        if rs is None:
+            archive_points.append(None)
+            continue
+        _, _, timestamps, values = rs
+        values = np.array(values).T
+        written = ~np.isnan(values).all(1)
+        values[np.isnan(values)] = NULL_VALUE
+        archive_points.append((timestamps[written], values[written]))
+    kenshin.backfill(tmpfile, archive_points)
+
+    if cold_file:
+        # the new fast file points to the final companion path before any
+        # rename, so that either file of the pair is always readable
+        kenshin.set_cold_path(tmpfile, cold_file)
+        rename_database(cold_tmpfile, cold_file)
+    rename_database(tmpfile, data_file)
+
+
+def rename_database(tmpfile, data_file):
     backup = data_file + ".bak"
 
     print 'Renaming old database to: %s' % backup
@@ -123,6 +161,8 @@ def rebuild(data_file, schema, header, retentions):
         os.rename(backup, data_file)
         raise e
         # Notice: by default, '.bak' files are not deleted.
+    finally:
+        kenshin.header_cache.invalidate(data_file)
 
 
 def main():
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import glob
+import mmap
+import StringIO
+
+import kenshin
+from kenshin.agg import Agg
+from kenshin.utils import write_sparse
+from kenshin.storage import (
+    Storage, LAYOUTS, COMPRESSIONS, VALUE_TYPES, FLAG_TIERED)
+
+
+def convert_data_file(data_file, layout=None, compression=None,
+                      value_type=None):
+    print data_file
+    with open(data_file, 'rb') as f:
+        header = kenshin.header(f)
+    # the companion file of a tiered file first
+    if header['cold_path']:
+        convert_data_file(header['cold_path'], layout, compression,
+                          value_type)
+
+    with open(data_file, 'rb') as f:
+        header = kenshin.header(f)
+        layout = layout or header['layout']
+        compression = compression or header['compression']
+        value_type = value_type or header['value_type']
+        flags = Storage.format_flags(layout, compression, value_type)
+        flags |= header['flags'] & FLAG_TIERED
+        if header['flags'] == flags:
+            print "No operation needed."
+            return
+
+        inter_tag_list = header['tag_list'] + ['N' * header['reserved_size']]
+        archive_list = [(a['sec_per_point'], a['count'])
+                        for a in header['archive_list']]
+        agg_name = Agg.get_agg_name(header['agg_id'])
+
+        tmpfile = data_file + '.tmp'
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            archive_arrays = [Storage.archive_arrays(mm, header, archive)
+                              for archive in header['archive_list']]
+            # the base timestamps of older files are in the data
+            base_ts_list = [
+                int(point_ts[0]) if archive['base_ts'] is None
+                else archive['base_ts']
+                for archive, (point_ts, _) in zip(header['archive_list'],
+                                                  archive_arrays)]
+            packed_header, _ = Storage.pack_header(
+                inter_tag_list, archive_list, header['x_files_factor'],
+                agg_name, flags, base_ts_list, header['cold_path'])
+            new_header = Storage.header(StringIO.StringIO(packed_header))
+
+            packed_archives = [
+                Storage.pack_archive(new_header, new_archive, point_ts,
+                                     point_vals)
+                for new_archive, (point_ts, point_vals) in zip(
+                    new_header['archive_list'], archive_arrays)]
+            del archive_arrays
+        finally:
+            mm.close()
+
+    # the header, the block indexes, then the data
+    with open(tmpfile, 'wb') as f_tmp:
+        f_tmp.write(packed_header)
+        f_tmp.write(''.join(index for _, index in packed_archives))
+        # unused space of compressed blocks is left as holes
+        for data, _ in packed_archives:
+            write_sparse(f_tmp, data)
+        f_tmp.truncate()
+
+    print "Converting format: %s, %s, %s -> %s, %s, %s" % (
+        header['layout'], header['compression'], header['value_type'],
+        layout, compression, value_type)
+    os.rename(tmpfile, data_file)
+    kenshin.header_cache.invalidate(data_file)
+
+
+def main():
+    usage = ("e.g: kenshin-convert-layout.py -l column -c gorilla -f '../graphite-root/storage/data/*/default/*.hs'\n"
+             "Note: please stop the rurouni-cache instances that write "
+             "      these files before converting them.")
+
+    import argparse
+    parser = argparse.ArgumentParser(description=usage,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-l", "--layout", choices=LAYOUTS,
+        help="target layout, 'column' stores each metric contiguously.")
+    parser.add_argument(
+        "-c", "--compression", choices=COMPRESSIONS,
+        help="target compression of the archives but the first one.")
+    parser.add_argument(
+        "-v", "--value-type", choices=VALUE_TYPES,
+        help="target value type, 'float32' halves the size of values.")
+    parser.add_argument(
+        "-f", "--files", required=True,
+        help="metric data file paterns. (e.g. /data/kenshin/storage/data/*/mfs/*.hs)")
+    args = parser.parse_args()
+    if not (args.layout or args.compression or args.value_type):
+        parser.error('nothing to convert, give --layout, --compression '
+                     'and/or --value-type')
+
+    for f in sorted(glob.glob(args.files)):
+        convert_data_file(os.path.abspath(f), args.layout, args.compression,
+                          args.value_type)
+
+
+if __name__ == '__main__':
+    main()
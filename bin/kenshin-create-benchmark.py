@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import time
+import shutil
+import tempfile
+
+from kenshin.storage import Storage, ALLOCATIONS
+from rurouni.storage import loadStorageSchemas, DefaultSchema
+
+
+def bench_schema(schema, allocation, data_dir, num):
+    storage = Storage(data_dir)
+    tags = [''] * schema.metrics_max_num
+    latencies = []
+    for i in xrange(num):
+        path = os.path.join(data_dir, '%s-%s-%d.hs' % (schema.name, allocation, i))
+        start = time.time()
+        storage.create(path, tags, list(schema.archives), schema.xFilesFactor,
+                       schema.aggregationMethod, schema.layout,
+                       schema.compression, schema.value_type, allocation)
+        latencies.append(time.time() - start)
+    st = os.stat(path)
+    latencies.sort()
+    return {
+        'avg': sum(latencies) / num * 1000,
+        'p50': latencies[num / 2] * 1000,
+        'max': latencies[-1] * 1000,
+        'size': st.st_size,
+        'disk': st.st_blocks * 512,
+    }
+
+
+def main():
+    usage = ("e.g: kenshin-create-benchmark.py -d ../graphite-root/conf/ -n 50\n"
+             "Create data files of every schema with every allocation mode "
+             "and report the creation latency (ms).\n"
+             "Note: run it on the file system of LOCAL_DATA_DIR, "
+             "files are removed afterwards.")
+
+    import argparse
+    parser = argparse.ArgumentParser(description=usage,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-d", "--conf-dir", required=True, help="kenshin conf directory.")
+    parser.add_argument(
+        "-n", "--num", default=20, type=int,
+        help="number of files to create per schema and allocation mode.")
+    parser.add_argument(
+        "-t", "--tmp-dir", default=None,
+        help="directory to create the files in (default: system temp dir).")
+    args = parser.parse_args()
+
+    storage_conf_path = os.path.join(args.conf_dir, 'storage-schemas.conf')
+    storage_schemas = loadStorageSchemas(storage_conf_path)
+
+    print '%-20s %-10s %10s %10s %10s %12s %12s' % (
+        'schema', 'allocation', 'avg', 'p50', 'max', 'size', 'disk')
+    for schema in storage_schemas:
+        if isinstance(schema, DefaultSchema):
+            # the built-in fallback, not defined in storage-schemas.conf
+            continue
+        for allocation in ALLOCATIONS:
+            data_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+            try:
+                rs = bench_schema(schema, allocation, data_dir, args.num)
+            finally:
+                shutil.rmtree(data_dir)
+            print '%-20s %-10s %10.3f %10.3f %10.3f %12d %12d' % (
+                schema.name, allocation, rs['avg'], rs['p50'], rs['max'],
+                rs['size'], rs['disk'])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,9 @@
 # coding: utf-8
 
 import argparse
-import struct
+import mmap
 import kenshin
+from kenshin.storage import Storage
 from datetime import datetime
 from kenshin.utils import get_metric
 
@@ -16,24 +17,18 @@ def timestamp_to_datestr(ts):
         return 'invalid timestamp'
 
 
-def get_point(fh, offset, size, format):
-    fh.seek(offset)
-    data = fh.read(size)
-    return struct.unpack(format, data)
+def get_point(point_ts, point_vals, idx):
+    return (int(point_ts[idx]),) + tuple(point_vals[idx].tolist())
 
 
 def run(filepath, archive_idx, point_idx, error):
     with open(filepath) as f:
         header = kenshin.header(f)
         archive = header['archive_list'][archive_idx]
-        point_size = header['point_size']
-        point_format = header['point_format']
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        point_ts, point_vals = Storage.archive_arrays(mm, header, archive)
 
-        start_offset = archive['offset'] + point_idx * point_size
-        if point_idx < 0:
-            start_offset += archive['size']
-
-        point = get_point(f, start_offset, point_size, point_format)
+        point = get_point(point_ts, point_vals, point_idx)
         print 'count: %s' % archive['count']
 
         if not error:
@@ -48,13 +43,13 @@ def run(filepath, archive_idx, point_idx, error):
         else:
             sec_per_point = archive['sec_per_point']
             ts = point[0]
-            start_offset += point_size
+            slot = point_idx % archive['count'] + 1
             point_idx += 1
-            while start_offset < archive['size'] + archive['offset']:
-                point = get_point(f, start_offset, point_size, point_format)
+            while slot < archive['count']:
+                point = get_point(point_ts, point_vals, slot)
                 if point[0] != ts + sec_per_point:
                     return point_idx
-                start_offset += point_size
+                slot += 1
                 point_idx += 1
                 ts = point[0]
             return 'No error!'
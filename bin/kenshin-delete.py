@@ -6,8 +6,7 @@ import glob
 import shutil
 from subprocess import check_output
 
-from kenshin import header, pack_header
-from kenshin.agg import Agg
+from kenshin import header, set_tags
 
 from rurouni.storage import getFilePathByInstanceDir, getMetricPathByInstanceDir
 
@@ -45,29 +44,20 @@ def delete_file(storage_dir, index, pos_metrics):
     bucket_data_dir = os.path.join(storage_dir, 'data', bucket)
     filepath = getFilePathByInstanceDir(bucket_data_dir, schema_name, fid)
 
-    with open(filepath, "r+b") as fh:
+    with open(filepath, "rb") as fh:
         header_info = header(fh)
-        tag_list = header_info["tag_list"]
-        reserved_size = header_info["reserved_size"]
-        archive_list = [(a["sec_per_point"], a["count"])
-                        for a in header_info["archive_list"]]
-        agg_name = Agg.get_agg_name(header_info["agg_id"])
-
-        released_size = 0
-        for pos_idx, tag in pos_metrics:
-            if tag == tag_list[pos_idx]:
-                tag_list[pos_idx] = ""
-                released_size += len(tag)
-            elif tag_list[pos_idx] != "":
-                print >>sys.stderr, "tag not match: (%s, %d)" % (tag, pos_idx)
-
-        if released_size != 0:
-            inter_tag_list = tag_list + ["N" * (reserved_size + released_size)]
-            packed_header, _ = pack_header(inter_tag_list,
-                                           archive_list,
-                                           header_info["x_files_factor"],
-                                           agg_name)
-            fh.write(packed_header)
+    tag_list = header_info["tag_list"]
+
+    released_size = 0
+    for pos_idx, tag in pos_metrics:
+        if tag == tag_list[pos_idx]:
+            tag_list[pos_idx] = ""
+            released_size += len(tag)
+        elif tag_list[pos_idx] != "":
+            print >>sys.stderr, "tag not match: (%s, %d)" % (tag, pos_idx)
+
+    if released_size != 0:
+        set_tags(filepath, tag_list)
 
 
 def delete(storage_dir, metric_file):
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # coding: utf-8
 import sys
+import math
 import time
 import optparse
 import signal
@@ -25,6 +26,14 @@ def main():
                              default=NOW,
                              type=int,
                              help="end timestamp")
+    option_parser.add_option('--max-points',
+                             default=None,
+                             type=int,
+                             help="consolidate to at most (about) this many points")
+    option_parser.add_option('--step',
+                             default=None,
+                             type=int,
+                             help="consolidate to points of this many seconds")
 
     (options, args) = option_parser.parse_args()
     if len(args) != 1:
@@ -36,12 +45,15 @@ def main():
     from_time = int(options._from)
     until_time = int(options.until)
 
-    header, timeinfo, points = kenshin.fetch(path, from_time, until_time, NOW)
-    start, end, step = timeinfo
-
     if metric:
-        idx = header['tag_list'].index(metric)
-        points = (p[idx] if p else None for p in points)
+        _, timeinfo, _, values = kenshin.fetch_column(
+            path, metric, from_time, until_time, NOW, options.max_points,
+            options.step)
+        points = (None if math.isnan(v) else v for v in values.tolist())
+    else:
+        _, timeinfo, points = kenshin.fetch(path, from_time, until_time, NOW,
+                                            options.max_points, options.step)
+    start, end, step = timeinfo
 
     t = start
     for p in points:
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import sys
+import json
+import time
+import multiprocessing
+
+from kenshin.tools.fsck import check_file, file_tags_from_index
+
+
+def find_files(data_dir, use_index=True):
+    """
+    Yield (path, index_tags) of the data files under `data_dir`, a
+    LOCAL_DATA_DIR (<instance>/<schema>/<file_idx>.hs, and the <instance>.idx
+    index files) or any directory of data files.
+    """
+    for instance in sorted(os.listdir(data_dir)):
+        instance_dir = os.path.join(data_dir, instance)
+        index_file = os.path.join(data_dir, '%s.idx' % instance)
+        if not os.path.isdir(instance_dir):
+            continue
+        file_tags = None
+        if use_index and instance.isdigit() and os.path.exists(index_file):
+            file_tags = file_tags_from_index(index_file, instance_dir)
+        for root, dirs, files in os.walk(instance_dir):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.endswith('.hs'):
+                    continue
+                path = os.path.join(root, name)
+                index_tags = None
+                if file_tags is not None:
+                    index_tags = file_tags.get(path, {})
+                yield path, index_tags
+
+
+def check(args):
+    path, index_tags, now = args
+    return check_file(path, index_tags, now)
+
+
+def main():
+    usage = ("e.g: kenshin-fsck.py -d /data/kenshin/storage/data -p 8 -o report.json\n"
+             "Check the data files of a data directory in parallel, the report "
+             "has one JSON object per file, then a summary object.")
+
+    import argparse
+    parser = argparse.ArgumentParser(description=usage,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-d", "--data-dir", required=True,
+        help="data directory (LOCAL_DATA_DIR).")
+    parser.add_argument(
+        "-p", "--processes", default=multiprocessing.cpu_count(), type=int,
+        help="number of processes.")
+    parser.add_argument(
+        "-o", "--output", default=None,
+        help="report file (default: stdout).")
+    parser.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="only report the files with errors or warnings.")
+    parser.add_argument(
+        "--no-index", action="store_true",
+        help="do not check the tags against the index files.")
+    args = parser.parse_args()
+
+    now = int(time.time())
+    tasks = ((path, index_tags, now) for path, index_tags in
+             find_files(args.data_dir, not args.no_index))
+    out = open(args.output, 'w') if args.output else sys.stdout
+    summary = {'files': 0, 'errors': 0, 'warnings': 0, 'bytes': 0}
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for report in pool.imap_unordered(check, tasks, 16):
+            summary['files'] += 1
+            summary['errors'] += bool(report['errors'])
+            summary['warnings'] += bool(report['warnings'])
+            summary['bytes'] += report.get('size', 0)
+            if report['errors'] or report['warnings'] or not args.quiet:
+                out.write(json.dumps(report, sort_keys=True) + '\n')
+    finally:
+        pool.terminate()
+    summary['seconds'] = round(time.time() - start, 3)
+    out.write(json.dumps({'summary': summary}, sort_keys=True) + '\n')
+    if out is not sys.stdout:
+        out.close()
+    sys.exit(1 if summary['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,8 @@ import struct
 import StringIO
 from multiprocessing import Process, Queue
 
-from kenshin import storage
+import numpy as np
+
 from kenshin.agg import Agg
 from kenshin.storage import Storage
 from kenshin.consts import NULL_VALUE
@@ -89,19 +90,37 @@ def main():
 
 def worker(queue):
     for (src_type, meta, metric_paths, metrics, dst_file) in iter(queue.get, 'STOP'):
+        # the companion file of a tiered file is rebuilt along
+        cold_file = meta['cold_path']
+        tmp_file = dst_file + '.tmp'
+        cold_tmp_file = cold_file and cold_file + '.tmp'
         try:
-            tmp_file = dst_file + '.tmp'
-            merge_metrics(src_type, meta, metric_paths, metrics, tmp_file)
+            merge_metrics(src_type, meta, metric_paths, metrics, tmp_file,
+                          cold_tmp_file)
+            if cold_file:
+                # point to the final companion path before any rename
+                Storage().set_cold_path(tmp_file, cold_file)
+                os.rename(cold_tmp_file, cold_file)
             os.rename(tmp_file, dst_file)
         except Exception as e:
             print >>sys.stderr, '[merge error] %s: %s' % (dst_file, e)
-            if os.path.exists(tmp_file):
-                os.remove(tmp_file)
+            for f in filter(None, [tmp_file, cold_tmp_file]):
+                if os.path.exists(f):
+                    os.remove(f)
     return True
 
 
-def merge_metrics(src_type, meta, metric_paths, metric_names, output_file):
-    ''' Merge metrics to a kenshin file.
+def cold_header(header):
+    ''' Return the header of the companion file of a tiered file.
+    '''
+    with open(header['cold_path']) as f:
+        return Storage.header(f)
+
+
+def merge_metrics(src_type, meta, metric_paths, metric_names, output_file,
+                  cold_output_file=None):
+    ''' Merge metrics to a kenshin file, and its companion file
+    `cold_output_file` if `meta` is the header of a tiered file.
     '''
     # Get content(data points grouped by archive) of each metric.
     if src_type == 'kenshin':
@@ -115,28 +134,33 @@ def merge_metrics(src_type, meta, metric_paths, metric_names, output_file):
             for path in metric_paths
         ]
 
-    # Merge metrics to a kenshin file
-    with open(output_file, 'wb') as f:
-        archives = meta['archive_list']
-        archive_info = [(archive['sec_per_point'], archive['count'])
-                        for archive in archives]
-        inter_tag_list = metric_names + ['']  # for reserved space
-
-        # header
-        packed_kenshin_header = Storage.pack_header(
-            inter_tag_list,
-            archive_info,
-            meta['x_files_factor'],
-            Agg.get_agg_name(meta['agg_id']),
-            )[0]
-        f.write(packed_kenshin_header)
-
-        for i, archive in enumerate(archives):
-            archive_points = [x[i] for x in metrics_archives_points]
-            merged_points = merge_points(archive_points)
-            points = fill_gap(merged_points, archive, len(meta['tag_list']))
-            packed_str = packed_kenshin_points(points)
-            f.write(packed_str)
+    # Merge metrics to a kenshin file, written archive by archive
+    archives = meta['archive_list']
+    hot_archive_cnt = len(archives)
+    if meta['cold_path']:
+        archives = archives + cold_header(meta)['archive_list']
+    archive_info = [(archive['sec_per_point'], archive['count'])
+                    for archive in archives]
+    archive_points = []
+    for i in xrange(len(archives)):
+        merged_points = merge_points([x[i] for x in metrics_archives_points])
+        if not merged_points:
+            archive_points.append(None)
+            continue
+        archive_points.append((
+            np.array([ts for ts, _ in merged_points]),
+            np.array([vals for _, vals in merged_points], dtype=float)))
+
+    output_file = os.path.abspath(output_file)
+    for f in filter(None, [output_file, cold_output_file]):
+        if os.path.exists(f):
+            os.remove(f)
+    storage = Storage()
+    storage.create(output_file, metric_names, archive_info,
+                   meta['x_files_factor'], Agg.get_agg_name(meta['agg_id']),
+                   meta['layout'], meta['compression'], meta['value_type'],
+                   cold_path=cold_output_file, hot_archive_cnt=hot_archive_cnt)
+    storage.backfill(output_file, archive_points)
 
 
 def metric_to_filepath(data_dir, metric, instance_num):
@@ -174,48 +198,12 @@ def merge_points(metrics_archive_points):
     return sorted(d.items())
 
 
-def fill_gap(archive_points, archive, metric_num):
-    EMPTY_POINT = (0, (0,) * metric_num)
-    if not archive_points:
-        return [EMPTY_POINT] * archive['count']
-    step = archive['sec_per_point']
-    rs = [archive_points[0]]
-    prev_ts = archive_points[0][0]
-    for ts, point in archive_points[1:]:
-        if prev_ts + step == ts:
-            rs.append((ts, point))
-        else:
-            rs.extend([EMPTY_POINT] * ((ts-prev_ts) / step))
-        prev_ts = ts
-    if len(rs) < archive['count']:
-        rs.extend([EMPTY_POINT] * (archive['count'] - len(rs)))
-    else:
-        rs = rs[:archive['count']]
-    return rs
-
-
-def packed_kenshin_points(points):
-    point_format = storage.POINT_FORMAT % len(points[0][1])
-    str_format = point_format[0] + point_format[1:] * len(points)
-    return struct.pack(str_format, *flatten(points))
-
-
-def flatten(iterable):
-    """ Recursively iterate lists and tuples.
-
-    >>> list(flatten([1, (2, 3, [4]), 5]))
-    [1, 2, 3, 4, 5]
-    """
-    for elm in iterable:
-        if isinstance(elm, (list, tuple)):
-            for relm in flatten(elm):
-                yield relm
-        else:
-            yield elm
-
-
 def get_metric_content(metric_path, metric_name):
     ''' Return data points of each archive of the metric.
+
+    The archives of a tiered file are followed by the ones of its
+    companion file, read from the path in its header: the companion
+    files of the source have to be at that path on this host.
     '''
     conn = urllib.urlopen(metric_path)
     if conn.code == 200:
@@ -225,26 +213,34 @@ def get_metric_content(metric_path, metric_name):
 
     header = Storage.header(StringIO.StringIO(content))
     metric_list = header['tag_list']
-    metric_cnt = len(metric_list)
     metric_idx = metric_list.index(metric_name)
-    step = metric_cnt + 1
-    point_format = header['point_format']
-    byte_order, point_type = point_format[0], point_format[1:]
+    archives = [(content, header, archive)
+                for archive in header['archive_list']]
+    if header['cold_path']:
+        try:
+            with open(header['cold_path'], 'rb') as f:
+                cold_content = f.read()
+        except IOError as e:
+            raise Exception('companion file %s of tiered file %s is not '
+                            'readable here (%s)' %
+                            (header['cold_path'], metric_path, e))
+        cold_header = Storage.header(StringIO.StringIO(cold_content))
+        archives += [(cold_content, cold_header, archive)
+                     for archive in cold_header['archive_list']]
+
     metric_content = []
     now = int(time.time())
 
-    for archive in header['archive_list']:
+    for content, header, archive in archives:
         ts_min = now - archive['retention']
-        archive_points = []
-        series_format = byte_order + (point_type * archive['count'])
-        packed_str = content[archive['offset']: archive['offset'] + archive['size']]
-        unpacked_series = struct.unpack(series_format, packed_str)
-        for i in xrange(0, len(unpacked_series), step):
-            ts = unpacked_series[i]
-            if ts > ts_min:
-                # (timestamp, value)
-                datapoint = (ts, unpacked_series[i+1+metric_idx])
-                archive_points.append(datapoint)
+        point_ts, point_vals = Storage.archive_arrays(content, header, archive)
+        archive_points = [
+            # (timestamp, value)
+            (ts, val)
+            for ts, val in zip(point_ts.tolist(),
+                               point_vals[:, metric_idx].tolist())
+            if ts > ts_min
+        ]
         metric_content.append(archive_points)
 
     return metric_content
@@ -15,9 +15,25 @@ _storage = Storage()
 validate_archive_list = _storage.validate_archive_list
 create = _storage.create
 update = _storage.update
+propagate = _storage.propagate
+backfill = _storage.backfill
+prefetch = _storage.prefetch
+set_sync_policy = _storage.set_sync_policy
+commit = _storage.commit
+pop_sync_times = _storage.pop_sync_times
 fetch = _storage.fetch
+fetch_parallel = _storage.fetch_parallel
+fetch_column = _storage.fetch_column
+fetch_many = _storage.fetch_many
+fetch_aggregate = _storage.fetch_aggregate
+fetch_aggregate_paths = _storage.fetch_aggregate_paths
 header = _storage.header
 pack_header = _storage.pack_header
 add_tag = _storage.add_tag
+set_tags = _storage.set_tags
+set_cold_path = _storage.set_cold_path
+header_cache = _storage.header_cache
+file_pool = _storage.file_pool
+block_cache = _storage.block_cache
 
 parse_retention_def = RetentionParser.parse_retention_def
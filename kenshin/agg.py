@@ -5,6 +5,36 @@
 
 import operator
 
+import numpy as np
+
+
+def _np_average(values, valid, axis):
+    total = np.where(valid, values, 0.).sum(axis)
+    return total / np.maximum(valid.sum(axis), 1)
+
+
+def _np_sum(values, valid, axis):
+    return np.where(valid, values, 0.).sum(axis)
+
+
+def _np_last(values, valid, axis):
+    values = np.rollaxis(values, axis, values.ndim)
+    valid = np.rollaxis(valid, axis, valid.ndim)
+    num = values.shape[-1]
+    # index of the last valid item, 0 if there is none.
+    idx = num - 1 - valid[..., ::-1].argmax(-1)
+    flat_values = values.reshape(-1, num)
+    rows = np.arange(flat_values.shape[0])
+    return flat_values[rows, idx.ravel()].reshape(idx.shape)
+
+
+def _np_max(values, valid, axis):
+    return np.where(valid, values, -np.inf).max(axis)
+
+
+def _np_min(values, valid, axis):
+    return np.where(valid, values, np.inf).min(axis)
+
 
 class Agg(object):
     agg_funcs = [
@@ -15,8 +45,20 @@ class Agg(object):
         ['min', min],
     ]
 
+    # vectorized version of `agg_funcs`, `func(values, valid, axis)`
+    # reduces `values` along `axis` considering only the items whose
+    # `valid` flag is set, the result is undefined where no item is valid.
+    np_agg_funcs = [
+        ['average', _np_average],
+        ['sum', _np_sum],
+        ['last', _np_last],
+        ['max', _np_max],
+        ['min', _np_min],
+    ]
+
     agg_type_list = [typ for typ, _ in agg_funcs]
     agg_func_dict = dict(agg_funcs)
+    np_agg_func_dict = dict(np_agg_funcs)
 
     @classmethod
     def get_agg_id(cls, agg_name):
@@ -27,6 +69,11 @@ class Agg(object):
         agg_type = cls.agg_type_list[agg_id]
         return cls.agg_func_dict[agg_type]
 
+    @classmethod
+    def get_np_agg_func(cls, agg_id):
+        agg_type = cls.agg_type_list[agg_id]
+        return cls.np_agg_func_dict[agg_type]
+
     @classmethod
     def get_agg_type_list(cls):
         return cls.agg_type_list
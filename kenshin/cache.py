@@ -0,0 +1,239 @@
+# coding: utf-8
+#
+# This module implements the in-process caches used by storage.
+#
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """
+    A bounded, thread safe LRU mapping.
+
+    Every entry carries a `stamp` (e.g. the file's inode, size and mtime),
+    a lookup only hits if the caller's stamp equals the stored one, stale
+    entries are dropped on lookup. A `max_size` of 0 disables the cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, stamp=None):
+        with self.lock:
+            try:
+                entry_stamp, value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if entry_stamp != stamp:
+                self.misses += 1
+                self.discard(key, value)
+                return None
+            self.entries[key] = (entry_stamp, value)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, stamp=None):
+        with self.lock:
+            if self.max_size <= 0:
+                self.discard(key, value)
+                return
+            if key in self.entries:
+                self.discard(key, self.entries.pop(key)[1])
+            self.entries[key] = (stamp, value)
+            self._shrink()
+
+    def _shrink(self):
+        while len(self.entries) > max(self.max_size, 0):
+            key, (_, value) = self.entries.popitem(last=False)
+            self.discard(key, value)
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self._shrink()
+
+    def restamp(self, key, old_stamp, new_stamp):
+        """
+        Revalidate an entry after a change that does not affect its value,
+        e.g. a data write changing a file's mtime but not its header.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == old_stamp:
+                self.entries[key] = (new_stamp, entry[1])
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.discard(key, self.entries.pop(key)[1])
+
+    def clear(self):
+        with self.lock:
+            for key, (_, value) in self.entries.items():
+                self.discard(key, value)
+            self.entries.clear()
+
+    def discard(self, key, value):
+        """
+        Called with the lock held when an entry is dropped without being
+        returned to a caller.
+        """
+        pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'size': len(self.entries),
+                'max_size': self.max_size,
+            }
+
+
+class HeaderCache(LRUCache):
+    """
+    Parsed headers keyed by file path, validated by (inode, size, mtime).
+
+    Cached headers are shared, callers must not modify them, but for the
+    base timestamps set by the first write of an archive (which change the
+    file the same way).
+    """
+
+    @staticmethod
+    def file_stamp(st):
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def get_header(self, path, fh, st, load):
+        stamp = self.file_stamp(st)
+        header = self.get(path, stamp)
+        if header is None:
+            header = load(fh)
+            self.put(path, header, stamp)
+        return header
+
+
+class FilePool(LRUCache):
+    """
+    Open file handles keyed by (path, mode).
+
+    A handle is lent to one caller at a time by `acquire` and given back by
+    `release`. Entries are validated by the inode of `path`, so a file that
+    has been replaced by rename (e.g. `add_tag` or kenshin-change-schema)
+    is reopened instead of writing to the unlinked one. Handles dropped
+    from the pool are closed.
+    """
+
+    def acquire(self, path, mode, ino):
+        with self.lock:
+            try:
+                entry_ino, fh = self.entries.pop((path, mode))
+            except KeyError:
+                self.misses += 1
+                return None
+            if entry_ino != ino:
+                self.misses += 1
+                self.discard((path, mode), fh)
+                return None
+            self.hits += 1
+            return fh
+
+    def release(self, path, mode, fh, ino):
+        self.put((path, mode), fh, ino)
+
+    def invalidate_path(self, path):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == path]:
+                self.discard(key, self.entries.pop(key)[1])
+
+    def discard(self, key, fh):
+        fh.close()
+
+
+class BlockCache(LRUCache):
+    """
+    Decoded point ranges of archives, keyed by (path, archive offset,
+    range index), bounded by the bytes of their arrays: `max_size` is a
+    byte budget.
+
+    Entries are validated by the file's (inode, size, mtime) and by a per
+    file generation, which writers of this process `bump`, so a write
+    within the mtime resolution is not missed. Only the files with cached
+    ranges keep a generation, the others are at the cache's `clock`,
+    which every bump advances, and a range read before a bump is not
+    cached. The cached arrays are read-only, callers get copies by
+    indexing them.
+    """
+
+    def __init__(self, max_size):
+        LRUCache.__init__(self, max_size)
+        self.used = 0
+        self.clock = 0
+        self.generations = {}
+        self.range_cnts = {}
+
+    @staticmethod
+    def size_of(value):
+        return sum(array.nbytes for array in value)
+
+    def stamp(self, path, st):
+        return HeaderCache.file_stamp(st), self.generations.get(path,
+                                                                self.clock)
+
+    def bump(self, path):
+        """
+        Invalidate the cached ranges of `path` after a change.
+        """
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.clock += 1
+            if path in self.generations:
+                self.generations[path] = self.clock
+
+    def put(self, key, value, stamp=None):
+        with self.lock:
+            path = key[0]
+            generation = self.generations.get(path, self.clock)
+            if stamp is not None and stamp[1] != generation:
+                # the file changed since the range was read
+                return
+            if key in self.entries:
+                self.discard(key, self.entries.pop(key)[1])
+            size = self.size_of(value)
+            if size > self.max_size:
+                return
+            self.entries[key] = (stamp, value)
+            self.used += size
+            self.generations[path] = generation
+            self.range_cnts[path] = self.range_cnts.get(path, 0) + 1
+            self._shrink()
+
+    def _shrink(self):
+        while self.used > max(self.max_size, 0):
+            key, (_, value) = self.entries.popitem(last=False)
+            self.discard(key, value)
+
+    def discard(self, key, value):
+        self.used -= self.size_of(value)
+        path = key[0]
+        self.range_cnts[path] -= 1
+        if not self.range_cnts[path]:
+            # the last range of the file is gone
+            del self.range_cnts[path]
+            del self.generations[path]
+
+    def stats(self):
+        stats = LRUCache.stats(self)
+        stats['bytes'] = self.used
+        return stats
@@ -0,0 +1,97 @@
+# coding: utf-8
+#
+# This module implements the block encoding of compressed archives.
+#
+# A block is a run of ring slots, Gorilla style, the timestamps are stored
+# as delta of deltas and every value as the XOR of its bits with the
+# previous value of the same metric, so regular timestamps and repeated (or
+# null) values become zeros. Instead of packing the bits one by one (which
+# is too slow in python), the byte planes of the integers are shuffled
+# together and the result is deflated by zlib.
+#
+# Block = zlib(TimestampPlanes, ValuePlanes) | TimestampPlanes, ValuePlanes
+#
+# The second form (raw) is used when compression does not help, it has
+# exactly the size of the points in the uncompressed file format, so a
+# block always fits in the space of its points. Values are encoded with
+# the value type of the file (float64 or float32).
+#
+
+import zlib
+
+import numpy as np
+
+
+COMPRESS_LEVEL = 6
+
+
+def _delta(x):
+    d = x.copy()
+    d[1:] -= x[:-1]
+    return d
+
+
+def _shuffle(x, dtype):
+    """
+    Big endian bytes of `x`, byte 0 of every item first, then byte 1, ...
+    """
+    x = np.ascontiguousarray(x, dtype=dtype)
+    return x.view(np.uint8).reshape(x.size, x.itemsize).T.tostring()
+
+
+def _unshuffle(data, dtype, cnt):
+    itemsize = np.dtype(dtype).itemsize
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, cnt)
+    return np.ascontiguousarray(planes.T).view(dtype).ravel()
+
+
+# unsigned integer type of the same size, by value type.
+_BITS_TYPES = {
+    np.dtype(np.float64): np.uint64,
+    np.dtype(np.float32): np.uint32,
+}
+
+
+def raw_block_size(cnt, tag_cnt, value_size=8):
+    return cnt * (4 + value_size * tag_cnt)
+
+
+def encode_block(point_ts, point_vals, value_type=np.float64):
+    """
+    Encode the `point_ts` timestamps and `point_vals` (points, metrics)
+    values of a block, values are stored as `value_type`.
+    """
+    value_type = np.dtype(value_type).newbyteorder('=')
+    bits_type = np.dtype(_BITS_TYPES[value_type])
+    point_ts = np.asarray(point_ts).astype(np.uint32)
+    # uint32 arithmetic wraps around, which decoding undoes
+    ts_dod = _delta(_delta(point_ts))
+    bits = np.ascontiguousarray(point_vals, dtype=value_type).view(bits_type)
+    bits_xor = bits.copy()
+    bits_xor[1:] ^= bits[:-1]
+
+    raw = (_shuffle(ts_dod, '>u4') +
+           _shuffle(bits_xor.T, bits_type.newbyteorder('>')))
+    packed = zlib.compress(raw, COMPRESS_LEVEL)
+    return packed if len(packed) < len(raw) else raw
+
+
+def decode_block(data, cnt, tag_cnt, value_type=np.float64):
+    """
+    Decode a block of `cnt` points, return (timestamps, values) as an int64
+    array and a float64 array of shape (cnt, tag_cnt).
+    """
+    value_type = np.dtype(value_type).newbyteorder('=')
+    bits_type = np.dtype(_BITS_TYPES[value_type])
+    if len(data) < raw_block_size(cnt, tag_cnt, value_type.itemsize):
+        data = zlib.decompress(data)
+    ts_size = cnt * 4
+    ts_dod = _unshuffle(data[:ts_size], '>u4', cnt).astype(np.uint32)
+    point_ts = ts_dod.cumsum(dtype=np.uint32).cumsum(dtype=np.uint32)
+
+    bits_xor = _unshuffle(data[ts_size:], bits_type.newbyteorder('>'),
+                          cnt * tag_cnt)
+    bits_xor = bits_xor.astype(bits_type).reshape(tag_cnt, cnt).T
+    bits = np.bitwise_xor.accumulate(bits_xor, axis=0)
+    point_vals = np.ascontiguousarray(bits).view(value_type)
+    return point_ts.astype(np.int64), point_vals.astype(np.float64)
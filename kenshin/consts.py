@@ -3,4 +3,20 @@
 
 NULL_VALUE = -4294967296.0
 DEFAULT_TAG_LENGTH = 96
-CHUNK_SIZE = 16384
\ No newline at end of file
+CHUNK_SIZE = 16384
+
+# max number of parsed headers kept by a Storage instance.
+HEADER_CACHE_SIZE = 10000
+
+# number of points per block of compressed archives.
+COMPRESSED_BLOCK_POINTS = 128
+
+# number of threads of `Storage.fetch_parallel`.
+FETCH_WORKERS = 8
+
+# byte budget of the decoded archive ranges kept by a Storage instance
+# (0 disables the cache).
+BLOCK_CACHE_SIZE = 0
+
+# number of points per cached range of uncompressed archives.
+BLOCK_CACHE_POINTS = 128
@@ -0,0 +1,205 @@
+# coding: utf-8
+#
+# This module implements positioned (and vectored) file I/O.
+#
+# Positioned I/O does not use the shared file offset, so one file
+# descriptor can serve several callers, and a vectored write sends
+# several buffers to one contiguous file range in a single system call.
+# Python 2 does not expose these calls in `os`, we call libc through
+# ctypes, falling back to lseek + read/write where libc does not provide
+# them.
+#
+
+import os
+import errno
+import ctypes
+import ctypes.util
+
+
+# the limit of buffers per vectored call (IOV_MAX on linux)
+IOV_MAX = 1024
+
+# posix_fadvise advice (linux value)
+POSIX_FADV_WILLNEED = 3
+
+# sync_file_range flags (linux values)
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+def _load_libc_func(libc, names, argtypes):
+    for name in names:
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = argtypes
+            func.restype = ctypes.c_ssize_t
+            return func
+    return None
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+if _libc is not None:
+    _pread = _load_libc_func(
+        _libc, ['pread64', 'pread'],
+        [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64])
+    _pwritev = _load_libc_func(
+        _libc, ['pwritev64', 'pwritev'],
+        [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int, ctypes.c_int64])
+    _posix_fallocate = _load_libc_func(
+        _libc, ['posix_fallocate64', 'posix_fallocate'],
+        [ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+    _posix_fadvise = _load_libc_func(
+        _libc, ['posix_fadvise64', 'posix_fadvise'],
+        [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+    _sync_file_range = _load_libc_func(
+        _libc, ['sync_file_range'],
+        [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint])
+    if _sync_file_range is not None:
+        _sync_file_range.restype = ctypes.c_int
+    # both return an error number instead of setting errno
+    for _func in (_posix_fallocate, _posix_fadvise):
+        if _func is not None:
+            _func.restype = ctypes.c_int
+else:
+    _pread = _pwritev = _posix_fallocate = _posix_fadvise = None
+    _sync_file_range = None
+
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+def pread(fd, size, offset):
+    """
+    Read up to `size` bytes at `offset`, return the bytes read.
+    """
+    if _pread is None:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+    buf = ctypes.create_string_buffer(size)
+    n = _check(_pread(fd, buf, size, offset))
+    return buf.raw[:n]
+
+
+def pwritev(fd, bufs, offset):
+    """
+    Write strings `bufs` back to back starting at `offset`.
+    """
+    if _pwritev is None:
+        os.lseek(fd, offset, os.SEEK_SET)
+        for buf in bufs:
+            _write_all(fd, buf)
+        return
+
+    for i in xrange(0, len(bufs), IOV_MAX):
+        chunk = bufs[i: i+IOV_MAX]
+        # keep the strings referenced while libc reads them
+        c_bufs = [ctypes.c_char_p(b) for b in chunk]
+        iov = (iovec * len(chunk))(*[
+            iovec(ctypes.cast(c, ctypes.c_void_p), len(b))
+            for c, b in zip(c_bufs, chunk)])
+        size = sum(len(b) for b in chunk)
+        n = _check(_pwritev(fd, iov, len(chunk), offset))
+        if n < size:
+            # short write, finish it the slow way
+            rest = ''.join(chunk)[n:]
+            os.lseek(fd, offset + n, os.SEEK_SET)
+            _write_all(fd, rest)
+        offset += size
+
+
+def pwrite(fd, buf, offset):
+    pwritev(fd, [buf], offset)
+
+
+def fallocate(fd, offset, size, chunk_size=16384):
+    """
+    Allocate disk blocks for `size` bytes at `offset`, reading back as
+    zeros, without writing them where the file system supports it, writing
+    zeros otherwise.
+    """
+    if size <= 0:
+        return
+    if _posix_fallocate is not None:
+        err = _posix_fallocate(fd, offset, size)
+        if err == 0:
+            return
+        if err not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise OSError(err, os.strerror(err))
+
+    zeroes = '\x00' * chunk_size
+    end = offset + size
+    while offset < end:
+        n = min(chunk_size, end - offset)
+        pwrite(fd, zeroes[:n], offset)
+        offset += n
+
+
+def willneed(fd, offset, size):
+    """
+    Ask the kernel to read `size` bytes at `offset` into the page cache in
+    the background (posix_fadvise WILLNEED). Return False where that is not
+    supported, nothing is read then.
+    """
+    if size <= 0:
+        return True
+    if _posix_fadvise is None:
+        return False
+    err = _posix_fadvise(fd, offset, size, POSIX_FADV_WILLNEED)
+    if err == 0:
+        return True
+    if err in (errno.ENOSYS, errno.EINVAL, errno.ESPIPE):
+        return False
+    raise OSError(err, os.strerror(err))
+
+
+def fdatasync(fd):
+    """
+    Flush the data of the file (and the metadata needed to read it back) to
+    the disk, fsync where fdatasync is not available.
+    """
+    getattr(os, 'fdatasync', os.fsync)(fd)
+
+
+def start_writeback(fd, offset=0, size=0):
+    """
+    Start writing the dirty pages of `size` bytes at `offset` (the whole
+    file if `size` is 0) to the disk without waiting for them
+    (sync_file_range WRITE). This does not make them durable, it lets the
+    writeback of many files overlap before they are fdatasync'ed. Return
+    False where that is not supported.
+    """
+    if _sync_file_range is None:
+        return False
+    if _sync_file_range(fd, offset, size, SYNC_FILE_RANGE_WRITE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.ESPIPE):
+        return False
+    raise OSError(err, os.strerror(err))
+
+
+def _write_all(fd, buf):
+    while buf:
+        try:
+            n = os.write(fd, buf)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        buf = buf[n:]
@@ -23,27 +23,93 @@ limitations under the License.
 # basic layout of fileformat.
 #
 # File = Header, Data
-#     Header = Metadata, Tag+, ArchiveInfo+
+#     Header = [Prefix], Metadata, Tag+, ArchiveInfo+
+#         Prefix = magic, version, flags
 #         Metadata = agg_id, max_retention, x_files_factor, archive_count, tag_size, point_size
 #         Tag = metric
-#         ArchiveInfo = offset, seconds_per_point, point_count
+#         ArchiveInfo = offset, seconds_per_point, point_count, [base_timestamp]
 #     Data = Archive+
 #         Archive = Point+
 #             Point = timestamp, value
 #
+# Version 1 files have no prefix (the magic can not be a valid agg_id).
+# Version 2 files carry a prefix, its flags describe the data format, with
+# FLAG_COLUMNAR set an archive is stored column by column:
+#
+#         Archive = Timestamp+, Column+
+#             Column = value+
+#
+# i.e. the timestamps of all the points, followed by the values of the
+# first metric, and so on. Point i of every column belongs to the same
+# slot of the ring, an archive has the same size in both layouts.
+#
+# With FLAG_COMPRESSED set, the archives but the first one are compressed,
+# the ring is cut into blocks of block_points slots, every block is encoded
+# (see kenshin.codec) into the space of its points, and the header is
+# followed by a block index:
+#
+#     Header = Prefix, Metadata, Tag+, ArchiveInfo+, block_points, BlockIndex+
+#         BlockIndex = block_length+    (one per compressed archive)
+#
+# a block length of 0 means that the block has never been written. The
+# unused space of the blocks is left as holes in the file.
+#
+# With FLAG_FLOAT32 set, values are stored as float32 instead of float64.
+#
+# With FLAG_BASE_TS set, every ArchiveInfo ends with the base timestamp of
+# the archive, i.e. the timestamp of its first slot (0 until the first
+# write), so the ring positions are known without reading the data. Files
+# without it are migrated on their first write, if the reserved tag space
+# can hold the larger header (see `Storage._migrate_header`).
+#
+# With FLAG_TAG_OVERFLOW set, the tags are stored in a tag table after the
+# data, and the Tag region of the header is only padding:
+#
+# File = Header, Data, TagTable
+#     TagTable = tag_size, Tag+
+#
+# the tags move there when they outgrow the Tag region (see
+# `Storage.set_tags`), so that changing them never moves the data.
+#
+# With FLAG_TIERED set, the file only holds the highest precision archives
+# (the fast tier), the lower precision ones are in a companion file (a file
+# of its own, with the same tags, usually on another disk), whose path
+# ends the header:
+#
+#     Header = ..., ArchiveInfo+, [block_points], ColdPath, [BlockIndex+]
+#         ColdPath = path_size, path    (NUL padded to path_size)
+#
+# `update`, `propagate` and `fetch` of the file read and write the
+# companion file where needed (see `Storage.create`).
+#
 
 import os
 import re
+import errno
+import sys
 import time
+import mmap
 import numpy as np
 import math
 import struct
 import operator
 import inspect
+from fractions import gcd
+from StringIO import StringIO
+from contextlib import contextmanager
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 
 from kenshin.agg import Agg
-from kenshin.utils import mkdir_p, roundup
-from kenshin.consts import DEFAULT_TAG_LENGTH, NULL_VALUE, CHUNK_SIZE
+from kenshin.cache import HeaderCache, FilePool, BlockCache
+from kenshin import fileio
+from kenshin.fileio import pread, pwritev
+from kenshin.utils import mkdir_p, roundup, group_by_file
+from kenshin import codec
+from kenshin.consts import (
+    DEFAULT_TAG_LENGTH, NULL_VALUE, CHUNK_SIZE, HEADER_CACHE_SIZE,
+    COMPRESSED_BLOCK_POINTS, FETCH_WORKERS, BLOCK_CACHE_SIZE,
+    BLOCK_CACHE_POINTS)
 
 
 LONG_FORMAT = "!L"
@@ -53,10 +119,52 @@ FLOAT_SIZE = struct.calcsize(FLOAT_FORMAT)
 VALUE_FORMAT = "!d"
 VALUE_SIZE = struct.calcsize(VALUE_FORMAT)
 POINT_FORMAT = "!L%dd"
+FLOAT32_POINT_FORMAT = "!L%df"
 METADATA_FORMAT = "!2Lf3L"
 METADATA_SIZE = struct.calcsize(METADATA_FORMAT)
 ARCHIVEINFO_FORMAT = "!3L"
 ARCHIVEINFO_SIZE = struct.calcsize(ARCHIVEINFO_FORMAT)
+BASE_ARCHIVEINFO_FORMAT = "!4L"
+BASE_ARCHIVEINFO_SIZE = struct.calcsize(BASE_ARCHIVEINFO_FORMAT)
+PREFIX_FORMAT = "!3L"
+PREFIX_SIZE = struct.calcsize(PREFIX_FORMAT)
+
+HEADER_MAGIC = 0x4b534846  # 'KSHF'
+HEADER_VERSION = 2
+
+BLOCKINFO_FORMAT = "!L"
+BLOCKINFO_SIZE = struct.calcsize(BLOCKINFO_FORMAT)
+
+# data format flags of version 2 files
+FLAG_COLUMNAR = 0x1
+FLAG_COMPRESSED = 0x2
+FLAG_FLOAT32 = 0x4
+FLAG_BASE_TS = 0x8
+FLAG_TAG_OVERFLOW = 0x10
+FLAG_TIERED = 0x20
+
+LAYOUT_ROW = 'row'
+LAYOUT_COLUMN = 'column'
+LAYOUTS = (LAYOUT_ROW, LAYOUT_COLUMN)
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_GORILLA = 'gorilla'
+COMPRESSIONS = (COMPRESSION_NONE, COMPRESSION_GORILLA)
+
+VALUE_TYPE_FLOAT64 = 'float64'
+VALUE_TYPE_FLOAT32 = 'float32'
+VALUE_TYPES = (VALUE_TYPE_FLOAT64, VALUE_TYPE_FLOAT32)
+
+# how `create` allocates the data of a new file, see `create`.
+ALLOCATION_FALLOCATE = 'fallocate'
+ALLOCATION_SPARSE = 'sparse'
+ALLOCATIONS = (ALLOCATION_FALLOCATE, ALLOCATION_SPARSE)
+
+# when the writes are made durable, see `set_sync_policy`.
+SYNC_NONE = 'none'
+SYNC_FDATASYNC = 'fdatasync'
+SYNC_GROUP = 'group'
+SYNC_POLICIES = (SYNC_NONE, SYNC_FDATASYNC, SYNC_GROUP)
 
 # reserved tag index for reserved space,
 # this is usefull when adding a tag to a file.
@@ -90,7 +198,7 @@ def enable_debug(ignore_header=False):
     因此 enable_debug 中使用 ignore_header 来忽略了 header 的读操作，从而方便 io
     性能的测试.
     """
-    global open, debug
+    global open, debug, pread, pwritev
 
     if not ignore_header:
         def debug(msg):
@@ -124,6 +232,19 @@ def enable_debug(ignore_header=False):
         def get_caller(self):
             return inspect.stack()[2][3]
 
+    def pread(fd, size, offset):
+        caller = inspect.stack()[1][3]
+        open.read_cnt += 1
+        debug("Read %d bytes #%d in %s" % (size, open.read_cnt, caller))
+        return fileio.pread(fd, size, offset)
+
+    def pwritev(fd, bufs, offset):
+        caller = inspect.stack()[1][3]
+        open.write_cnt += 1
+        debug("Write %d bytes #%d in %s" % (sum(len(b) for b in bufs),
+                                            open.write_cnt, caller))
+        return fileio.pwritev(fd, bufs, offset)
+
 
 ### retention parser
 
@@ -185,12 +306,48 @@ class RetentionParser(object):
 
 class Storage(object):
 
-    def __init__(self, data_dir=''):
+    def __init__(self, data_dir='', header_cache_size=HEADER_CACHE_SIZE,
+                 max_open_files=0, block_cache_size=BLOCK_CACHE_SIZE,
+                 sync_policy=SYNC_NONE):
         self.data_dir = data_dir
+        self.header_cache = HeaderCache(header_cache_size)
+        self.file_pool = FilePool(max_open_files)
+        self.block_cache = BlockCache(block_cache_size)
+        self.sync_lock = Lock()
+        self.dirty_paths = set()
+        self.sync_times = []
+        self.set_sync_policy(sync_policy)
 
     def create(self, metric_name, tag_list, archive_list, x_files_factor=None,
-               agg_name=None):
+               agg_name=None, layout=LAYOUT_ROW, compression=COMPRESSION_NONE,
+               value_type=VALUE_TYPE_FLOAT64, allocation=ALLOCATION_FALLOCATE,
+               cold_path=None, hot_archive_cnt=1):
+        """
+        Create the data file of `metric_name`. `layout` is either 'row'
+        (points stored one after another) or 'column', `compression` is
+        either 'none' or 'gorilla' (compress all archives but the first
+        one), `value_type` is either 'float64' or 'float32'. Version 2
+        files are created, see the file format above.
+
+        The data is zero filled without being written, `allocation` is
+        either 'fallocate' (disk blocks are reserved up front) or 'sparse'
+        (the data is a hole, blocks are allocated by the first writes).
+        Compressed archives are always sparse.
+
+        Given `cold_path`, the file is tiered: only the first
+        `hot_archive_cnt` archives are stored in the file, the others go
+        to a companion file created at `cold_path` (with the same options),
+        e.g. to keep the rarely read archives off a fast disk.
+        """
         Storage.validate_archive_list(archive_list, x_files_factor)
+        flags = Storage.format_flags(layout, compression, value_type)
+        if allocation not in ALLOCATIONS:
+            raise InvalidConfig("unknown allocation '%s', must be one of %s" %
+                                (allocation, ', '.join(ALLOCATIONS)))
+        if cold_path and not 0 < hot_archive_cnt < len(archive_list):
+            raise InvalidConfig("a tiered file needs 1 to %d hot archives, "
+                                "not %s" % (len(archive_list) - 1,
+                                            hot_archive_cnt))
 
         path = self.gen_path(self.data_dir, metric_name)
         if os.path.exists(path):
@@ -198,6 +355,14 @@ class Storage(object):
         else:
             mkdir_p(os.path.dirname(path))
 
+        if cold_path:
+            cold_path = os.path.abspath(cold_path)
+            self.create(cold_path, tag_list, archive_list[hot_archive_cnt:],
+                        x_files_factor, agg_name, layout, compression,
+                        value_type, allocation)
+            archive_list = archive_list[:hot_archive_cnt]
+            flags |= FLAG_TIERED
+
         # inter_tag_list[RESERVED_INDEX] is reserved space
         # to avoid move data points.
         empty_tag_cnt = sum(1 for t in tag_list if not t)
@@ -205,16 +370,52 @@ class Storage(object):
 
         with open(path, 'wb') as f:
             packed_header, end_offset = self.pack_header(
-                inter_tag_list, archive_list, x_files_factor, agg_name)
+                inter_tag_list, archive_list, x_files_factor, agg_name, flags,
+                cold_path=cold_path)
             f.write(packed_header)
 
-            # init data
-            remaining = end_offset - f.tell()
-            zeroes = '\x00' * CHUNK_SIZE
-            while remaining > CHUNK_SIZE:
-                f.write(zeroes)
-                remaining -= CHUNK_SIZE
-            f.write(zeroes[:remaining])
+            # init data, compressed archives are left as holes
+            if flags & FLAG_COMPRESSED and len(archive_list) > 1:
+                header = self.header(StringIO(packed_header))
+                allocate_end = header['archive_list'][1]['offset']
+            else:
+                allocate_end = end_offset
+            f.flush()
+            if allocation == ALLOCATION_FALLOCATE:
+                fileio.fallocate(f.fileno(), f.tell(), allocate_end - f.tell(),
+                                 CHUNK_SIZE)
+            f.truncate(end_offset)
+
+    @staticmethod
+    def format_flags(layout=LAYOUT_ROW, compression=COMPRESSION_NONE,
+                     value_type=VALUE_TYPE_FLOAT64):
+        """
+        Data format flags of the given file options, new files always
+        store the base timestamps in the header.
+        """
+        if layout not in LAYOUTS:
+            raise InvalidConfig("unknown layout '%s', must be one of %s" %
+                                (layout, ', '.join(LAYOUTS)))
+        if compression not in COMPRESSIONS:
+            raise InvalidConfig("unknown compression '%s', must be one of %s" %
+                                (compression, ', '.join(COMPRESSIONS)))
+        if value_type not in VALUE_TYPES:
+            raise InvalidConfig("unknown value type '%s', must be one of %s" %
+                                (value_type, ', '.join(VALUE_TYPES)))
+        flags = FLAG_BASE_TS
+        if layout == LAYOUT_COLUMN:
+            flags |= FLAG_COLUMNAR
+        if compression != COMPRESSION_NONE:
+            flags |= FLAG_COMPRESSED
+        if value_type == VALUE_TYPE_FLOAT32:
+            flags |= FLAG_FLOAT32
+        return flags
+
+    @staticmethod
+    def point_format(flags, tag_cnt):
+        if flags & FLAG_FLOAT32:
+            return FLOAT32_POINT_FORMAT % tag_cnt
+        return POINT_FORMAT % tag_cnt
 
     @staticmethod
     def validate_archive_list(archive_list, xff):
@@ -285,9 +486,33 @@ class Storage(object):
         return os.path.join(data_dir, file_path)
 
     @staticmethod
-    def pack_header(inter_tag_list, archive_list, x_files_factor, agg_name):
-        # tag
-        tag = str('\t'.join(inter_tag_list))
+    def pack_header(inter_tag_list, archive_list, x_files_factor, agg_name,
+                    flags=0, base_ts_list=None, cold_path=None,
+                    cold_path_size=None):
+        """
+        Pack a file header, a version 2 header (with prefix) is packed if
+        any of the data format `flags` is set. Callers rewriting the header
+        of an existing file must pass on `header['flags']`, the base
+        timestamps of the archives (`base_ts_list`, zeros by default),
+        `header['cold_path']` and `header['cold_path_size']`.
+
+        With FLAG_TAG_OVERFLOW, only the reserved space of `inter_tag_list`
+        is packed, the tags go to the tag table (see `pack_tag_table`).
+        With FLAG_TIERED, `cold_path` is the path of the companion file,
+        NUL padded to `cold_path_size` bytes.
+        """
+        # prefix
+        if flags:
+            prefix = struct.pack(PREFIX_FORMAT, HEADER_MAGIC, HEADER_VERSION,
+                                 flags)
+        else:
+            prefix = ''
+
+        # tag, only the padding if the tags are in the tag table
+        if flags & FLAG_TAG_OVERFLOW:
+            tag = str(inter_tag_list[RESERVED_INDEX])
+        else:
+            tag = str('\t'.join(inter_tag_list))
 
         # metadata
         agg_id = Agg.get_agg_id(agg_name)
@@ -295,221 +520,1023 @@ class Storage(object):
         xff = x_files_factor
         archive_cnt = len(archive_list)
         tag_size = len(tag)
-        point_size = struct.calcsize(POINT_FORMAT % (len(inter_tag_list) - 1))
+        point_size = struct.calcsize(
+            Storage.point_format(flags, len(inter_tag_list) - 1))
         metadata = struct.pack(METADATA_FORMAT, agg_id, max_retention,
             xff, archive_cnt, tag_size, point_size)
 
         # archive_info
-        header = [metadata, tag]
-        offset = METADATA_SIZE + len(tag) + ARCHIVEINFO_SIZE * len(archive_list)
-
-        for sec, cnt in archive_list:
-            archive_info = struct.pack(ARCHIVEINFO_FORMAT, offset, sec, cnt)
+        header = [prefix, metadata, tag]
+        if flags & FLAG_BASE_TS:
+            archive_info_size = BASE_ARCHIVEINFO_SIZE
+        else:
+            archive_info_size = ARCHIVEINFO_SIZE
+        offset = (len(prefix) + METADATA_SIZE + len(tag) +
+                  archive_info_size * len(archive_list))
+
+        if flags & FLAG_TIERED:
+            packed_cold_path = Storage.pack_cold_path(cold_path,
+                                                      cold_path_size)
+            offset += len(packed_cold_path)
+
+        # block index, it is not part of the packed header
+        if flags & FLAG_COMPRESSED:
+            block_points = COMPRESSED_BLOCK_POINTS
+            offset += BLOCKINFO_SIZE + sum(
+                BLOCKINFO_SIZE * Storage.block_count(cnt, block_points)
+                for _, cnt in archive_list[1:])
+
+        base_ts_list = base_ts_list or [0] * len(archive_list)
+        for (sec, cnt), base_ts in zip(archive_list, base_ts_list):
+            if flags & FLAG_BASE_TS:
+                archive_info = struct.pack(BASE_ARCHIVEINFO_FORMAT, offset,
+                                           sec, cnt, base_ts or 0)
+            else:
+                archive_info = struct.pack(ARCHIVEINFO_FORMAT, offset, sec, cnt)
             header.append(archive_info)
             offset += point_size * cnt
+
+        if flags & FLAG_COMPRESSED:
+            header.append(struct.pack(BLOCKINFO_FORMAT, block_points))
+        if flags & FLAG_TIERED:
+            header.append(packed_cold_path)
         return ''.join(header), offset
 
+    @staticmethod
+    def pack_cold_path(cold_path, path_size=None):
+        cold_path = str(cold_path)
+        path_size = path_size or len(cold_path)
+        return (struct.pack(LONG_FORMAT, path_size) +
+                cold_path.ljust(path_size, '\x00'))
+
+    @staticmethod
+    def pack_tag_table(tag_list):
+        tags = str('\t'.join(tag_list + ['']))
+        return struct.pack(LONG_FORMAT, len(tags)) + tags
+
+    @staticmethod
+    def block_count(point_cnt, block_points):
+        return -(-point_cnt // block_points)
+
     @staticmethod
     def header(fh):
         origin_offset = fh.tell()
         if origin_offset != 0:
             fh.seek(0)
         packed_metadata = fh.read(METADATA_SIZE)
+        if struct.unpack(LONG_FORMAT, packed_metadata[:LONG_SIZE])[0] == HEADER_MAGIC:
+            packed_prefix = packed_metadata[:PREFIX_SIZE]
+            packed_metadata = (packed_metadata[PREFIX_SIZE:] +
+                               fh.read(PREFIX_SIZE))
+            _, version, flags = struct.unpack(PREFIX_FORMAT, packed_prefix)
+            if version > HEADER_VERSION:
+                raise KenshinException("unsupported file version: %s" % version)
+            metadata_offset = PREFIX_SIZE
+        else:
+            version, flags = 1, 0
+            metadata_offset = 0
         agg_id, max_retention, xff, archive_cnt, tag_size, point_size = struct.unpack(
             METADATA_FORMAT, packed_metadata)
         inter_tag_list = fh.read(tag_size).split('\t')
 
         archives = []
         for i in xrange(archive_cnt):
-            packed_archive_info = fh.read(ARCHIVEINFO_SIZE)
-            offset, sec, cnt = struct.unpack(
-                ARCHIVEINFO_FORMAT, packed_archive_info)
+            if flags & FLAG_BASE_TS:
+                base_ts_offset = fh.tell() + ARCHIVEINFO_SIZE
+                packed_archive_info = fh.read(BASE_ARCHIVEINFO_SIZE)
+                offset, sec, cnt, base_ts = struct.unpack(
+                    BASE_ARCHIVEINFO_FORMAT, packed_archive_info)
+            else:
+                # unknown, stored in the first slot of the archive
+                base_ts_offset = base_ts = None
+                packed_archive_info = fh.read(ARCHIVEINFO_SIZE)
+                offset, sec, cnt = struct.unpack(
+                    ARCHIVEINFO_FORMAT, packed_archive_info)
             archive_info = {
                 'offset': offset,
                 'sec_per_point': sec,
                 'count': cnt,
                 'size': point_size * cnt,
                 'retention': sec * cnt,
+                'compressed': bool(i and flags & FLAG_COMPRESSED),
+                'base_ts': base_ts,
+                'base_ts_offset': base_ts_offset,
             }
             archives.append(archive_info)
 
+        block_points = 0
+        if flags & FLAG_COMPRESSED:
+            block_points = struct.unpack(
+                BLOCKINFO_FORMAT, fh.read(BLOCKINFO_SIZE))[0]
+        cold_path = cold_path_offset = cold_path_size = None
+        if flags & FLAG_TIERED:
+            cold_path_offset = fh.tell()
+            cold_path_size = struct.unpack(LONG_FORMAT, fh.read(LONG_SIZE))[0]
+            cold_path = fh.read(cold_path_size).rstrip('\x00')
+        # the packed header ends here, the block index follows
+        header_size = fh.tell()
+        index_offset = header_size
+        for archive_info in archives:
+            if archive_info['compressed']:
+                block_cnt = Storage.block_count(archive_info['count'],
+                                                block_points)
+                archive_info['block_cnt'] = block_cnt
+                archive_info['block_index_offset'] = index_offset
+                index_offset += BLOCKINFO_SIZE * block_cnt
+
+        data_end = archives[-1]['offset'] + archives[-1]['size']
+        if flags & FLAG_TAG_OVERFLOW:
+            # the Tag region is the reserved space
+            reserved = inter_tag_list[0]
+            fh.seek(data_end)
+            tag_size = struct.unpack(LONG_FORMAT, fh.read(LONG_SIZE))[0]
+            inter_tag_list = fh.read(tag_size).split('\t')
+            inter_tag_list[RESERVED_INDEX] = reserved
+
         fh.seek(origin_offset)
         tag_list = inter_tag_list[:RESERVED_INDEX]
         info = {
+            'version': version,
+            'flags': flags,
+            'layout': LAYOUT_COLUMN if flags & FLAG_COLUMNAR else LAYOUT_ROW,
+            'compression': (COMPRESSION_GORILLA if flags & FLAG_COMPRESSED
+                            else COMPRESSION_NONE),
+            'block_points': block_points,
+            'value_type': (VALUE_TYPE_FLOAT32 if flags & FLAG_FLOAT32
+                           else VALUE_TYPE_FLOAT64),
+            'value_format': FLOAT_FORMAT if flags & FLAG_FLOAT32 else VALUE_FORMAT,
+            'value_size': FLOAT_SIZE if flags & FLAG_FLOAT32 else VALUE_SIZE,
+            'metadata_offset': metadata_offset,
+            'header_size': header_size,
+            'data_end': data_end,
             'agg_id': agg_id,
             'max_retention': max_retention,
             'x_files_factor': xff,
             'tag_list': tag_list,
             'reserved_size': len(inter_tag_list[RESERVED_INDEX]),
             'point_size': point_size,
-            'point_format': POINT_FORMAT % len(tag_list),
+            'point_format': Storage.point_format(flags, len(tag_list)),
             'archive_list': archives,
+            'cold_path': cold_path,
+            'cold_path_offset': cold_path_offset,
+            'cold_path_size': cold_path_size,
         }
         return info
 
-    @staticmethod
-    def add_tag(tag, path, pos_idx):
+    def add_tag(self, tag, path, pos_idx):
         with open(path, 'r+b') as fh:
             header_info = Storage.header(fh)
-            tag_list = header_info['tag_list']
-            reserved_size = header_info['reserved_size']
-
-            archive_list = [(a['sec_per_point'], a['count'])
-                            for a in header_info['archive_list']]
-            agg_name = Agg.get_agg_name(header_info['agg_id'])
-
-            if len(tag) <= len(tag_list[pos_idx]) + reserved_size:
-                diff = len(tag_list[pos_idx]) + reserved_size - len(tag)
-                tag_list[pos_idx] = tag
-                inter_tag_list = tag_list + ['N' * diff]
-                packed_header, _ = Storage.pack_header(
-                    inter_tag_list, archive_list, header_info['x_files_factor'], agg_name)
-                fh.write(packed_header)
-            else:
-                tag_list[pos_idx] = tag
-                inter_tag_list = tag_list + ['']
-                packed_header, _ = Storage.pack_header(
-                    inter_tag_list, archive_list, header_info['x_files_factor'], agg_name)
-                tmpfile = path + '.tmp'
-                with open(tmpfile, 'wb') as fh_tmp:
-                    fh_tmp.write(packed_header)
-                    fh.seek(header_info['archive_list'][0]['offset'])
-                    while True:
-                        bytes = fh.read(CHUNK_SIZE)
-                        if not bytes:
-                            break
-                        fh_tmp.write(bytes)
-                os.rename(tmpfile, path)
-
-    def update(self, path, points, now=None, mtime=None):
-        # order points by timestamp, newest first
-        points.sort(key=operator.itemgetter(0), reverse=True)
-        mtime = mtime or int(os.stat(path).st_mtime)
-        with open(path, 'r+b') as f:
-            header = self.header(f)
+            tag_list = list(header_info['tag_list'])
+            tag_list[pos_idx] = tag
+            self._write_tags(path, fh, header_info, tag_list)
+        if header_info['cold_path']:
+            self.add_tag(tag, header_info['cold_path'], pos_idx)
+
+    def set_tags(self, path, tag_list):
+        """
+        Replace the tags of the file at `path` (e.g. emptying the tags of
+        deleted metrics), the number of tags can not change.
+        """
+        with open(path, 'r+b') as fh:
+            header_info = Storage.header(fh)
+            if len(tag_list) != len(header_info['tag_list']):
+                raise KenshinException("%d tags for a file of %d tags" % (
+                    len(tag_list), len(header_info['tag_list'])))
+            self._write_tags(path, fh, header_info, list(tag_list))
+        if header_info['cold_path']:
+            self.set_tags(header_info['cold_path'], tag_list)
+
+    def set_cold_path(self, path, cold_path):
+        """
+        Point a tiered file to its companion file moved to `cold_path`, e.g.
+        after rebuilding the pair under temporary names. The new path can
+        not be longer than the one the file was created with.
+        """
+        with open(path, 'r+b') as fh:
+            header_info = Storage.header(fh)
+            if not header_info['flags'] & FLAG_TIERED:
+                raise KenshinException("not a tiered file: %s" % path)
+            cold_path = os.path.abspath(cold_path)
+            path_size = header_info['cold_path_size']
+            if len(cold_path) > path_size:
+                raise KenshinException("cold path longer than %d bytes: %s" %
+                                       (path_size, cold_path))
+            pwritev(fh.fileno(), [self.pack_cold_path(cold_path, path_size)],
+                    header_info['cold_path_offset'])
+        self._invalidate(path)
+
+    def _write_tags(self, path, fh, header_info, tag_list):
+        """
+        Write the new `tag_list` of a file, in place: in the Tag region of
+        the header if it fits, in the tag table after the data otherwise.
+        Only a file whose Tag region can not even hold the header of the
+        tag table format is rewritten through a temporary file.
+        """
+        flags = header_info['flags']
+        reserved_size = header_info['reserved_size']
+        archive_list = [(a['sec_per_point'], a['count'])
+                        for a in header_info['archive_list']]
+        base_ts_list = [a['base_ts'] for a in header_info['archive_list']]
+        agg_name = Agg.get_agg_name(header_info['agg_id'])
+        fd = fh.fileno()
+
+        if flags & FLAG_TAG_OVERFLOW:
+            tag_table = self.pack_tag_table(tag_list)
+            pwritev(fd, [tag_table], header_info['data_end'])
+            fh.truncate(header_info['data_end'] + len(tag_table))
+            self._invalidate(path)
+            return
+
+        tag_region_size = len('\t'.join(header_info['tag_list'] +
+                                        ['N' * reserved_size]))
+        tags_size = len('\t'.join(tag_list + ['']))
+        # the tag table format needs a prefix and the base timestamps
+        extra_size = 0
+        if header_info['version'] < 2:
+            extra_size += PREFIX_SIZE
+        if not flags & FLAG_BASE_TS:
+            extra_size += ((BASE_ARCHIVEINFO_SIZE - ARCHIVEINFO_SIZE) *
+                           len(archive_list))
+
+        if tags_size <= tag_region_size:
+            inter_tag_list = tag_list + ['N' * (tag_region_size - tags_size)]
+            packed_header, _ = Storage.pack_header(
+                inter_tag_list, archive_list, header_info['x_files_factor'],
+                agg_name, flags, base_ts_list, header_info['cold_path'],
+                header_info['cold_path_size'])
+            pwritev(fd, [packed_header], 0)
+        elif extra_size <= tag_region_size:
+            if not flags & FLAG_BASE_TS:
+                base_ts_list = [self._read_base_ts(fd, header_info, a)
+                                for a in header_info['archive_list']]
+            inter_tag_list = tag_list + ['N' * (tag_region_size - extra_size)]
+            packed_header, _ = Storage.pack_header(
+                inter_tag_list, archive_list, header_info['x_files_factor'],
+                agg_name, flags | FLAG_TAG_OVERFLOW | FLAG_BASE_TS,
+                base_ts_list, header_info['cold_path'],
+                header_info['cold_path_size'])
+            # the tags first, the header then points to them
+            tag_table = self.pack_tag_table(tag_list)
+            pwritev(fd, [tag_table], header_info['data_end'])
+            fh.truncate(header_info['data_end'] + len(tag_table))
+            pwritev(fd, [packed_header], 0)
+        else:
+            inter_tag_list = tag_list + ['']
+            packed_header, _ = Storage.pack_header(
+                inter_tag_list, archive_list, header_info['x_files_factor'],
+                agg_name, flags, base_ts_list, header_info['cold_path'])
+            tmpfile = path + '.tmp'
+            with open(tmpfile, 'wb') as fh_tmp:
+                fh_tmp.write(packed_header)
+                # copy the block index (if any) and the data
+                fh.seek(header_info['header_size'])
+                while True:
+                    bytes = fh.read(CHUNK_SIZE)
+                    if not bytes:
+                        break
+                    fh_tmp.write(bytes)
+            os.rename(tmpfile, path)
+        self._invalidate(path)
+
+    def _invalidate(self, path):
+        self.header_cache.invalidate(path)
+        self.file_pool.invalidate_path(path)
+        self.block_cache.bump(path)
+
+    def _cached_header(self, path, fh, st=None):
+        st = st or os.fstat(fh.fileno())
+        return self.header_cache.get_header(path, fh, st, self.header)
+
+    @staticmethod
+    def _header_copy(header):
+        """
+        Copy of a cached header (its lists too) for the callers of the
+        fetch functions, so that they can not alter the cached one.
+        """
+        return dict(header, tag_list=list(header['tag_list']),
+                    archive_list=[dict(a) for a in header['archive_list']])
+
+    @contextmanager
+    def _open(self, path, mode):
+        """
+        Open `path`, yield the file object and its stat result.
+
+        If the file pool is enabled, the file object is taken from (and then
+        given back to) the pool, pooled files are unbuffered so that they
+        never serve stale data written by others.
+
+        A file opened for writing is synced (or recorded for the next group
+        commit) afterwards, according to the sync policy.
+        """
+        if self.file_pool.max_size <= 0:
+            with open(path, mode) as fh:
+                yield fh, os.fstat(fh.fileno())
+                if mode != 'rb':
+                    self._written(path, fh)
+            return
+
+        st = os.stat(path)
+        fh = self.file_pool.acquire(path, mode, st.st_ino)
+        if fh is None:
+            fh = open(path, mode, 0)
+        try:
+            yield fh, st
+            if mode != 'rb':
+                self._written(path, fh)
+        except:
+            fh.close()
+            raise
+        self.file_pool.release(path, mode, fh, st.st_ino)
+
+    def set_sync_policy(self, policy):
+        """
+        Set when the writes of `update`, `propagate` and `backfill` are
+        flushed to the disk:
+
+          none      - never, the kernel writes the dirty pages back in its
+                      own time, a machine crash may lose the recent writes.
+          fdatasync - every file written before the call returns.
+          group     - at the next `commit`, which flushes every file written
+                      since the previous one in a single batch.
+        """
+        if policy not in SYNC_POLICIES:
+            raise InvalidConfig("unknown sync policy '%s', must be one of %s"
+                                % (policy, ', '.join(SYNC_POLICIES)))
+        self.sync_policy = policy
+
+    def _written(self, path, fh):
+        if self.sync_policy == SYNC_FDATASYNC:
+            fh.flush()
+            start = time.time()
+            fileio.fdatasync(fh.fileno())
+            self._add_sync_time(time.time() - start)
+        elif self.sync_policy == SYNC_GROUP:
+            fh.flush()
+            with self.sync_lock:
+                self.dirty_paths.add(path)
+
+    def _add_sync_time(self, sync_time):
+        with self.sync_lock:
+            self.sync_times.append(sync_time)
+
+    def pop_sync_times(self):
+        """
+        Return (and forget) the latencies of the syncs since the last call,
+        one per file with the fdatasync policy, one per `commit` with the
+        group policy.
+        """
+        with self.sync_lock:
+            sync_times, self.sync_times = self.sync_times, []
+        return sync_times
+
+    def commit(self):
+        """
+        Flush every file written since the last commit to the disk (group
+        commit policy), return the number of files synced.
+
+        The writeback of all the files is started first (see
+        `fileio.start_writeback`) so that the disk sees their pages
+        together, then every file is fdatasync'ed, which mostly waits for
+        writes already in flight. Files that failed to sync are kept for the
+        next commit.
+        """
+        with self.sync_lock:
+            paths, self.dirty_paths = self.dirty_paths, set()
+        if not paths:
+            return 0
+
+        start = time.time()
+        synced = 0
+        try:
+            for path in paths:
+                self._sync_path(path, fileio.start_writeback)
+            for path in list(paths):
+                if self._sync_path(path, fileio.fdatasync):
+                    synced += 1
+                paths.discard(path)
+        except:
+            with self.sync_lock:
+                self.dirty_paths.update(paths)
+            raise
+        self._add_sync_time(time.time() - start)
+        return synced
+
+    @staticmethod
+    def _sync_path(path, sync_func):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            # removed since written
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        try:
+            sync_func(fd)
+        finally:
+            os.close(fd)
+        return True
+
+    def update(self, path, points, now=None, mtime=None, propagate=True,
+               history=None):
+        """
+        Write `points` to the archives they fit in, `points` is either a
+        list of (timestamp, values) or a pair of arrays (timestamps, values)
+        with values of shape (points, metrics). Of the points falling in
+        the same slot, the last one given wins.
+
+        With `propagate` disabled, the points written to the highest
+        precision archive are not propagated to the lower archives, that is
+        left to a later `propagate` call. Return the time range to
+        propagate from the highest precision archive (None if no point was
+        written there).
+
+        The points older than the archives of a tiered file are written to
+        its companion file.
+
+        `history` (same forms as `points`) holds the points written to the
+        highest precision archive by the previous updates, one per
+        timestamp in the order they were written, e.g. kept by the caller
+        since it flushed them. The rollups of this update are computed from
+        them (and `points`) when they cover the whole rollup window, instead
+        of reading the archive back, see `_history_window`.
+        """
+        point_ts, point_vals = self._point_arrays(points)
+        dirty_range = None
+        with self._open(path, 'r+b') as (f, st):
+            mtime = mtime or int(st.st_mtime)
+            header = self._cached_header(path, f, st)
+            if not header['flags'] & FLAG_BASE_TS:
+                header = self._migrate_header(path, f, header)
             if now is None:
                 now = int(time.time())
             archive_list = header['archive_list']
-            i = 0
-            curr_archive = archive_list[i]
-            curr_points = []
-
-            for point in points:
-                age = now - point[0]
-
-                while age > curr_archive['retention']:
-                    # we can't fit any more points in archive i
-                    if curr_points:
-                        timestamp_range = (min(mtime, curr_points[-1][0]),
-                                           curr_points[0][0])
-                        self._update_archive(f, header, curr_archive,
-                                             curr_points, i, timestamp_range)
-                        curr_points = []
-                    try:
-                        curr_archive = archive_list[i+1]
-                        i += 1
-                    except IndexError:
-                        curr_archive = None
-                        break
 
-                if not curr_archive:
-                    # drop remaining points that don't fit in the database
-                    break
+            # every point goes to the first archive whose retention covers
+            # its age, points older than the last one's are dropped (or go
+            # to the companion file)
+            retentions = [a['retention'] for a in archive_list]
+            point_archive = np.searchsorted(retentions, now - point_ts)
+            for i, archive in enumerate(archive_list):
+                in_archive = point_archive == i
+                if not in_archive.any():
+                    continue
+                archive_ts = point_ts[in_archive]
+                timestamp_range = (min(mtime, int(archive_ts.min())),
+                                   int(archive_ts.max()))
+                rs = self._update_archive(f, header, archive, archive_ts,
+                                          point_vals[in_archive], i,
+                                          timestamp_range, propagate,
+                                          history if i == 0 else None)
+                if i == 0:
+                    dirty_range = rs
+            if header['cold_path']:
+                cold = point_archive == len(archive_list)
+                if cold.any():
+                    self.update(header['cold_path'],
+                                (point_ts[cold], point_vals[cold]), now, mtime)
+
+            # data writes only change the mtime (the base timestamps set
+            # by the first writes are updated in the cached header too),
+            # keep the header valid
+            self.header_cache.restamp(path, HeaderCache.file_stamp(st),
+                                      HeaderCache.file_stamp(os.fstat(f.fileno())))
+            self.block_cache.bump(path)
+        return dirty_range
 
-                curr_points.append(point)
+    @staticmethod
+    def _point_arrays(points):
+        """
+        (timestamps, values) arrays of the `points` given to `update`.
+        """
+        if isinstance(points, tuple) and isinstance(points[0], np.ndarray):
+            point_ts, point_vals = points
+        else:
+            point_ts = [p[0] for p in points]
+            point_vals = [p[1] for p in points]
+        point_ts = np.asarray(point_ts, dtype=np.int64)
+        point_vals = np.asarray(point_vals, dtype=np.float64)
+        if not len(point_ts):
+            return point_ts, point_vals.reshape(0, 0)
+        return point_ts, point_vals.reshape(len(point_ts), -1)
+
+    def _migrate_header(self, path, fh, header):
+        """
+        Add the base timestamps (FLAG_BASE_TS) to the header of an older
+        file, in place: the larger header takes the room from the reserved
+        tag space, so the data does not move. Return the new header, or
+        `header` if there is not enough reserved space, such a file keeps
+        reading the base timestamps from the data.
+        """
+        archive_list = header['archive_list']
+        extra_size = (BASE_ARCHIVEINFO_SIZE - ARCHIVEINFO_SIZE) * len(archive_list)
+        if header['version'] < 2:
+            extra_size += PREFIX_SIZE
+        if header['reserved_size'] < extra_size:
+            return header
+
+        fd = fh.fileno()
+        base_ts_list = [self._read_base_ts(fd, header, a) for a in archive_list]
+        inter_tag_list = header['tag_list'] + [
+            'N' * (header['reserved_size'] - extra_size)]
+        packed_header, _ = self.pack_header(
+            inter_tag_list,
+            [(a['sec_per_point'], a['count']) for a in archive_list],
+            header['x_files_factor'], Agg.get_agg_name(header['agg_id']),
+            header['flags'] | FLAG_BASE_TS, base_ts_list, header['cold_path'],
+            header['cold_path_size'])
+        new_header = self.header(StringIO(packed_header))
+        if new_header['header_size'] != header['header_size']:
+            return header
+        pwritev(fd, [packed_header], 0)
+        self.header_cache.invalidate(path)
+        return new_header
+
+    def propagate(self, path, timestamp_range, history=None):
+        """
+        Propagate `timestamp_range` of the highest precision archive to the
+        lower archives, e.g. the ranges returned by `update` called with
+        `propagate` disabled, `history` is as in `update`.
 
-            if curr_archive and curr_points:
-                timestamp_range = (min(mtime, curr_points[-1][0]),
-                                   curr_points[0][0])
-                self._update_archive(f, header, curr_archive, curr_points, i,
-                                     timestamp_range)
+        Return False if the range does not complete any lower point yet,
+        or is empty.
+        """
+        if timestamp_range[0] >= timestamp_range[1]:
+            return False
+        with self._open(path, 'r+b') as (f, st):
+            header = self._cached_header(path, f, st)
+            archive_list = header['archive_list']
+            if len(archive_list) < 2 and not header['cold_path']:
+                return False
+            higher = archive_list[0]
+            base_ts = self._read_base_ts(f.fileno(), header, higher)
+            if base_ts == 0:
+                return False
+            higher_series = None
+            if history is not None:
+                higher_series = self._history_series(
+                    header, higher, self._point_arrays(history))
+            if len(archive_list) < 2:
+                return self._propagate_cold(f, header, higher, timestamp_range,
+                                            base_ts, higher_series)
+            rs = self._propagate(f, header, higher, archive_list[1],
+                                 timestamp_range, 1, base_ts,
+                                 higher_series=higher_series)
+            self.header_cache.restamp(path, HeaderCache.file_stamp(st),
+                                      HeaderCache.file_stamp(os.fstat(f.fileno())))
+            self.block_cache.bump(path)
+            return rs
+
+    def backfill(self, path, archive_points, fill_lower=False):
+        """
+        Write whole histories straight into the archives of a file, e.g.
+        when migrating data. `archive_points` holds one
+        (timestamps, values) pair per archive, highest precision first,
+        `values` of shape (points, metrics) with NULL_VALUE for nulls, or
+        None to leave an archive alone.
+
+        Points are aligned to the precision of their archive, the points
+        falling in the same slot are aggregated like propagation does. The
+        points are merged with the ones in the archive: a point does not
+        replace a newer one in its slot, and only the newest retention of
+        points, backfilled or not, is kept. Every archive is
+        rewritten in one sequential write (one per block if compressed),
+        nothing is propagated. With `fill_lower`, an archive given as None
+        is computed from the one above it (if that one was written),
+        aggregating its whole ring at once.
+
+        The archives of a tiered file are followed by the archives of its
+        companion file in `archive_points`.
+        """
+        with self._open(path, 'r+b') as (f, st):
+            header = self._cached_header(path, f, st)
+            if not header['flags'] & FLAG_BASE_TS:
+                header = self._migrate_header(path, f, header)
+            archive_list = header['archive_list']
+            cold_points = archive_points[len(archive_list):]
+            if cold_points and not header['cold_path']:
+                raise KenshinException(
+                    "%d archives of points for a file of %d archives" %
+                    (len(archive_points), len(archive_list)))
+            archive_points = (list(archive_points) +
+                              [None] * (len(archive_list) - len(archive_points)))
+
+            fd = f.fileno()
+            ring = None
+            for archive, points in zip(archive_list, archive_points):
+                if points is None and fill_lower and ring is not None:
+                    points = ring
+                ring = None
+                if points is not None:
+                    ring = self._backfill_archive(fd, header, archive, *points)
+
+            self.header_cache.restamp(path, HeaderCache.file_stamp(st),
+                                      HeaderCache.file_stamp(os.fstat(f.fileno())))
+            self.block_cache.bump(path)
+
+        if header['cold_path']:
+            cold_points = list(cold_points) or [None]
+            if cold_points[0] is None and fill_lower:
+                cold_points[0] = ring
+            if any(points is not None for points in cold_points):
+                self.backfill(header['cold_path'], cold_points, fill_lower)
+
+    def _backfill_archive(self, fd, header, archive, point_ts, point_vals):
+        """
+        Merge the points into the ring of `archive` and write it back,
+        return the (timestamps, values) of the whole ring, or None if there
+        was no point to write.
+        """
+        tag_cnt = len(header['tag_list'])
+        point_ts = np.asarray(point_ts, dtype=np.int64)
+        point_vals = np.asarray(point_vals, dtype=np.float64).reshape(
+            len(point_ts), tag_cnt)
+        written = point_ts > 0
+        point_ts, point_vals = self._aggregate_points(
+            header, point_ts[written], point_vals[written],
+            archive['sec_per_point'])
+        if not len(point_ts):
+            return None
+
+        count = archive['count']
+        base_ts = self._read_base_ts(fd, header, archive)
+        if base_ts == 0:
+            ring_ts = np.zeros(count, dtype=np.int64)
+            ring_vals = np.zeros((count, tag_cnt))
+        else:
+            ring_ts, ring_vals = self._read_slots(fd, header, archive, 0, count)
+        # the retention is counted from the newest point, backfilled or not
+        newest_ts = max(point_ts[-1], ring_ts.max())
+        written = point_ts > newest_ts - archive['retention']
+        point_ts, point_vals = point_ts[written], point_vals[written]
+        if not len(point_ts):
+            return None
+        if base_ts == 0:
+            base_ts = int(point_ts[0])
+            if header['flags'] & FLAG_BASE_TS:
+                self._write_base_ts(fd, archive, base_ts)
+
+        # a point does not replace a newer one in its slot
+        slots = (point_ts - base_ts) // archive['sec_per_point'] % count
+        written = point_ts >= ring_ts[slots]
+        ring_ts[slots[written]] = point_ts[written]
+        ring_vals[slots[written]] = point_vals[written]
+
+        if archive['compressed']:
+            blocks = self._encode_blocks(header, archive, ring_ts, ring_vals)
+            segments = [(self._block_offset(header, archive, block_id), data)
+                        for block_id, data in enumerate(blocks) if data]
+            segments.append((archive['block_index_offset'],
+                             np.array([len(data) for data in blocks],
+                                      dtype='>u4').tostring()))
+        else:
+            segments = [(archive['offset'],
+                         self.pack_archive(header, archive, ring_ts,
+                                           ring_vals)[0])]
+        self._write_segments(fd, segments)
+        return ring_ts, ring_vals
 
-    def _update_archive(self, fh, header, archive, points, archive_idx, timestamp_range):
-        step = archive['sec_per_point']
-        aligned_points = sorted((p[0] - (p[0] % step), p[1])
-                                for p in points if p)
-        if not aligned_points:
-            return
+    @staticmethod
+    def _aggregate_points(header, point_ts, point_vals, step):
+        """
+        Align points to `step` and aggregate the points of every aligned
+        timestamp with the file's aggregation method, null values are
+        ignored (the result is null if all of them are).
 
-        # create a packed string for each contiguous sequence of points
-        point_format = header['point_format']
-        packed_strings = []
-        curr_strings = []
-        previous_ts = None
-        len_aligned_points = len(aligned_points)
-        for i in xrange(0, len_aligned_points):
-            # take last val of duplicates
-            if (i+1 < len_aligned_points and
-                aligned_points[i][0] == aligned_points[i+1][0]):
-                continue
-            (ts, val) = aligned_points[i]
-            packed_str = struct.pack(point_format, ts, *val)
-            if (not previous_ts) or (ts == previous_ts + step):
-                curr_strings.append(packed_str)
-            else:
-                start_ts = previous_ts - (step * (len(curr_strings) - 1))
-                packed_strings.append((start_ts, ''.join(curr_strings)))
-                curr_strings = [packed_str]
-            previous_ts = ts
+        Return the aligned timestamps (sorted, unique) and their values.
+        """
+        order = np.argsort(point_ts, kind='mergesort')
+        point_ts, point_vals = point_ts[order], point_vals[order]
+        aligned_ts = point_ts - point_ts % step
+        uniq_ts, first_idx, group_idx = np.unique(
+            aligned_ts, return_index=True, return_inverse=True)
+        if len(uniq_ts) == len(aligned_ts):
+            return uniq_ts, point_vals
+
+        # view the points as (aligned point, point, tag) arrays
+        pos = np.arange(len(aligned_ts)) - first_idx[group_idx]
+        group_vals = np.zeros((len(uniq_ts), pos.max() + 1,
+                               point_vals.shape[1]))
+        group_vals[group_idx, pos] = point_vals
+        present = np.zeros(group_vals.shape[:2], dtype=bool)
+        present[group_idx, pos] = True
+        valid = present[:, :, np.newaxis] & (group_vals != NULL_VALUE)
+        agg_func = Agg.get_np_agg_func(header['agg_id'])
+        agg_vals = agg_func(group_vals, valid, 1)
+        return uniq_ts, np.where(valid.any(1), agg_vals, NULL_VALUE)
+
+    def _update_archive(self, fh, header, archive, point_ts, point_vals,
+                        archive_idx, timestamp_range, propagate=True,
+                        history=None):
+        if not len(point_ts):
+            return None
+        step = archive['sec_per_point']
+        aligned_ts = point_ts - point_ts % step
 
-        if curr_strings:
-            start_ts = previous_ts - (step * (len(curr_strings) - 1))
-            packed_strings.append((start_ts, ''.join(curr_strings)))
+        # order the points by timestamp, a stable sort keeps the points
+        # given later after the others, and the last one of duplicates wins
+        order = np.argsort(aligned_ts, kind='mergesort')
+        aligned_ts, point_vals = aligned_ts[order], point_vals[order]
+        last = np.ones(len(aligned_ts), dtype=bool)
+        last[:-1] = aligned_ts[1:] != aligned_ts[:-1]
+        point_ts, point_vals = aligned_ts[last], point_vals[last]
 
         # read base point and determine where our writes will start
-        base_point = self._read_base_point(fh, archive, header)
-        base_ts = base_point[0]
-
-        first_ts = aligned_points[0][0]
+        fd = fh.fileno()
+        base_ts = self._read_base_ts(fd, header, archive)
         if base_ts == 0:
             # this file's first update, so set it to first timestamp
-            base_ts = first_ts
-
-        # write all of our packed strings in locations
-        # determined by base_ts
-        archive_end = archive['offset'] + archive['size']
-        for (ts, packed_str) in packed_strings:
-            offset = self._timestamp2offset(ts, base_ts, header, archive)
-            bytes_beyond = (offset + len(packed_str)) - archive_end
-            fh.seek(offset)
-            if bytes_beyond > 0:
-                fh.write(packed_str[:-bytes_beyond])
-                fh.seek(archive['offset'])
-                fh.write(packed_str[-bytes_beyond:])
-            else:
-                fh.write(packed_str)
-
-        # now we propagate the updates to lower-precision archives
+            base_ts = int(point_ts[0])
+            if header['flags'] & FLAG_BASE_TS:
+                self._write_base_ts(fd, archive, base_ts)
+
+        # pack every point at its location in the ring, determined by
+        # base_ts
+        if archive['compressed']:
+            segments = self._pack_blocks(fd, header, archive, base_ts,
+                                         point_ts, point_vals)
+        else:
+            segments = self._pack_points(header, archive, base_ts, point_ts,
+                                         point_vals)
+        self._write_segments(fd, segments)
+
+        # update timestamp_range
+        time_start, time_end = timestamp_range
+        time_end = max(time_end, int(point_ts[-1]))
+        time_start = min(time_start, int(point_ts[0]))
+        timestamp_range = (time_start, time_end)
+
+        # now we propagate the updates to lower-precision archives,
+        # only updates of the highest precision archive may be deferred.
         archive_list = header['archive_list']
         next_archive_idx = archive_idx + 1
-        if next_archive_idx < len(archive_list):
-            # update timestamp_range
-            time_start, time_end = timestamp_range
-            time_end = max(time_end, aligned_points[-1][0])
-            time_start = min(time_start, aligned_points[0][0])
-            timestamp_range = (time_start, time_end)
-            self._propagate(fh, header, archive, archive_list[next_archive_idx],
-                            timestamp_range, next_archive_idx)
-
-    def _read_base_point(self, fh, archive, header):
-        fh.seek(archive['offset'])
-        base_point = fh.read(header['point_size'])
-        return struct.unpack(header['point_format'], base_point)
-
-    def _timestamp2offset(self, ts, base_ts, header, archive):
-        time_distance = ts - base_ts
-        point_distince = time_distance / archive['sec_per_point']
-        byte_distince =  point_distince * header['point_size']
-        return archive['offset'] + (byte_distince % archive['size'])
+        if propagate or archive_idx > 0:
+            higher_series = None
+            if history is not None:
+                # the points just written are the newest of the history
+                higher_series = self._history_series(
+                    header, archive, self._point_arrays(history),
+                    (point_ts, point_vals))
+            if next_archive_idx < len(archive_list):
+                self._propagate(fh, header, archive,
+                                archive_list[next_archive_idx],
+                                timestamp_range, next_archive_idx, base_ts,
+                                higher_series=higher_series)
+            elif header['cold_path']:
+                self._propagate_cold(fh, header, archive, timestamp_range,
+                                     base_ts, higher_series)
+        return timestamp_range
+
+    def _pack_points(self, header, archive, base_ts, point_ts, point_vals):
+        """
+        Pack the points (in time order, no duplicates) at their locations
+        in the ring, return the (offset, data) segments to write, one per
+        run of contiguous slots (and per column in a columnar file).
+        """
+        slots = (point_ts - base_ts) // archive['sec_per_point'] % archive['count']
+        # runs are broken by the ring's wrap-around (or missing points)
+        breaks = np.flatnonzero(np.diff(slots) != 1) + 1
+        runs = zip([0] + breaks.tolist(), breaks.tolist() + [len(slots)])
+        run_slots = slots[[start for start, _ in runs]].tolist()
+
+        if not header['flags'] & FLAG_COLUMNAR:
+            points = np.empty(len(point_ts), dtype=self.point_dtype(header))
+            points['ts'] = point_ts
+            points['val'] = point_vals
+            return self._run_segments(points, runs, run_slots,
+                                      archive['offset'], header['point_size'])
+
+        # column by column, each run of a column is one segment
+        segments = self._run_segments(point_ts.astype('>u4'), runs, run_slots,
+                                      archive['offset'], LONG_SIZE)
+        point_vals = point_vals.astype(self.value_dtype(header))
+        for col in xrange(len(header['tag_list'])):
+            segments.extend(self._run_segments(
+                point_vals[:, col], runs, run_slots,
+                self._column_offset(header, archive, col),
+                header['value_size']))
+        return segments
+
+    @staticmethod
+    def _run_segments(items, runs, run_slots, offset, item_size):
+        data = np.ascontiguousarray(items).tostring()
+        return [(offset + slot * item_size,
+                 data[start * item_size: end * item_size])
+                for (start, end), slot in zip(runs, run_slots)]
+
+    def _pack_blocks(self, fd, header, archive, base_ts, point_ts, point_vals):
+        """
+        Apply the points (in time order, no duplicates) to the blocks of a
+        compressed archive, return the (offset, data) segments rewriting
+        the whole blocks and their block index entries.
+        """
+        block_points = header['block_points']
+        slots = (point_ts - base_ts) // archive['sec_per_point'] % archive['count']
+        block_ids = np.unique(slots // block_points)
+        block_ts, block_vals = self._read_blocks(fd, header, archive,
+                                                 block_ids)
+        pos = self._block_slot_pos(block_ids, block_points, slots)
+        block_ts.reshape(-1)[pos] = point_ts
+        block_vals.reshape(block_ts.size, block_vals.shape[2])[pos] = point_vals
+
+        segments = []
+        index_segments = []
+        for i, block_id in enumerate(block_ids):
+            cnt = self._block_size(archive, block_points, block_id)
+            data = codec.encode_block(block_ts[i, :cnt], block_vals[i, :cnt],
+                                      self.value_dtype(header))
+            segments.append((self._block_offset(header, archive, block_id),
+                             data))
+            index_segments.append(
+                (archive['block_index_offset'] + BLOCKINFO_SIZE * block_id,
+                 struct.pack(BLOCKINFO_FORMAT, len(data))))
+        return segments + index_segments
+
+    @staticmethod
+    def _block_size(archive, block_points, block_id):
+        """
+        Number of slots of a block, the last block of the ring may be short.
+        """
+        return min(block_points, archive['count'] - block_id * block_points)
+
+    @staticmethod
+    def _block_offset(header, archive, block_id):
+        return (archive['offset'] +
+                block_id * header['block_points'] * header['point_size'])
+
+    @staticmethod
+    def _block_slot_pos(block_ids, block_points, slots):
+        """
+        Position of ring `slots` in the flattened blocks `block_ids` (sorted).
+        """
+        return (np.searchsorted(block_ids, slots // block_points) * block_points
+                + slots % block_points)
+
+    def _read_block_index(self, fd, archive):
+        data = pread(fd, BLOCKINFO_SIZE * archive['block_cnt'],
+                     archive['block_index_offset'])
+        return np.frombuffer(data, dtype='>u4')
+
+    def _read_blocks(self, fd, header, archive, block_ids, cols=None):
+        """
+        Read and decode the blocks `block_ids` of a compressed archive, only
+        the value columns listed in `cols` (all by default) are kept.
+
+        Return (timestamps, values) arrays of shape (blocks, block_points)
+        and (blocks, block_points, columns), never written blocks (and the
+        missing tail of a short last block) are zeros.
+        """
+        block_points = header['block_points']
+        tag_cnt = len(header['tag_list'])
+        col_cnt = tag_cnt if cols is None else len(cols)
+        block_lengths = self._read_block_index(fd, archive)
+        block_ts = np.zeros((len(block_ids), block_points), dtype=np.int64)
+        block_vals = np.zeros((len(block_ids), block_points, col_cnt))
+        for i, block_id in enumerate(block_ids):
+            length = int(block_lengths[block_id])
+            if not length:
+                continue
+            cnt = self._block_size(archive, block_points, block_id)
+            data = pread(fd, length, self._block_offset(header, archive,
+                                                        block_id))
+            point_ts, point_vals = codec.decode_block(
+                data, cnt, tag_cnt, self.value_dtype(header))
+            block_ts[i, :cnt] = point_ts
+            block_vals[i, :cnt] = (point_vals if cols is None
+                                   else point_vals[:, cols])
+        return block_ts, block_vals
+
+    def _read_block_slots(self, fd, header, archive, slots, cols=None):
+        """
+        Read ring `slots` of a compressed archive, decoding only the blocks
+        they fall in. Return (timestamps, values) like `_read_slots`.
+        """
+        block_points = header['block_points']
+        block_ids = np.unique(slots // block_points)
+        block_ts, block_vals = self._read_blocks(fd, header, archive,
+                                                 block_ids, cols)
+        pos = self._block_slot_pos(block_ids, block_points, slots)
+        return (block_ts.reshape(-1)[pos],
+                block_vals.reshape(block_ts.size, block_vals.shape[2])[pos])
+
+    @staticmethod
+    def _column_offset(header, archive, col):
+        """
+        File offset of the values of metric `col` in a columnar archive.
+        """
+        return archive['offset'] + archive['count'] * (
+            LONG_SIZE + col * header['value_size'])
+
+    @staticmethod
+    def _write_segments(fd, segments):
+        """
+        Write (offset, data) segments in the given order, every run of
+        segments that are contiguous in the file (e.g. the points before,
+        or after, the ring's wrap-around) goes out in one vectored write.
+        """
+        run_offset, run_end, run_bufs = None, None, []
+        for offset, data in segments:
+            if offset != run_end:
+                if run_bufs:
+                    pwritev(fd, run_bufs, run_offset)
+                run_offset, run_end, run_bufs = offset, offset, []
+            run_bufs.append(data)
+            run_end += len(data)
+        if run_bufs:
+            pwritev(fd, run_bufs, run_offset)
+
+    def _read_base_ts(self, fd, header, archive):
+        if header['flags'] & FLAG_BASE_TS:
+            return archive['base_ts']
+        if archive['compressed']:
+            point_ts, _ = self._read_block_slots(fd, header, archive,
+                                                 np.zeros(1, dtype=int), [])
+            return int(point_ts[0])
+        packed_base_ts = pread(fd, LONG_SIZE, archive['offset'])
+        return struct.unpack(LONG_FORMAT, packed_base_ts)[0]
+
+    @staticmethod
+    def _write_base_ts(fd, archive, base_ts):
+        """
+        Store the base timestamp of a never written archive in the header,
+        before its first points, and in the (maybe cached) header dict: the
+        file changes exactly as its parsed header does.
+        """
+        pwritev(fd, [struct.pack(LONG_FORMAT, base_ts)],
+                archive['base_ts_offset'])
+        archive['base_ts'] = base_ts
+
+    @staticmethod
+    def _ring_extents(offset, item_size, count, first_idx, cnt):
+        """
+        The (offset, size) file extents of `cnt` items of the ring of `count`
+        items of `item_size` bytes at `offset`, starting from item
+        `first_idx` and wrapping around the ring end.
+        """
+        tail_cnt = min(cnt, count - first_idx)
+        extents = [(offset + first_idx * item_size, tail_cnt * item_size)]
+        if tail_cnt < cnt:
+            extents.append((offset, (cnt - tail_cnt) * item_size))
+        return extents
+
+    @staticmethod
+    def _read_ring(fd, offset, item_size, count, first_idx, cnt):
+        """
+        Read `cnt` items from the ring (see `_ring_extents`).
+        """
+        return ''.join(pread(fd, size, extent_offset) for extent_offset, size
+                       in Storage._ring_extents(offset, item_size, count,
+                                                first_idx, cnt))
+
+    def _read_slots(self, fd, header, archive, first_idx, cnt):
+        """
+        Read `cnt` ring slots of `archive` starting from slot `first_idx`.
+
+        Return (timestamps, values) as an int64 array and a float64 array
+        of shape (cnt, metrics).
+        """
+        count = archive['count']
+        if archive['compressed']:
+            slots = (first_idx + np.arange(cnt)) % count
+            return self._read_block_slots(fd, header, archive, slots)
+        if not header['flags'] & FLAG_COLUMNAR:
+            data = self._read_ring(fd, archive['offset'], header['point_size'],
+                                   count, first_idx, cnt)
+            points = np.frombuffer(data, dtype=self.point_dtype(header))
+            return (points['ts'].astype(np.int64),
+                    points['val'].astype(np.float64))
+
+        data = self._read_ring(fd, archive['offset'], LONG_SIZE, count,
+                               first_idx, cnt)
+        point_ts = np.frombuffer(data, dtype='>u4').astype(np.int64)
+        point_vals = np.empty((cnt, len(header['tag_list'])))
+        for col in xrange(point_vals.shape[1]):
+            data = self._read_ring(fd, self._column_offset(header, archive, col),
+                                   header['value_size'], count, first_idx, cnt)
+            point_vals[:, col] = np.frombuffer(data,
+                                               dtype=self.value_dtype(header))
+        return point_ts, point_vals
+
+    def _timestamp2index(self, ts, base_ts, archive):
+        point_distince = (ts - base_ts) / archive['sec_per_point']
+        return point_distince % archive['count']
 
     @staticmethod
     def get_propagate_timeunit(low_sec_per_point, high_sec_per_point, xff):
         num_point = low_sec_per_point / high_sec_per_point
         return int(math.ceil(num_point * xff)) * high_sec_per_point
 
-    def _propagate(self, fh, header, higher, lower, timestamp_range, lower_idx):
+    def _propagate(self, fh, header, higher, lower, timestamp_range, lower_idx,
+                   higher_base_ts, lower_fh=None, lower_header=None,
+                   higher_series=None):
         """
         propagte update to low precision archives.
+
+        `lower` belongs to the file `lower_fh` of header `lower_header`
+        if given, i.e. the companion file of a tiered file.
+
+        `higher_series` are the points last written to `higher` (see
+        `_history_series`), the window of the lower points is taken from
+        them when they cover it, and read from `higher` otherwise.
         """
         from_time, until_time = timestamp_range
         timeunit = Storage.get_propagate_timeunit(lower['sec_per_point'],
@@ -526,175 +1553,817 @@ class Storage(object):
         else:
             lower_interval_end = roundup(until_time, lower['sec_per_point'])
             lower_interval_start = from_time - from_time % lower['sec_per_point']
+        if lower_interval_start >= lower_interval_end:
+            # no lower point, not the whole ring
+            return False
 
-        fh.seek(higher['offset'])
-        packed_base_interval = fh.read(LONG_SIZE)
-        higher_base_interval = struct.unpack(LONG_FORMAT, packed_base_interval)[0]
-
-        if higher_base_interval == 0:
-            higher_first_offset = higher['offset']
-        else:
-            higher_first_offset = self._timestamp2offset(lower_interval_start,
-                                                         higher_base_interval,
-                                                         header,
-                                                         higher)
-
+        higher_first_idx = self._timestamp2index(lower_interval_start,
+                                                 higher_base_ts, higher)
         higher_point_num = (lower_interval_end - lower_interval_start) / higher['sec_per_point']
-        higher_size = higher_point_num * header['point_size']
-        relative_first_offset = higher_first_offset - higher['offset']
-        relative_last_offset = (relative_first_offset + higher_size) % higher['size']
-        higher_last_offset = relative_last_offset + higher['offset']
-
-        # get unpacked series str
-        # TODO: abstract this to a function
-        fh.seek(higher_first_offset)
-        if higher_first_offset < higher_last_offset:
-            series_str = fh.read(higher_last_offset - higher_first_offset)
-        else:
-            higher_end = higher['offset'] + higher['size']
-            series_str = fh.read(higher_end - higher_first_offset)
-            fh.seek(higher['offset'])
-            series_str += fh.read(higher_last_offset - higher['offset'])
-
-        # now we unpack the series data we just read
-        point_format = header['point_format']
-        byte_order, point_type = point_format[0], point_format[1:]
-        point_num = len(series_str) / header['point_size']
-        # assert point_num == higher_point_num
-        series_format = byte_order + (point_type * point_num)
-        unpacked_series = struct.unpack(series_format, series_str)
-
-        # and finally we construct a list of values
-        point_cnt = (lower_interval_end - lower_interval_start) / lower['sec_per_point']
+        # a range of whole rings reads the whole ring
+        higher_cnt = higher_point_num % higher['count'] or higher['count']
+        window = None
+        if higher_series is not None and higher_point_num == higher_cnt:
+            window = self._history_window(higher_series, higher,
+                                          lower_interval_start, higher_cnt)
+        if window is None:
+            window = self._read_slots(fh.fileno(), header, higher,
+                                      higher_first_idx, higher_cnt)
+        series_ts, series_vals = window
+
+        # view the series as (lower point, higher point, tag) arrays, the
+        # newest lower point is aligned with the end of the series, so pad
+        # the oldest, maybe incomplete, lower point with zero timestamps.
         tag_cnt = len(header['tag_list'])
         agg_cnt = lower['sec_per_point'] / higher['sec_per_point']
-        step = (tag_cnt + 1) * agg_cnt
-        lower_points = [None] * point_cnt
-
-        unpacked_series = unpacked_series[::-1]
-        ts = lower_interval_end
-        for i in xrange(0, len(unpacked_series), step):
-            higher_points = unpacked_series[i: i+step]
-            ts -= higher['sec_per_point'] * agg_cnt
-            agg_value = self._get_agg_value(higher_points, tag_cnt, header['agg_id'],
-                                            lower_interval_start, lower_interval_end)
-            lower_points[i/step] = (ts, agg_value)
-
-        lower_points = [x for x in lower_points if x and x[0]]  # filter zero item
+        point_cnt = -(-higher_cnt // agg_cnt)
+        pad_cnt = point_cnt * agg_cnt - higher_cnt
+
+        higher_ts = np.zeros(point_cnt * agg_cnt, dtype=np.int64)
+        higher_ts[pad_cnt:] = series_ts
+        higher_ts = higher_ts.reshape(point_cnt, agg_cnt)
+        higher_vals = np.zeros((point_cnt * agg_cnt, tag_cnt))
+        higher_vals[pad_cnt:] = series_vals
+        higher_vals = higher_vals.reshape(point_cnt, agg_cnt, tag_cnt)
+
+        # and finally we aggregate the valid values of every lower point
+        in_range = ((lower_interval_start <= higher_ts) &
+                    (higher_ts < lower_interval_end))
+        valid = in_range[:, :, np.newaxis] & (higher_vals != NULL_VALUE)
+        agg_func = Agg.get_np_agg_func(header['agg_id'])
+        agg_vals = agg_func(higher_vals, valid, 1)
+        agg_vals = np.where(valid.any(1), agg_vals, NULL_VALUE)
+        lower_ts = (lower_interval_end -
+                    lower['sec_per_point'] * np.arange(point_cnt, 0, -1))
+
+        written = lower_ts != 0  # filter zero item
         timestamp_range = (lower_interval_start, max(lower_interval_end, until_time))
-        self._update_archive(fh, header, lower, lower_points, lower_idx,
+        self._update_archive(lower_fh or fh, lower_header or header, lower,
+                             lower_ts[written], agg_vals[written], lower_idx,
                              timestamp_range)
+        return True
 
-    def _get_agg_value(self, higher_points, tag_cnt, agg_id, ts_start, ts_end):
-        higher_points = higher_points[::-1]
-        agg_func = Agg.get_agg_func(agg_id)
-        step = tag_cnt + 1
-
-        # points format:
-        # t1 v11 v12,
-        # t2 v21 v22,
-        # t3 v31 v32,
-        points = [higher_points[i: i+step]
-                  for i in xrange(0, len(higher_points), step)]
-        valid_points = self.filter_points_by_time(points, ts_start, ts_end)
-        if not valid_points:
-            val = [NULL_VALUE] * tag_cnt
-        else:
-            points = np.array(valid_points)
-            points = points.transpose()
-            val = [agg_func(self.filter_values(x)) for x in points[1:]]
-        return val
+    @classmethod
+    def _history_series(cls, header, archive, *series):
+        """
+        Merge the (timestamps, values) `series` written one after another
+        to `archive` into the points the archive holds at their timestamps:
+        aligned, the last one of every timestamp, sorted, values rounded to
+        the file's value type.
+        """
+        point_ts = np.concatenate([s[0] for s in series])
+        point_vals = np.concatenate([s[1] for s in series
+                                     if s[1].shape[0]] or [series[0][1]])
+        if not len(point_ts):
+            return point_ts, point_vals
+        point_ts = point_ts - point_ts % archive['sec_per_point']
+        # a stable sort keeps the points written later after the others
+        order = np.argsort(point_ts, kind='mergesort')
+        point_ts, point_vals = point_ts[order], point_vals[order]
+        last = np.ones(len(point_ts), dtype=bool)
+        last[:-1] = point_ts[1:] != point_ts[:-1]
+        point_vals = point_vals[last].astype(cls.value_dtype(header))
+        return point_ts[last], point_vals.astype(np.float64)
 
     @staticmethod
-    def filter_points_by_time(points, ts_start, ts_end):
-        return [p for p in points if ts_start <= p[0] < ts_end]
+    def _history_window(series, archive, start, cnt):
+        """
+        The `cnt` points of `archive` from `start` taken from `series` (see
+        `_history_series`), or None unless the series has a point at every
+        one of those timestamps, the slots the points were written to, and
+        none that has since overwritten them (a ring later).
+        """
+        series_ts, series_vals = series
+        step = archive['sec_per_point']
+        first = np.searchsorted(series_ts, start)
+        window_ts = series_ts[first: first+cnt]
+        # the timestamps are unique and sorted, so they are contiguous if
+        # the first and the last ones are
+        if (len(window_ts) < cnt or window_ts[0] != start or
+                window_ts[-1] != start + (cnt - 1) * step or
+                series_ts[-1] - start >= archive['retention']):
+            return None
+        return window_ts, series_vals[first: first+cnt]
+
+    def _propagate_cold(self, fh, header, higher, timestamp_range,
+                        higher_base_ts, higher_series=None):
+        """
+        Propagate the update of the last archive of a tiered file to the
+        first archive of its companion file (and on to the next ones).
+        """
+        cold_path = header['cold_path']
+        with self._open(cold_path, 'r+b') as (f, st):
+            cold_header = self._cached_header(cold_path, f, st)
+            rs = self._propagate(fh, header, higher,
+                                 cold_header['archive_list'][0],
+                                 timestamp_range, 0, higher_base_ts, f,
+                                 cold_header, higher_series)
+            self.header_cache.restamp(cold_path, HeaderCache.file_stamp(st),
+                                      HeaderCache.file_stamp(os.fstat(f.fileno())))
+            self.block_cache.bump(cold_path)
+        return rs
+
+    def prefetch(self, path, from_time, until_time):
+        """
+        Ask the kernel to read the header and the slots from `from_time` to
+        `until_time` of the highest precision archive into the page cache,
+        in the background (see `fileio.willneed`), e.g. to warm up the files
+        about to be written after a restart.
+
+        Return the number of bytes advised.
+        """
+        with self._open(path, 'rb') as (f, st):
+            header = self._cached_header(path, f, st)
+            fd = f.fileno()
+            archive = header['archive_list'][0]
+            # the header and the block index
+            extents = [(0, archive['offset'])]
+            base_ts = self._read_base_ts(fd, header, archive)
+            if base_ts:
+                step = archive['sec_per_point']
+                from_time -= from_time % step
+                cnt = min(archive['count'],
+                          (roundup(until_time, step) - from_time) / step)
+                first_idx = self._timestamp2index(from_time, base_ts, archive)
+                if header['flags'] & FLAG_COLUMNAR:
+                    columns = [(archive['offset'], LONG_SIZE)] + [
+                        (self._column_offset(header, archive, col),
+                         header['value_size'])
+                        for col in xrange(len(header['tag_list']))]
+                else:
+                    columns = [(archive['offset'], header['point_size'])]
+                for offset, item_size in columns:
+                    extents.extend(self._ring_extents(
+                        offset, item_size, archive['count'], first_idx, cnt))
+            for offset, size in extents:
+                fileio.willneed(fd, offset, size)
+            return sum(size for _, size in extents)
+
+    def fetch(self, path, from_time, until_time=None, now=None,
+              max_points=None, step=None):
+        """
+        Fetch the points of every metric of the file, return
+        (header, time_info, values), `values` holds one tuple per point
+        (None for nulls), or None if the time range is out of the file's
+        retention.
+
+        Given `step` (seconds) or `max_points`, the points are consolidated
+        to that step, or to (about) that many points, with the file's
+        aggregation method, reading the coarsest archive that is precise
+        enough (see `_consolidation`).
+
+        A range beyond the archives of a tiered file is fetched from its
+        companion file, the header returned is then the companion's.
+        """
+        if now is None:
+            now = int(time.time())
+        with self._open(path, 'rb') as (f, st):
+            header = self._cached_header(path, f, st)
+            if self._cold_tier(header, from_time, now):
+                return self.fetch(header['cold_path'], from_time, until_time,
+                                  now, max_points, step)
+            archive_range = self._fetch_archive_range(header, from_time,
+                                                      until_time, now)
+            if archive_range is None:
+                return None
+            archive, from_time, until_time = archive_range
+            archive, agg_step = self._consolidation(
+                header, archive, from_time, until_time, max_points, step)
+            if agg_step == archive['sec_per_point']:
+                rs = self._archive_fetch(f, header, archive, from_time,
+                                         until_time)
+                return (self._header_copy(header),) + rs[1:]
+
+            time_info, vals = self._consolidated_series(
+                f, header, archive, from_time, until_time, agg_step)
+            val_array = np.where(vals == NULL_VALUE, None, vals.astype(object))
+            return (self._header_copy(header), time_info,
+                    map(tuple, val_array.tolist()))
+
+    def fetch_parallel(self, requests, workers=FETCH_WORKERS):
+        """
+        Run many `fetch` calls on a pool of `workers` threads, e.g. for the
+        hundreds of files of a wildcard query, so that their disk waits
+        overlap (file I/O and most of the decoding release the GIL).
+        Every request is a tuple of `fetch` arguments,
+        (path, from_time[, until_time[, now[, max_points[, step]]]]).
+
+        The requests are run in (device, inode) order of their files for
+        locality, the results are returned in request order. The first
+        exception raised by a request (in request order) is raised.
+        """
+        return self._run_parallel(self.fetch, requests, workers)
 
     @staticmethod
-    def filter_values(points):
-        rs = [p for p in points if p != NULL_VALUE]
-        return rs if rs else [NULL_VALUE]
+    def _run_parallel(func, requests, workers):
+        requests = list(requests)
+        if workers <= 1 or len(requests) <= 1:
+            return [func(*req) for req in requests]
 
-    def fetch(self, path, from_time, until_time=None, now=None):
-        with open(path, 'rb') as f:
-            header = self.header(f)
+        def file_key(i):
+            try:
+                st = os.stat(requests[i][0])
+            except OSError:
+                # left to `fetch` to fail
+                return (0, 0, i)
+            return (st.st_dev, st.st_ino, i)
+        order = sorted(xrange(len(requests)), key=file_key)
+
+        def run(i):
+            try:
+                return True, func(*requests[i])
+            except Exception:
+                return False, sys.exc_info()
+
+        pool = ThreadPool(min(workers, len(requests)))
+        try:
+            # neighbouring files go to the same thread
+            chunksize = -(-len(order) // (workers * 4))
+            outcomes = pool.map(run, order, chunksize)
+        finally:
+            pool.terminate()
+
+        results = [None] * len(requests)
+        for i, (ok, rs) in sorted(zip(order, outcomes)):
+            if not ok:
+                raise rs[0], rs[1], rs[2]
+            results[i] = rs
+        return results
+
+    def fetch_column(self, path, metric, from_time, until_time=None, now=None,
+                     max_points=None, step=None):
+        """
+        Fetch a single metric of the file, `metric` is either the metric
+        name or its position index in the file.
 
-            # validate timestamp
-            if now is None:
-                now = int(time.time())
-            if until_time is None:
-                until_time = now
-            if from_time >= until_time:
-                raise InvalidTime("from_time '%s' is after unitl_time '%s'" %
-                                  (from_time, until_time))
-
-            oldest_time = now - header['max_retention']
-            if from_time > now:
-                return None
-            if until_time < oldest_time:
+        Only the requested column is decoded. Return
+        (header, time_info, timestamps, values) where `values` is a float64
+        array aligned with `timestamps` with NaN for nulls, or None if the
+        time range is out of the file's retention.
+        """
+        rs = self.fetch_many(path, [metric], from_time, until_time, now,
+                             max_points, step)
+        if rs is None:
+            return None
+        header, time_info, timestamps, values = rs
+        return header, time_info, timestamps, values[0]
+
+    def fetch_many(self, path, metrics, from_time, until_time=None, now=None,
+                   max_points=None, step=None):
+        """
+        Fetch several metrics of the file with a single read of the archive,
+        metrics are given by name or position index.
+
+        Return (header, time_info, timestamps, values_list), `values_list`
+        holds one float64 array (NaN for nulls) per requested metric, or
+        None if the time range is out of the file's retention.
+        `max_points` and `step` consolidate the points like `fetch` does,
+        the companion file of a tiered file is read like `fetch` does.
+        """
+        rs = self._fetch_values(path, metrics, from_time, until_time, now,
+                                max_points, step)
+        if rs is None:
+            return None
+        header, time_info, timestamps, values = rs
+        return (self._header_copy(header), time_info, timestamps,
+                list(values.T))
+
+    def _fetch_values(self, path, metrics, from_time, until_time=None,
+                      now=None, max_points=None, step=None):
+        """
+        `fetch_many` with the values as a float64 array of shape (points,
+        metrics).
+        """
+        if now is None:
+            now = int(time.time())
+        with self._open(path, 'rb') as (f, st):
+            header = self._cached_header(path, f, st)
+            if self._cold_tier(header, from_time, now):
+                return self._fetch_values(header['cold_path'], metrics,
+                                          from_time, until_time, now,
+                                          max_points, step)
+            archive_range = self._fetch_archive_range(header, from_time,
+                                                      until_time, now)
+            if archive_range is None:
                 return None
+            archive, from_time, until_time = archive_range
+            cols = [self.metric_index(header, m) for m in metrics]
+
+            archive, agg_step = self._consolidation(
+                header, archive, from_time, until_time, max_points, step)
+            if agg_step != archive['sec_per_point']:
+                time_info, vals = self._consolidated_series(
+                    f, header, archive, from_time, until_time, agg_step, cols)
+                vals[vals == NULL_VALUE] = np.nan
+                return header, time_info, np.arange(*time_info), vals
+
+            sec_per_point = archive['sec_per_point']
+            from_time = roundup(from_time, sec_per_point)
+            until_time = roundup(until_time, sec_per_point)
+            time_info = (from_time, until_time, sec_per_point)
+            timestamps = np.arange(from_time, until_time, sec_per_point)
+            values = np.empty((len(timestamps), len(cols)))
+            values.fill(np.nan)
+
+            series = self._archive_series(f, header, archive, from_time,
+                                          until_time, cols)
+            if series is not None:
+                point_ts, point_vals = series
+                idx, valid = self._series_index(point_ts, time_info,
+                                                len(timestamps))
+                point_vals = point_vals[valid]
+                point_vals[point_vals == NULL_VALUE] = np.nan
+                values[idx] = point_vals
+            return header, time_info, timestamps, values
+
+    def fetch_aggregate(self, path, metrics, func, from_time, until_time=None,
+                        now=None, max_points=None, step=None):
+        """
+        Fetch several metrics of the file and reduce them to one series
+        with the aggregation method `func` ('average', 'sum', 'last', 'max'
+        or 'min', see `Agg`), e.g. graphite's sumSeries of metrics sharing
+        a file, with a single read of the archive. Null values are
+        ignored, a point is null if the values of all metrics are.
+
+        Return (header, time_info, timestamps, values), `values` is a
+        float64 array with NaN for nulls, or None if the time range is out
+        of the file's retention. Other arguments are as in `fetch_many`.
+        """
+        rs = self._fetch_partial(path, metrics, func, from_time, until_time,
+                                 now, max_points, step)
+        if rs is None:
+            return None
+        header, time_info, timestamps, values, counts = rs
+        if func == 'average':
+            values = values / np.maximum(counts, 1)
+        values[counts == 0] = np.nan
+        return self._header_copy(header), time_info, timestamps, values
+
+    def fetch_aggregate_paths(self, paths, func, from_time, until_time=None,
+                              now=None, max_points=None, step=None,
+                              workers=FETCH_WORKERS):
+        """
+        `fetch_aggregate` over the metric link paths of e.g. a wildcard
+        query: the paths are grouped by data file (see
+        `utils.group_by_file`), every file is read and reduced once (on a
+        pool of `workers` threads, see `fetch_parallel`), and the series of
+        the files are reduced together. The series of files of different
+        precisions are consolidated to a common step.
+
+        Return (time_info, timestamps, values) as `fetch_aggregate` does,
+        or None if the time range is out of the retention of every file.
+        """
+        groups = group_by_file(paths)
+        for items in groups.itervalues():
+            for path, metric in items:
+                if metric is None:
+                    raise KenshinException("not a metric link: %s" % path)
+        requests = [(data_path, [metric for _, metric in items], func,
+                     from_time, until_time, now, max_points, step)
+                    for data_path, items in groups.iteritems()]
+        results = self._run_parallel(self._fetch_partial, requests, workers)
+        while True:
+            steps = set(rs[1][2] for rs in results if rs is not None)
+            if len(steps) <= 1:
+                break
+            # fetch the others again consolidated to the common step, which
+            # may not be a multiple of the archive a file consolidates then
+            common_step = reduce(lambda x, y: x * y / gcd(x, y), steps)
+            redo = [i for i, rs in enumerate(results)
+                    if rs is not None and rs[1][2] != common_step]
+            redo_results = self._run_parallel(
+                self._fetch_partial,
+                [requests[i][:-2] + (None, common_step) for i in redo],
+                workers)
+            for i, rs in zip(redo, redo_results):
+                results[i] = rs
+        results = [rs for rs in results if rs is not None]
+        if not results:
+            return None
+
+        # place the series of the files on a common time range
+        step = results[0][1][2]
+        from_time = min(rs[1][0] for rs in results)
+        until_time = max(rs[1][1] for rs in results)
+        cnt = (until_time - from_time) / step
+        values = np.zeros((len(results), cnt))
+        counts = np.zeros((len(results), cnt), dtype=np.int64)
+        for i, (_, time_info, _, vals, cnts) in enumerate(results):
+            start = (time_info[0] - from_time) / step
+            values[i, start: start+len(vals)] = vals
+            counts[i, start: start+len(vals)] = cnts
+
+        agg_func = Agg.np_agg_func_dict['sum' if func == 'average' else func]
+        total_counts = counts.sum(0)
+        values = agg_func(values, counts > 0, 0)
+        if func == 'average':
+            values = values / np.maximum(total_counts, 1)
+        values[total_counts == 0] = np.nan
+        time_info = (from_time, until_time, step)
+        return time_info, np.arange(*time_info), values
+
+    def _fetch_partial(self, path, metrics, func, from_time, until_time=None,
+                       now=None, max_points=None, step=None):
+        """
+        Reduce the metrics of the file with `func`, return (header,
+        time_info, timestamps, values, counts), `counts` being the number
+        of non null values of every point. The values of 'average' are the
+        sums, so that the results of several files can be reduced together.
+        """
+        if func not in Agg.np_agg_func_dict:
+            raise KenshinException("unknown aggregation function: %s" % func)
+        rs = self._fetch_values(path, metrics, from_time, until_time, now,
+                                max_points, step)
+        if rs is None:
+            return None
+        header, time_info, timestamps, values = rs
+        valid = ~np.isnan(values)
+        agg_func = Agg.np_agg_func_dict['sum' if func == 'average' else func]
+        return (header, time_info, timestamps, agg_func(values, valid, 1),
+                valid.sum(1))
+
+    @staticmethod
+    def metric_index(header, metric):
+        if isinstance(metric, (int, long)):
+            if not 0 <= metric < len(header['tag_list']):
+                raise IndexError("position index out of range: %s" % metric)
+            return metric
+        try:
+            return header['tag_list'].index(metric)
+        except ValueError:
+            raise KenshinException("metric not found: %s" % metric)
+
+    @staticmethod
+    def _cold_tier(header, from_time, now):
+        """
+        Whether a fetch from `from_time` reads the companion file of a
+        tiered file, i.e. goes beyond the retention of its archives.
+        """
+        return bool(header['cold_path'] and
+                    now - from_time > header['max_retention'])
 
-            until_time = min(now, until_time)
-            from_time = max(oldest_time, from_time)
+    @staticmethod
+    def _fetch_archive_range(header, from_time, until_time, now):
+        """
+        Validate the time range and choose the archive to read.
+
+        Return (archive, from_time, until_time) with the range clamped to
+        the file's retention, or None if it is out of the retention.
+        """
+        if now is None:
+            now = int(time.time())
+        if until_time is None:
+            until_time = now
+        if from_time >= until_time:
+            raise InvalidTime("from_time '%s' is after unitl_time '%s'" %
+                              (from_time, until_time))
+
+        oldest_time = now - header['max_retention']
+        if from_time > now:
+            return None
+        if until_time < oldest_time:
+            return None
+
+        until_time = min(now, until_time)
+        from_time = max(oldest_time, from_time)
+
+        diff = now - from_time
+        for archive in header['archive_list']:
+            if archive['retention'] >= diff:
+                break
+        return archive, from_time, until_time
+
+    @staticmethod
+    def _consolidation(header, archive, from_time, until_time, max_points=None,
+                       step=None):
+        """
+        Choose the archive and the step of a fetch consolidated to `step`
+        seconds, or to at most (about) `max_points` points: the coarsest
+        archive covering the range (from `archive` on) whose precision is
+        not coarser than that step, its points are aggregated by a whole
+        factor.
+
+        Return (archive, agg_step), `agg_step` is the archive's precision
+        if there is nothing to consolidate.
+        """
+        target_step = step or 0
+        if max_points:
+            target_step = max(target_step,
+                              -(-(until_time - from_time) // max_points))
+        archive_list = header['archive_list']
+        for lower in archive_list[archive_list.index(archive) + 1:]:
+            if lower['sec_per_point'] > target_step:
+                break
+            archive = lower
+        sec_per_point = archive['sec_per_point']
+        return archive, max(sec_per_point, roundup(target_step, sec_per_point))
 
-            diff = now - from_time
-            for archive in header['archive_list']:
-                if archive['retention'] >= diff:
-                    break
+    def _consolidated_series(self, fh, header, archive, from_time, until_time,
+                             agg_step, cols=None):
+        """
+        Read the points from `from_time` to `until_time` and aggregate them
+        into points of `agg_step` seconds (a multiple of the archive's
+        precision, the points are aligned to it) with the file's
+        aggregation method.
 
-            return self._archive_fetch(f, header, archive, from_time, until_time)
+        Return (time_info, values), `values` is a float64 array of shape
+        (points, columns) with NULL_VALUE for nulls.
+        """
+        sec_per_point = archive['sec_per_point']
+        from_time -= from_time % agg_step
+        until_time = roundup(until_time, agg_step)
+        time_info = (from_time, until_time, agg_step)
+        cnt = (until_time - from_time) / agg_step
+        agg_cnt = agg_step / sec_per_point
+        col_cnt = len(header['tag_list']) if cols is None else len(cols)
+
+        # never read more than the whole ring
+        series_from = max(from_time, until_time - archive['retention'])
+        series = self._archive_series(fh, header, archive, series_from,
+                                      until_time, cols)
+        if series is None:
+            vals = np.empty((cnt, col_cnt))
+            vals.fill(NULL_VALUE)
+            return time_info, vals
+
+        # view the points as (consolidated point, point, column) arrays
+        point_ts, point_vals = series
+        idx, valid = self._series_index(
+            point_ts, (from_time, until_time, sec_per_point), cnt * agg_cnt)
+        group_vals = np.zeros((cnt * agg_cnt, col_cnt))
+        group_vals[idx] = point_vals[valid]
+        present = np.zeros(cnt * agg_cnt, dtype=bool)
+        present[idx] = True
+        group_vals = group_vals.reshape(cnt, agg_cnt, col_cnt)
+        valid = (present.reshape(cnt, agg_cnt)[:, :, np.newaxis] &
+                 (group_vals != NULL_VALUE))
+        agg_func = Agg.get_np_agg_func(header['agg_id'])
+        agg_vals = agg_func(group_vals, valid, 1)
+        return time_info, np.where(valid.any(1), agg_vals, NULL_VALUE)
 
     def _archive_fetch(self, fh, header, archive, from_time, until_time):
         from_time = roundup(from_time, archive['sec_per_point'])
         until_time = roundup(until_time, archive['sec_per_point'])
         tag_cnt = len(header['tag_list'])
         null_point = (None,) * tag_cnt
+        sec_per_point = archive['sec_per_point']
+        time_info = (from_time, until_time, sec_per_point)
 
-        base_point = self._read_base_point(fh, archive, header)
-        base_ts = base_point[0]
-
-        if base_ts == 0:
-            step = archive['sec_per_point']
-            cnt = (until_time - from_time) / step
-            time_info = (from_time, until_time, step)
-            val_list = [null_point] * cnt
-            return (header, time_info, val_list)
-
-        from_offset = self._timestamp2offset(from_time, base_ts, header, archive)
-        until_offset = self._timestamp2offset(until_time, base_ts, header, archive)
-
-        fh.seek(from_offset)
-        if from_offset < until_offset:
-            series_str = fh.read(until_offset - from_offset)
-        else:
-            archive_end = archive['offset'] + archive['size']
-            series_str = fh.read(archive_end - from_offset)
-            fh.seek(archive['offset'])
-            series_str += fh.read(until_offset - archive['offset'])
-
-        ## unpack series string
-        point_format = header['point_format']
-        byte_order, point_type = point_format[0], point_format[1:]
-        cnt = len(series_str) / header['point_size']
-        series_format = byte_order + point_type * cnt
-        unpacked_series = struct.unpack(series_format, series_str)
+        series = self._archive_series(fh, header, archive, from_time, until_time)
+        if series is None:
+            cnt = (until_time - from_time) / sec_per_point
+            return (header, time_info, [null_point] * cnt)
 
         ## construct value list
-        # pre-allocate entire list or speed
-        val_list = [null_point] * cnt
-        step = tag_cnt + 1
-        sec_per_point = archive['sec_per_point']
-        for i in xrange(0, len(unpacked_series), step):
-            point_ts = unpacked_series[i]
-            if from_time <= point_ts < until_time:
-                val = unpacked_series[i+1: i+step]
-                idx = (point_ts - from_time) / sec_per_point
-                val_list[idx] = self._conver_null_value(val)
-
-        time_info = (from_time, until_time, sec_per_point)
+        point_ts, point_vals = series
+        cnt = len(point_ts)
+        idx, valid = self._series_index(point_ts, time_info, cnt)
+        vals = point_vals[valid]
+
+        val_array = np.empty((cnt, tag_cnt), dtype=object)
+        val_array.fill(None)
+        val_array[idx] = np.where(vals == NULL_VALUE, None, vals.astype(object))
+        val_list = map(tuple, val_array.tolist())
         return header, time_info, val_list
 
     @staticmethod
-    def _conver_null_value(point_val):
-        val = [None if x == NULL_VALUE else x
-               for x in point_val]
-        return tuple(val)
+    def _series_index(point_ts, time_info, cnt):
+        """
+        Map the points read from an archive to their index in a result of
+        `cnt` points described by `time_info`.
+
+        Return (idx, valid), `valid` marks the points that belong to the
+        result and `idx` gives the positions of those points.
+        """
+        from_time, until_time, sec_per_point = time_info
+        valid = (point_ts >= from_time) & (point_ts < until_time)
+        idx = (point_ts - from_time) // sec_per_point
+        valid &= idx < cnt
+        return idx[valid], valid
+
+    @staticmethod
+    def point_dtype(header):
+        """
+        NumPy dtype of one on-disk point, equivalent to `header['point_format']`.
+        """
+        tag_cnt = len(header['tag_list'])
+        return np.dtype([('ts', '>u4'),
+                         ('val', Storage.value_dtype(header), (tag_cnt,))])
+
+    @staticmethod
+    def value_dtype(header):
+        """
+        NumPy dtype of one on-disk value, equivalent to `header['value_format']`.
+        """
+        return '>f4' if header['flags'] & FLAG_FLOAT32 else '>f8'
+
+    @classmethod
+    def archive_arrays(cls, buf, header, archive):
+        """
+        View `archive` of the file content `buf` (a string or a memory map)
+        as (timestamps, values) arrays without copying, `values` has shape
+        (points, metrics). Both are in the file's (big endian) byte order.
+
+        A compressed archive is decoded into new (native) arrays instead.
+        """
+        count = archive['count']
+        if archive['compressed']:
+            return cls._decode_archive(buf, header, archive)
+        if not header['flags'] & FLAG_COLUMNAR:
+            points = np.frombuffer(buf, dtype=cls.point_dtype(header),
+                                   count=count, offset=archive['offset'])
+            return points['ts'], points['val']
+
+        tag_cnt = len(header['tag_list'])
+        point_ts = np.frombuffer(buf, dtype='>u4', count=count,
+                                 offset=archive['offset'])
+        point_vals = np.frombuffer(buf, dtype=cls.value_dtype(header),
+                                   count=count * tag_cnt,
+                                   offset=cls._column_offset(header, archive, 0))
+        return point_ts, point_vals.reshape(tag_cnt, count).T
+
+    @classmethod
+    def _decode_archive(cls, buf, header, archive):
+        block_points = header['block_points']
+        block_lengths = np.frombuffer(buf, dtype='>u4',
+                                      count=archive['block_cnt'],
+                                      offset=archive['block_index_offset'])
+        point_ts = np.zeros(archive['count'], dtype=np.int64)
+        point_vals = np.zeros((archive['count'], len(header['tag_list'])))
+        for block_id, length in enumerate(block_lengths.tolist()):
+            if not length:
+                continue
+            offset = cls._block_offset(header, archive, block_id)
+            cnt = cls._block_size(archive, block_points, block_id)
+            first = block_id * block_points
+            point_ts[first: first+cnt], point_vals[first: first+cnt] = (
+                codec.decode_block(buf[offset: offset+length], cnt,
+                                   point_vals.shape[1],
+                                   cls.value_dtype(header)))
+        return point_ts, point_vals
+
+    @classmethod
+    def pack_archive(cls, header, archive, point_ts, point_vals):
+        """
+        Pack a whole archive from its timestamps and (points, metrics)
+        values, the inverse of `archive_arrays`.
+
+        Return (data, block_index), the block index of a compressed archive
+        goes to archive['block_index_offset'] (it is empty for the others).
+        """
+        point_ts = np.asarray(point_ts)
+        point_vals = np.asarray(point_vals, dtype=np.float64)
+        if archive['compressed']:
+            blocks = cls._encode_blocks(header, archive, point_ts, point_vals)
+            block_points = header['block_points']
+            block_index = np.array([len(data) for data in blocks],
+                                   dtype='>u4').tostring()
+            return ''.join(
+                data.ljust(cls._block_size(archive, block_points, block_id) *
+                           header['point_size'], '\x00')
+                for block_id, data in enumerate(blocks)), block_index
+
+        point_ts = np.asarray(point_ts, dtype='>u4')
+        point_vals = np.asarray(point_vals, dtype=cls.value_dtype(header))
+        if not header['flags'] & FLAG_COLUMNAR:
+            points = np.empty(len(point_ts), dtype=cls.point_dtype(header))
+            points['ts'] = point_ts
+            points['val'] = point_vals
+            return points.tostring(), ''
+        return point_ts.tostring() + point_vals.T.tostring(), ''
+
+    @classmethod
+    def _encode_blocks(cls, header, archive, point_ts, point_vals):
+        """
+        Encode every block of a compressed archive from its timestamps and
+        values, blocks without any point are empty strings.
+        """
+        block_points = header['block_points']
+        blocks = []
+        for block_id in xrange(archive['block_cnt']):
+            first = block_id * block_points
+            cnt = cls._block_size(archive, block_points, block_id)
+            block_ts = point_ts[first: first+cnt]
+            if not np.any(block_ts):
+                blocks.append('')
+                continue
+            blocks.append(codec.encode_block(block_ts,
+                                             point_vals[first: first+cnt],
+                                             cls.value_dtype(header)))
+        return blocks
+
+    def _archive_series(self, fh, header, archive, from_time, until_time,
+                        cols=None):
+        """
+        Read the ring slots from `from_time` to `until_time` (both aligned to
+        the archive's precision) through a read-only memory map of the file.
+
+        The archive is viewed as arrays (see `archive_arrays`) and the
+        wrap-around is resolved by one `take` over the slot indexes. Only
+        the value columns listed in `cols` (all by default) are copied and
+        decoded, in a columnar file those are contiguous. Compressed
+        archives are read with `pread`, decoding only the needed blocks.
+
+        With the block cache enabled, the slots are read through it instead
+        (see `_read_cached_slots`).
+
+        Return (timestamps, values) in chronological slot order, `values` is
+        a float64 array of shape (points, columns), or None if the archive
+        has never been written.
+        """
+        if archive['compressed'] or self.block_cache.max_size > 0:
+            fd = fh.fileno()
+            base_ts = self._read_base_ts(fd, header, archive)
+            if base_ts == 0:
+                return None
+            slots = self._series_slots(base_ts, archive, from_time, until_time)
+            if self.block_cache.max_size > 0:
+                return self._read_cached_slots(fd, fh.name, header, archive,
+                                               slots, cols)
+            return self._read_block_slots(fd, header, archive, slots, cols)
+
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            point_ts, point_vals = self.archive_arrays(mm, header, archive)
+            if header['flags'] & FLAG_BASE_TS:
+                base_ts = archive['base_ts']
+            else:
+                base_ts = int(point_ts[0])
+            series = self._take_series(point_ts, point_vals, archive, base_ts,
+                                       from_time, until_time, cols)
+            del point_ts, point_vals
+        finally:
+            mm.close()
+        return series
+
+    def _read_cached_slots(self, fd, path, header, archive, slots, cols=None):
+        """
+        Read ring `slots` of `archive` through the block cache. The ring is
+        cut in ranges of fixed size (the blocks of a compressed archive,
+        BLOCK_CACHE_POINTS slots otherwise), the ranges missing in the cache
+        are read, decoded and cached whole.
+
+        Return (timestamps, values) like `_read_block_slots`.
+        """
+        if archive['compressed']:
+            range_points = header['block_points']
+        else:
+            range_points = BLOCK_CACHE_POINTS
+        range_ids = np.unique(slots // range_points).tolist()
+        stamp = self.block_cache.stamp(path, os.fstat(fd))
+        ranges = {}
+        for range_id in range_ids:
+            ranges[range_id] = self.block_cache.get(
+                (path, archive['offset'], range_id), stamp)
+        missing = [r for r in range_ids if ranges[r] is None]
+
+        if archive['compressed'] and missing:
+            block_ts, block_vals = self._read_blocks(fd, header, archive,
+                                                     missing)
+            decoded = zip(block_ts, block_vals)
+        else:
+            decoded = []
+            for range_id in missing:
+                # the ranges are padded to range_points with zeros
+                cnt = self._block_size(archive, range_points, range_id)
+                point_ts, point_vals = self._read_slots(
+                    fd, header, archive, range_id * range_points, cnt)
+                range_ts = np.zeros(range_points, dtype=np.int64)
+                range_vals = np.zeros((range_points, point_vals.shape[1]))
+                range_ts[:cnt], range_vals[:cnt] = point_ts, point_vals
+                decoded.append((range_ts, range_vals))
+        for range_id, (range_ts, range_vals) in zip(missing, decoded):
+            range_ts.flags.writeable = range_vals.flags.writeable = False
+            ranges[range_id] = (range_ts, range_vals)
+            self.block_cache.put((path, archive['offset'], range_id),
+                                 ranges[range_id], stamp)
+
+        range_ts = np.array([ranges[r][0] for r in range_ids])
+        range_vals = np.array([ranges[r][1] for r in range_ids])
+        pos = self._block_slot_pos(np.array(range_ids), range_points, slots)
+        point_vals = range_vals.reshape(range_ts.size, range_vals.shape[2])[pos]
+        if cols is not None:
+            point_vals = point_vals[:, cols]
+        return range_ts.reshape(-1)[pos], point_vals
+
+    def _series_slots(self, base_ts, archive, from_time, until_time):
+        count = archive['count']
+        from_idx = self._timestamp2index(from_time, base_ts, archive)
+        until_idx = self._timestamp2index(until_time, base_ts, archive)
+        # same slot means the whole ring, just as the offsets did
+        cnt = (until_idx - from_idx) % count or count
+        return (from_idx + np.arange(cnt)) % count
+
+    def _take_series(self, point_ts, point_vals, archive, base_ts, from_time,
+                     until_time, cols):
+        if base_ts == 0:
+            return None
+
+        slots = self._series_slots(base_ts, archive, from_time, until_time)
+        point_ts = point_ts.take(slots).astype(np.int64)
+        if cols is None:
+            point_vals = point_vals.take(slots, axis=0)
+        else:
+            point_vals = np.column_stack([point_vals[:, c].take(slots)
+                                          for c in cols])
+        return point_ts, point_vals.astype(np.float64)
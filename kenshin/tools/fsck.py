@@ -0,0 +1,266 @@
+# coding: utf-8
+#
+# This module implements the integrity checks of kenshin-fsck.
+#
+# A file is checked as a whole through a memory map, every archive is
+# viewed as (timestamps, values) arrays (see `Storage.archive_arrays`) and
+# checked with vectorized NumPy operations, so the checks of a file cost
+# about one sequential read of it.
+#
+
+import os
+import mmap
+import time
+import struct
+
+import numpy as np
+
+from kenshin import codec
+from kenshin.storage import (
+    Storage, KenshinException, FLAG_TAG_OVERFLOW, BLOCKINFO_SIZE)
+from kenshin.consts import NULL_VALUE
+
+
+def check_file(path, index_tags=None, now=None):
+    """
+    Check the data file at `path`: header and size consistency, the ring
+    position and alignment of the timestamps and the block index of every
+    archive, and the tags against `index_tags` (the {position index:
+    metric} of the file in the index file) if given.
+
+    Return the report of the file, a dict of `errors` (damage) and
+    `warnings` (suspicious but valid) message lists, and statistics.
+    """
+    report = {
+        'path': path,
+        'errors': [],
+        'warnings': [],
+    }
+    errors, warnings = report['errors'], report['warnings']
+    if now is None:
+        now = int(time.time())
+
+    try:
+        with open(path, 'rb') as f:
+            header = Storage.header(f)
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if size else ''
+    except Exception as e:
+        # a damaged header may fail to parse in any way
+        errors.append('unreadable header: %s' % e)
+        return report
+
+    try:
+        report.update({
+            'version': header['version'],
+            'layout': header['layout'],
+            'compression': header['compression'],
+            'value_type': header['value_type'],
+            'size': size,
+            'metrics': sum(1 for tag in header['tag_list'] if tag),
+        })
+        header_errors, readable = check_header(header, size)
+        errors.extend(header_errors)
+        errors.extend(check_tags(header, index_tags))
+        if header['cold_path'] and not os.path.exists(header['cold_path']):
+            errors.append('missing companion file: %s' % header['cold_path'])
+        if not readable:
+            return report
+
+        report['archives'] = []
+        for i, archive in enumerate(header['archive_list']):
+            stats, archive_errors, archive_warnings = check_archive(
+                mm, header, archive, now)
+            report['archives'].append(stats)
+            errors.extend('archive %d: %s' % (i, e) for e in archive_errors)
+            warnings.extend('archive %d: %s' % (i, w)
+                            for w in archive_warnings)
+    finally:
+        if size:
+            mm.close()
+    return report
+
+
+def check_header(header, size):
+    """
+    Return the errors of the header of a file of `size` bytes, and whether
+    the archives can be read where the header says they are.
+    """
+    errors = []
+    readable = True
+    archive_list = header['archive_list']
+    try:
+        Storage.validate_archive_list(
+            [(a['sec_per_point'], a['count']) for a in archive_list],
+            header['x_files_factor'])
+    except KenshinException as e:
+        errors.append('invalid archives: %s' % e)
+    if header['max_retention'] != archive_list[-1]['retention']:
+        errors.append('max retention %d, the last archive keeps %d' %
+                      (header['max_retention'], archive_list[-1]['retention']))
+    if header['point_size'] != struct.calcsize(header['point_format']):
+        errors.append('point size %d for %d metrics' %
+                      (header['point_size'], len(header['tag_list'])))
+
+    # the block index, then the archives back to back
+    offset = header['header_size'] + sum(
+        BLOCKINFO_SIZE * a['block_cnt']
+        for a in archive_list if a['compressed'])
+    for i, archive in enumerate(archive_list):
+        if archive['offset'] != offset:
+            readable = False
+            errors.append('archive %d at offset %d, expected %d' %
+                          (i, archive['offset'], offset))
+        offset = archive['offset'] + archive['size']
+
+    expected_size = header['data_end']
+    if header['flags'] & FLAG_TAG_OVERFLOW:
+        expected_size += len(Storage.pack_tag_table(header['tag_list']))
+    if size < expected_size:
+        readable = readable and size >= header['data_end']
+        errors.append('truncated, %d bytes, expected %d' %
+                      (size, expected_size))
+    elif size > expected_size:
+        errors.append('%d bytes, expected %d' % (size, expected_size))
+    return errors, readable
+
+
+def check_tags(header, index_tags=None):
+    """
+    Return the errors of the tags of a file, `index_tags` as in
+    `check_file`.
+    """
+    errors = []
+    tag_list = header['tag_list']
+    tags = [tag for tag in tag_list if tag]
+    if len(set(tags)) != len(tags):
+        errors.append('duplicate metrics')
+    if index_tags is None:
+        return errors
+    for pos_idx, metric in sorted(index_tags.iteritems()):
+        if pos_idx >= len(tag_list):
+            errors.append('index: %s at position %d, out of the file' %
+                          (metric, pos_idx))
+        elif tag_list[pos_idx] != metric:
+            errors.append('index: %s at position %d, the file has %r' %
+                          (metric, pos_idx, tag_list[pos_idx]))
+    missing = [i for i, tag in enumerate(tag_list)
+               if tag and i not in index_tags]
+    if missing:
+        errors.append('index: no entry for position %s' %
+                      ', '.join(map(str, missing)))
+    return errors
+
+
+def check_archive(buf, header, archive, now):
+    """
+    Check `archive` of the file content `buf`, return (statistics, errors,
+    warnings).
+    """
+    errors, warnings = [], []
+    stats = {
+        'sec_per_point': archive['sec_per_point'],
+        'count': archive['count'],
+    }
+    if archive['compressed']:
+        errors.extend(check_block_index(buf, header, archive))
+        if errors:
+            return stats, errors, warnings
+    try:
+        point_ts, point_vals = Storage.archive_arrays(buf, header, archive)
+    except Exception as e:
+        errors.append('undecodable: %s' % e)
+        return stats, errors, warnings
+    point_ts = point_ts.astype(np.int64)
+
+    step = archive['sec_per_point']
+    written = point_ts != 0
+    written_cnt = int(written.sum())
+    stats['written'] = written_cnt
+
+    # the base timestamp of older files is the one of the first slot
+    base_ts = archive['base_ts']
+    if base_ts is None:
+        base_ts = int(point_ts[0])
+    if not written_cnt:
+        if base_ts:
+            warnings.append('base timestamp %d but no point' % base_ts)
+        return stats, errors, warnings
+    if not base_ts:
+        errors.append('%d points but no base timestamp' % written_cnt)
+        return stats, errors, warnings
+
+    ts = point_ts[written]
+    misaligned = int((ts % step != 0).sum())
+    # every point is in the slot of its timestamp in the ring
+    slots = np.nonzero(written)[0]
+    misplaced = int(((ts - base_ts) // step % archive['count'] !=
+                     slots).sum())
+    future = int((ts > now + step).sum())
+    if misaligned:
+        errors.append('%d timestamps not aligned to %ds' % (misaligned, step))
+    if misplaced:
+        errors.append('%d points out of the slot of their timestamp' %
+                      misplaced)
+    if future:
+        warnings.append('%d points in the future' % future)
+
+    # the columns of the metrics, not the free ones
+    tags = header['tag_list']
+    cols = [i for i, tag in enumerate(tags) if tag]
+    nulls = point_vals[written][:, cols] == NULL_VALUE
+    stats.update({
+        'first_ts': int(ts.min()),
+        'last_ts': int(ts.max()),
+        'misaligned': misaligned,
+        'misplaced': misplaced,
+        'future': future,
+        'null_ratio': round(float(nulls.mean()), 4) if nulls.size else 0.,
+    })
+    # metrics without any value, in the archives they should have reached
+    empty = [tags[col] for col, is_empty in zip(cols, nulls.all(0))
+             if is_empty]
+    if empty and archive is header['archive_list'][0]:
+        warnings.append('no value for %d metrics: %s' %
+                        (len(empty), ', '.join(empty[:5])))
+    return stats, errors, warnings
+
+
+def check_block_index(buf, header, archive):
+    """
+    Return the errors of the block index of a compressed archive, every
+    block has to fit in the space of its points.
+    """
+    errors = []
+    block_points = header['block_points']
+    block_lengths = np.frombuffer(buf, dtype='>u4', count=archive['block_cnt'],
+                                  offset=archive['block_index_offset'])
+    cnts = np.minimum(block_points,
+                      archive['count'] -
+                      np.arange(archive['block_cnt']) * block_points)
+    limits = codec.raw_block_size(cnts, len(header['tag_list']),
+                                  header['value_size'])
+    overflow = np.nonzero(block_lengths > limits)[0]
+    if len(overflow):
+        errors.append('%d blocks larger than their space, first block %d' %
+                      (len(overflow), overflow[0]))
+    return errors
+
+
+def file_tags_from_index(index_file, instance_data_dir):
+    """
+    Read the index file of a rurouni instance, return {data file path:
+    {position index: metric}}.
+    """
+    files = {}
+    with open(index_file) as f:
+        for line in f:
+            try:
+                metric, schema_name, file_idx, pos_idx = line.split()
+                path = os.path.join(instance_data_dir, schema_name,
+                                    '%d.hs' % int(file_idx))
+                files.setdefault(path, {})[int(pos_idx)] = metric
+            except ValueError:
+                continue
+    return files
@@ -19,6 +19,23 @@ def get_metric(path):
     return metric
 
 
+def group_by_file(paths):
+    """
+    Group metric link paths (see `rurouni.storage.createLink`) by the data
+    file they point to, so the metrics sharing a file can be read with one
+    `kenshin.fetch_many` call.
+
+    Return an OrderedDict of {data file path: [(path, metric), ...]}, the
+    metric is None for a path that is not a link.
+    """
+    from collections import OrderedDict
+    groups = OrderedDict()
+    for path in paths:
+        data_path = os.path.realpath(path)
+        groups.setdefault(data_path, []).append((path, get_metric(path)))
+    return groups
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -44,6 +61,21 @@ def roundup(x, base):
     return (x - t + base) if t else x
 
 
+def write_sparse(f, data, chunk_size=4096):
+    """
+    Write `data` to `f`, seeking over the chunks of zeros so that they are
+    left as holes in the file. The caller must `truncate` the file at its
+    final size, in case it ends with a hole.
+    """
+    zeroes = '\x00' * chunk_size
+    for i in xrange(0, len(data), chunk_size):
+        chunk = data[i: i+chunk_size]
+        if chunk == zeroes[:len(chunk)]:
+            f.seek(len(chunk), os.SEEK_CUR)
+        else:
+            f.write(chunk)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
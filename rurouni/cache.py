@@ -23,7 +23,8 @@ from kenshin.consts import NULL_VALUE
 from rurouni import log
 from rurouni.conf import settings
 from rurouni.storage import (
-    getFilePath, createLink, StorageSchemas, rebuildIndex, rebuildLink
+    getFilePath, getColdFilePath, createLink, StorageSchemas, rebuildIndex,
+    rebuildLink
 )
 from rurouni.utils import TokenBucket, get_instance_of_metric
 from rurouni.exceptions import TokenBucketFull, UnexpectedMetric
@@ -138,8 +139,14 @@ class MetricCache(object):
                 file_path = getFilePath(schema.name, file_idx)
                 if not os.path.exists(file_path):
                     tags = [''] * schema.metrics_max_num
+                    cold_path = None
+                    if schema.cold_data_dir:
+                        cold_path = getColdFilePath(schema, file_idx)
                     kenshin.create(file_path, tags, schema.archives, schema.xFilesFactor,
-                                   schema.aggregationMethod)
+                                   schema.aggregationMethod, schema.layout,
+                                   schema.compression, schema.value_type,
+                                   settings.FILE_ALLOCATION, cold_path,
+                                   schema.hot_archives)
                 # update file metadata
                 kenshin.add_tag(metric, file_path, pos_idx)
                 # create link
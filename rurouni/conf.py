@@ -33,6 +33,12 @@ defaults = dict(
 
     MAX_CREATES_PER_MINUTE = float('inf'),
     NUM_ALL_INSTANCE = 1,
+    MAX_OPEN_FILES = 0,
+    DEFERRED_ROLLUP = False,
+    ROLLUP_HISTORY = False,
+    FILE_ALLOCATION = 'fallocate',
+    WARMUP_RATE = 0,
+    SYNC_POLICY = 'none',
 )
 
 
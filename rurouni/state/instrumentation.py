@@ -76,6 +76,8 @@ def record_metrics():
     errors = _stats.get('errors', 0)
     cache_queries = _stats.get('cacheQueries', 0)
     cache_overflow = _stats.get('cacheOverflow', 0)
+    rollup_times = _stats.get('rollupTimes', [])
+    sync_times = _stats.get('syncTimes', [])
 
     if update_times:
         avg_update_time = sum(update_times) / len(update_times)
@@ -85,7 +87,17 @@ def record_metrics():
         points_per_update = float(committed_points) / len(update_times)
         record('pointsPerUpdate', points_per_update)
 
+    if rollup_times:
+        avg_rollup_time = sum(rollup_times) / len(rollup_times)
+        record('avgRollupTime', avg_rollup_time)
+
+    if sync_times:
+        avg_sync_time = sum(sync_times) / len(sync_times)
+        record('avgSyncTime', avg_sync_time)
+        record('syncOperations', len(sync_times))
+
     record('updateOperations', len(update_times))
+    record('rollupOperations', len(rollup_times))
     record('committedPoints', committed_points)
     record('creates', creates)
     record('droppedCreates', dropped_creates)
@@ -93,6 +105,12 @@ def record_metrics():
     record('cacheQueries', cache_queries)
     record('cacheOverflow', cache_overflow)
 
+    # startup warm-up progress, see `rurouni.writer.warmUpFiles`
+    warmup_files = _stats.get('warmupFiles', 0)
+    if warmup_files:
+        record('warmupFiles', warmup_files)
+        record('warmupBytes', _stats.get('warmupBytes', 0))
+
     record('metricReceived', _stats.get('metricReceived', 0))
     record('cpuUsage', get_cpu_usage())
     # this only workds on linux
@@ -17,6 +17,14 @@ def getFilePath(schema_name, file_idx):
                 schema_name, '%d.hs' % file_idx)
 
 
+def getColdFilePath(schema, file_idx):
+    """
+    Path of the companion file of a tiered file (see `coldDataDir`).
+    """
+    return join(schema.cold_data_dir, settings['instance'], schema.name,
+                '%d.hs' % file_idx)
+
+
 def getMetricPath(metric):
     path = metric.replace('.', sep)
     return join(settings.LOCAL_LINK_DIR, settings['instance'], path + '.hs')
@@ -74,6 +82,9 @@ def rebuildIndex(instance_data_dir, instance_index_file):
                                   (metric, schema_name, file_id, i))
             if empty_flag:
                 os.remove(fp)
+                # and the companion file of a tiered file
+                if header['cold_path'] and os.path.exists(header['cold_path']):
+                    os.remove(header['cold_path'])
     out.close()
 
 
@@ -120,7 +131,9 @@ class Schema(object):
 
 class DefaultSchema(Schema):
     def __init__(self, name, xFilesFactor, aggregationMethod, archives,
-                 cache_retention, metrics_max_num, cache_ratio):
+                 cache_retention, metrics_max_num, cache_ratio, layout='row',
+                 compression='none', value_type='float64', cold_data_dir=None,
+                 hot_archives=1):
         self.name = name
         self.xFilesFactor = xFilesFactor
         self.aggregationMethod = aggregationMethod
@@ -128,6 +141,11 @@ class DefaultSchema(Schema):
         self.cache_retention = cache_retention
         self.metrics_max_num = metrics_max_num
         self.cache_ratio = cache_ratio
+        self.layout = layout
+        self.compression = compression
+        self.value_type = value_type
+        self.cold_data_dir = cold_data_dir
+        self.hot_archives = hot_archives
 
     def match(self, metric):
         return True
@@ -135,7 +153,9 @@ class DefaultSchema(Schema):
 
 class PatternSchema(Schema):
     def __init__(self, name, pattern, xFilesFactor, aggregationMethod, archives,
-                 cache_retention, metrics_max_num, cache_ratio):
+                 cache_retention, metrics_max_num, cache_ratio, layout='row',
+                 compression='none', value_type='float64', cold_data_dir=None,
+                 hot_archives=1):
         self.name = name
         self.pattern = re.compile(pattern)
         self.xFilesFactor = xFilesFactor
@@ -144,6 +164,11 @@ class PatternSchema(Schema):
         self.cache_retention = cache_retention
         self.metrics_max_num = metrics_max_num
         self.cache_ratio = cache_ratio
+        self.layout = layout
+        self.compression = compression
+        self.value_type = value_type
+        self.cold_data_dir = cold_data_dir
+        self.hot_archives = hot_archives
 
     def match(self, metric):
         return self.pattern.match(metric)
@@ -166,15 +191,24 @@ def loadStorageSchemas(conf_file):
             options.get('cacheretention'))
         metrics_max_num = options.get('metricsperfile')
         cache_ratio = 1.2
+        layout = options.get('layout', 'row')
+        compression = options.get('compression', 'none')
+        value_type = options.get('valuetype', 'float64')
+        cold_data_dir = options.get('colddatadir')
+        hot_archives = int(options.get('hotarchives', 1))
 
         try:
             kenshin.validate_archive_list(archives, xff)
+            kenshin.Storage.format_flags(layout, compression, value_type)
         except kenshin.InvalidConfig:
             log.err("Invalid schema found in %s." % section)
+        if cold_data_dir and not 0 < hot_archives < len(archives):
+            log.err("Invalid hotArchives found in %s." % section)
 
         schema = PatternSchema(section, pattern, float(xff), agg, archives,
                                int(cache_retention), int(metrics_max_num),
-                               float(cache_ratio))
+                               float(cache_ratio), layout, compression,
+                               value_type, cold_data_dir, hot_archives)
         schema_list.append(schema)
     schema_list.append(defaultSchema)
     return schema_list
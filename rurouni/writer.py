@@ -1,6 +1,8 @@
 # coding: utf-8
 import time
+from threading import Lock
 
+import numpy as np
 from twisted.application.service import Service
 from twisted.internet import reactor
 
@@ -18,6 +20,10 @@ class WriterService(Service):
         pass
 
     def startService(self):
+        kenshin.file_pool.resize(settings.MAX_OPEN_FILES)
+        kenshin.set_sync_policy(settings.SYNC_POLICY)
+        if settings.WARMUP_RATE > 0:
+            reactor.callInThread(warmUpFiles)
         reactor.callInThread(writeForever)
         Service.startService(self)
 
@@ -27,6 +33,9 @@ class WriterService(Service):
             writeCachedDataPointsWhenStop(file_cache_idxs)
         except Exception as e:
             log.err('write error when stopping service: %s' % e)
+        RollupScheduler.run(force=True)
+        commitWrites()
+        kenshin.file_pool.clear()
         Service.stopService(self)
 
 
@@ -47,29 +56,87 @@ def writeForever():
 
 def writeCachedDataPoints(file_cache_idxs):
     pop_func = MetricCache.pop
+    deferred = settings.DEFERRED_ROLLUP
     for schema_name, file_idx in file_cache_idxs:
         datapoints = pop_func(schema_name, file_idx)
         file_path = getFilePath(schema_name, file_idx)
 
         try:
             t1 = time.time()
-            kenshin.update(file_path, datapoints)
+            dirty_range = kenshin.update(file_path, datapoints,
+                                         propagate=not deferred,
+                                         history=RollupHistory.get(file_path))
             update_time = time.time() - t1
         except Exception as e:
             log.err('Error writing to %s: %s' % (file_path, e))
             instrumentation.incr('errors')
+            RollupHistory.discard(file_path)
         else:
+            RollupHistory.add(schema_name, file_path, datapoints)
             point_cnt = len(datapoints)
             instrumentation.incr('committedPoints', point_cnt)
             instrumentation.append('updateTimes', update_time)
 
+            if deferred and dirty_range:
+                RollupScheduler.add(schema_name, file_path, dirty_range)
+
             if settings.LOG_UPDATES:
                 log.updates("wrote %d datapoints for %s in %.5f secs" %
                             (point_cnt, schema_name, update_time))
 
+    if deferred:
+        RollupScheduler.run()
+    commitWrites()
     return True
 
 
+def commitWrites():
+    """
+    Flush the files written since the last call with the group sync policy
+    (a no-op otherwise), and record the sync latencies.
+    """
+    try:
+        kenshin.commit()
+    except Exception as e:
+        log.err('Error syncing data files: %s' % e)
+        instrumentation.incr('errors')
+    for sync_time in kenshin.pop_sync_times():
+        instrumentation.append('syncTimes', sync_time)
+
+
+def warmUpFiles():
+    """
+    Prefetch the slots of the highest precision archive that the first
+    flushes (and rollups) after a restart touch, for every file of the
+    index, issuing at most WARMUP_RATE bytes per second.
+    """
+    rate = float(settings.WARMUP_RATE)
+    start = time.time()
+    now = int(start)
+    file_cnt = total_size = 0
+    for schema_name, file_idx in MetricCache.getAllFileCaches():
+        if not reactor.running:
+            return
+        schema = MetricCache.storage_schemas.getSchemaByName(schema_name)
+        # a rollup reads back the propagation timeunit of the points it
+        # aggregates into the next archive
+        lookback = RollupScheduler.getTimeunit(schema_name) or 0
+        until = now + schema.cache_retention + settings.DEFAULT_WAIT_TIME
+        file_path = getFilePath(schema_name, file_idx)
+        try:
+            size = kenshin.prefetch(file_path, now - lookback, until)
+        except Exception as e:
+            log.err('Error warming up %s: %s' % (file_path, e))
+            continue
+        instrumentation.incr('warmupFiles')
+        instrumentation.incr('warmupBytes', size)
+        file_cnt += 1
+        total_size += size
+        time.sleep(max(0, start + total_size / rate - time.time()))
+    log.cache('warmed up %d files (%d bytes) in %.2f secs' %
+              (file_cnt, total_size, time.time() - start))
+
+
 def writeCachedDataPointsWhenStop(file_cache_idxs):
     pop_func = MetricCache.pop
     for schema_name, file_idx in file_cache_idxs:
@@ -80,3 +147,130 @@ def writeCachedDataPointsWhenStop(file_cache_idxs):
                 kenshin.update(file_path, datapoints)
             except Exception as e:
                 log.err('Error writing to %s: %s' % (file_path, e))
+
+
+class RollupScheduler(object):
+    """
+    Deferred propagation to the lower precision archives.
+
+    When DEFERRED_ROLLUP is enabled the writer only updates the highest
+    precision archive of a file and records the written time range here.
+    The accumulated range is propagated once it crosses a boundary of the
+    file's propagate timeunit (see `kenshin.Storage.get_propagate_timeunit`),
+    which turns the rollups of many flushes into one read-modify-write of
+    every lower archive.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.dirty_ranges = {}
+
+    def add(self, schema_name, file_path, timestamp_range):
+        with self.lock:
+            if file_path in self.dirty_ranges:
+                timeunit, (start, end) = self.dirty_ranges[file_path]
+                timestamp_range = (min(start, timestamp_range[0]),
+                                   max(end, timestamp_range[1]))
+            else:
+                timeunit = self.getTimeunit(schema_name)
+                if timeunit is None:
+                    return
+            self.dirty_ranges[file_path] = (timeunit, timestamp_range)
+
+    @staticmethod
+    def getTimeunit(schema_name):
+        schema = MetricCache.storage_schemas.getSchemaByName(schema_name)
+        if schema is None or len(schema.archives) < 2:
+            return None
+        return kenshin.Storage.get_propagate_timeunit(
+            schema.archives[1][0], schema.archives[0][0], schema.xFilesFactor)
+
+    def popDueRanges(self, force=False):
+        due = []
+        with self.lock:
+            for file_path, (timeunit, (start, end)) in self.dirty_ranges.items():
+                if not force and end / timeunit == start / timeunit:
+                    continue
+                del self.dirty_ranges[file_path]
+                # an empty range has nothing to propagate
+                if start < end:
+                    due.append((file_path, (start, end)))
+                if not force and end % timeunit:
+                    # the last timeunit is not complete yet
+                    self.dirty_ranges[file_path] = (
+                        timeunit, (end - end % timeunit, end))
+        return due
+
+    def run(self, force=False):
+        for file_path, timestamp_range in self.popDueRanges(force):
+            try:
+                t1 = time.time()
+                kenshin.propagate(file_path, timestamp_range,
+                                  RollupHistory.get(file_path))
+                rollup_time = time.time() - t1
+            except Exception as e:
+                log.err('Error propagating %s: %s' % (file_path, e))
+                instrumentation.incr('errors')
+                RollupHistory.discard(file_path)
+            else:
+                instrumentation.append('rollupTimes', rollup_time)
+
+
+RollupScheduler = RollupScheduler()
+
+
+class RollupHistory(object):
+    """
+    The points the writer flushed lately to every file, when
+    ROLLUP_HISTORY is enabled.
+
+    They are handed back to `kenshin.update` (and `kenshin.propagate`) as
+    the `history` of the file, so that the lower precision archives are
+    computed from them rather than by reading the highest precision
+    archive back. Only the points of the last rollup window (and of a
+    flush, for deferred rollups) are kept, as (timestamps, values)
+    arrays, kenshin reads the archive when they do not cover it, e.g.
+    after a restart.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.histories = {}
+
+    def get(self, file_path):
+        if not settings.ROLLUP_HISTORY:
+            return None
+        with self.lock:
+            return self.histories.get(file_path)
+
+    def add(self, schema_name, file_path, datapoints):
+        if not settings.ROLLUP_HISTORY or not datapoints:
+            return
+        span = self.getSpan(schema_name)
+        if span is None:
+            return
+        point_ts = np.array([ts for ts, _ in datapoints], dtype=np.int64)
+        point_vals = np.array([vals for _, vals in datapoints],
+                              dtype=np.float64)
+        with self.lock:
+            history = self.histories.get(file_path)
+            if history is not None and \
+                    history[1].shape[1:] == point_vals.shape[1:]:
+                point_ts = np.concatenate([history[0], point_ts])
+                point_vals = np.concatenate([history[1], point_vals])
+            recent = point_ts > point_ts.max() - span
+            self.histories[file_path] = (point_ts[recent], point_vals[recent])
+
+    def discard(self, file_path):
+        # what the file holds is unknown after a failed write
+        with self.lock:
+            self.histories.pop(file_path, None)
+
+    @staticmethod
+    def getSpan(schema_name):
+        timeunit = RollupScheduler.getTimeunit(schema_name)
+        if timeunit is None:
+            return None
+        schema = MetricCache.storage_schemas.getSchemaByName(schema_name)
+        return max(timeunit, schema.archives[1][0]) + schema.cache_retention
+
+
+RollupHistory = RollupHistory()
@@ -2,6 +2,8 @@
 
 import unittest
 
+import numpy as np
+
 from kenshin.agg import Agg
 
 
@@ -37,3 +39,44 @@ class TestAgg(unittest.TestCase):
     def test_agg_min(self):
         func = self._get_agg_func_by_name('min')
         self.assertEqual(func(self.vals), 0.0)
+
+
+class TestNpAgg(unittest.TestCase):
+
+    def setUp(self):
+        # two groups of four values, the last column is never valid.
+        self.vals = np.array([[1., 2., 3., 4.], [5., 6., 7., 8.]])
+        self.valid = np.array([[True, False, True, False],
+                               [True, True, True, False]])
+
+    def _agg(self, name):
+        func = Agg.get_np_agg_func(Agg.get_agg_id(name))
+        return func(self.vals, self.valid, 1).tolist()
+
+    def test_np_agg_avg(self):
+        self.assertEqual(self._agg('average'), [2.0, 6.0])
+
+    def test_np_agg_sum(self):
+        self.assertEqual(self._agg('sum'), [4.0, 18.0])
+
+    def test_np_agg_last(self):
+        self.assertEqual(self._agg('last'), [3.0, 7.0])
+
+    def test_np_agg_max(self):
+        self.assertEqual(self._agg('max'), [3.0, 7.0])
+
+    def test_np_agg_min(self):
+        self.assertEqual(self._agg('min'), [1.0, 5.0])
+
+    def test_np_agg_matches_agg(self):
+        # np.sum adds in another order than sum, equal within rounding
+        rnd = np.random.RandomState(0)
+        vals = np.vstack([self.vals.T, rnd.uniform(-1e6, 1e6, (60, 2))]).T
+        valid = np.vstack([self.valid.T, rnd.rand(60, 2) < 0.8]).T
+        for agg_id, name in enumerate(Agg.get_agg_type_list()):
+            func = Agg.get_agg_func(agg_id)
+            np_func = Agg.get_np_agg_func(agg_id)
+            for group_vals, group_valid in zip(vals, valid):
+                expected = func(list(group_vals[group_valid]))
+                self.assertTrue(np.allclose(np_func(group_vals, group_valid, 0),
+                                            expected), name)
@@ -0,0 +1,241 @@
+# coding: utf-8
+import os
+import shutil
+import unittest
+
+import numpy as np
+
+from kenshin.cache import LRUCache, BlockCache
+from kenshin.storage import Storage
+from kenshin.utils import mkdir_p
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_stamp(self):
+        cache = LRUCache(2)
+        cache.put('a', 1, stamp=(1, 2))
+        self.assertEqual(cache.get('a', (1, 2)), 1)
+        cache.restamp('a', (1, 2), (1, 3))
+        self.assertEqual(cache.get('a', (1, 3)), 1)
+        # stale entry is dropped
+        self.assertEqual(cache.get('a', (1, 4)), None)
+        self.assertEqual(len(cache), 0)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+
+class TestHeaderCache(unittest.TestCase):
+    data_dir = '/tmp/kenshin'
+
+    def setUp(self):
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+        mkdir_p(self.data_dir)
+        self.storage = Storage(data_dir=self.data_dir)
+        self.storage.create('sys.cpu.user', ['', ''], [(1, 60), (3, 60)],
+                            1.0, 'min')
+        self.path = self.storage.gen_path(self.data_dir, 'sys.cpu.user')
+        self.cache = self.storage.header_cache
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_update_fetch_hit(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, (i, i)) for i in range(1, 4)]
+        self.storage.update(self.path, points, now_ts)
+        self.storage.fetch(self.path, now_ts - 3, now=now_ts)
+        self.storage.update(self.path, points, now_ts)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+    def test_add_tag_invalidate(self):
+        now_ts = 1411628779
+        header, _, _ = self.storage.fetch(self.path, now_ts - 3, now=now_ts)
+        self.assertEqual(header['tag_list'], ['', ''])
+        self.storage.add_tag('host=webserver01,cpu=0', self.path, 0)
+        header, _, _ = self.storage.fetch(self.path, now_ts - 3, now=now_ts)
+        self.assertEqual(header['tag_list'], ['host=webserver01,cpu=0', ''])
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+
+class TestFilePool(unittest.TestCase):
+    data_dir = '/tmp/kenshin'
+
+    def setUp(self):
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+        mkdir_p(self.data_dir)
+        self.storage = Storage(data_dir=self.data_dir, max_open_files=4)
+        self.storage.create('sys.cpu.user', ['a', 'b'], [(1, 60), (3, 60)],
+                            1.0, 'min')
+        self.path = self.storage.gen_path(self.data_dir, 'sys.cpu.user')
+        self.pool = self.storage.file_pool
+        self.now_ts = 1411628779
+
+    def tearDown(self):
+        self.pool.clear()
+        shutil.rmtree(self.data_dir)
+
+    def _update(self, i):
+        points = [(self.now_ts - i, (float(i), float(i)))]
+        self.storage.update(self.path, points, self.now_ts)
+
+    def _fetch(self):
+        _, _, vals = self.storage.fetch(self.path, self.now_ts - 3,
+                                        now=self.now_ts)
+        return vals
+
+    def test_reuse(self):
+        self._update(1)
+        self._update(2)
+        self.assertEqual(self.pool.stats()['hits'], 1)
+        self.assertEqual(self._fetch(), [(None, None), (2.0, 2.0), (1.0, 1.0)])
+
+    def test_file_replaced(self):
+        self._update(1)
+        # replace the file just like kenshin-change-schema does
+        tmp_path = self.path + '.tmp'
+        shutil.copy(self.path, tmp_path)
+        os.rename(tmp_path, self.path)
+        self._update(2)
+        self.assertEqual(self.pool.stats()['hits'], 0)
+        self.assertEqual(self._fetch(), [(None, None), (2.0, 2.0), (1.0, 1.0)])
+
+    def test_add_tag_invalidate(self):
+        self._update(1)
+        self.assertEqual(len(self.pool), 1)
+        # too long to fit in the reserved space, the file is rewritten
+        self.storage.add_tag('x' * 1024, self.path, 0)
+        self.assertEqual(len(self.pool), 0)
+        self._update(2)
+        self.assertEqual(self._fetch(), [(None, None), (2.0, 2.0), (1.0, 1.0)])
+
+
+class TestBlockCache(unittest.TestCase):
+    data_dir = '/tmp/kenshin'
+
+    def setUp(self):
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+        mkdir_p(self.data_dir)
+        self.storage = Storage(data_dir=self.data_dir,
+                               block_cache_size=1 << 20)
+        self.storage.create('sys.cpu.user', ['a', 'b'], [(1, 300), (3, 200)],
+                            1.0, 'min')
+        self.path = self.storage.gen_path(self.data_dir, 'sys.cpu.user')
+        self.cache = self.storage.block_cache
+        self.now_ts = 1411628779
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def _update(self, i):
+        points = [(self.now_ts - i, (float(i), float(i)))]
+        self.storage.update(self.path, points, self.now_ts)
+
+    def _fetch(self):
+        _, _, vals = self.storage.fetch(self.path, self.now_ts - 3,
+                                        now=self.now_ts)
+        return vals
+
+    def test_byte_budget(self):
+        cache = BlockCache(2048)
+        block = (np.zeros(64, dtype=np.int64), np.zeros((64, 1)))
+        cache.put('a', block)
+        cache.put('b', block)
+        self.assertEqual(cache.stats()['bytes'], 2048)
+        cache.put('c', block)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['bytes'], 2048)
+        cache.resize(1024)
+        self.assertEqual(len(cache), 1)
+        # never holds a range above the budget
+        cache.put('d', (np.zeros(1024),))
+        self.assertEqual(cache.get('d'), None)
+
+    def test_generations(self):
+        cache = BlockCache(2048)
+        block = (np.zeros(64, dtype=np.int64), np.zeros((64, 1)))
+        st = os.stat(self.path)
+        stamp = cache.stamp('a', st)
+        cache.put(('a', 0, 0), block, stamp)
+        cache.put(('a', 0, 1), block, stamp)
+        cache.bump('b')
+        self.assertEqual(cache.generations, {'a': 0})
+        # a range read before a bump of its file is not cached
+        stamp = cache.stamp('b', st)
+        cache.bump('b')
+        cache.put(('b', 0, 0), block, stamp)
+        self.assertEqual(len(cache), 2)
+
+        # dropped with the last range of the file, invalidated or evicted
+        cache.bump('a')
+        for range_id in range(2):
+            self.assertEqual(cache.get(('a', 0, range_id),
+                                       cache.stamp('a', st)), None)
+        self.assertEqual(cache.generations, {})
+        cache.put(('b', 0, 0), block, cache.stamp('b', st))
+        cache.put(('c', 0, 0), block, cache.stamp('c', st))
+        self.assertEqual(cache.generations, {'b': 3, 'c': 3})
+        cache.put(('c', 0, 1), block, cache.stamp('c', st))
+        self.assertEqual(cache.generations, {'c': 3})
+        cache.clear()
+        self.assertEqual(cache.generations, {})
+
+    def test_fetch_hit(self):
+        self._update(1)
+        self.assertEqual(self._fetch(), [(None, None), (None, None), (1.0, 1.0)])
+        self.assertEqual(self._fetch(), [(None, None), (None, None), (1.0, 1.0)])
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_update_invalidate(self):
+        self._update(1)
+        self._fetch()
+        self._update(2)
+        self.assertEqual(self._fetch(), [(None, None), (2.0, 2.0), (1.0, 1.0)])
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+    def test_bump(self):
+        self._update(1)
+        self._fetch()
+        self.cache.bump(self.path)
+        self._fetch()
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+    def test_across_ranges(self):
+        points = [(self.now_ts - i, (float(i), float(-i)))
+                  for i in range(1, 300)]
+        self.storage.update(self.path, points, self.now_ts)
+        # across two cached ranges, then across the end of the ring
+        for from_ts, until_ts in [(self.now_ts - 175, self.now_ts - 165),
+                                  (self.now_ts - 3, self.now_ts + 2)]:
+            for _ in range(2):
+                _, time_info, vals = self.storage.fetch(
+                    self.path, from_ts, until_ts, now=self.now_ts + 2)
+                self.assertEqual(time_info, (from_ts, until_ts, 1))
+                expected = [(float(i), float(-i)) if i > 0 else (None, None)
+                            for i in range(self.now_ts - from_ts,
+                                           self.now_ts - until_ts, -1)]
+                self.assertEqual(vals, expected)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (5, 3))
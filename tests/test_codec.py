@@ -0,0 +1,41 @@
+# coding: utf-8
+import unittest
+
+import numpy as np
+
+from kenshin import codec
+from kenshin.consts import NULL_VALUE
+
+
+class TestCodec(unittest.TestCase):
+
+    def _check(self, point_ts, point_vals):
+        data = codec.encode_block(point_ts, point_vals)
+        cnt, tag_cnt = point_vals.shape
+        self.assertTrue(len(data) <= codec.raw_block_size(cnt, tag_cnt))
+        ts, vals = codec.decode_block(data, cnt, tag_cnt)
+        self.assertEqual(ts.tolist(), list(point_ts))
+        self.assertEqual(vals.tolist(), point_vals.tolist())
+        return data
+
+    def test_regular_series(self):
+        point_ts = 1411628760 + 60 * np.arange(128)
+        point_vals = np.empty((128, 3))
+        point_vals[:, 0] = np.arange(128) % 5
+        point_vals[:, 1] = NULL_VALUE
+        point_vals[:, 2] = 0.1 * np.arange(128)
+        data = self._check(point_ts, point_vals)
+        self.assertTrue(len(data) < codec.raw_block_size(128, 3) / 4)
+
+    def test_ring_wrap_and_empty_slots(self):
+        point_ts = 1411628760 + 60 * np.arange(20)
+        point_ts = np.concatenate([point_ts[10:], point_ts[:10]])
+        point_ts[3] = 0
+        point_vals = np.arange(40.).reshape(20, 2)
+        self._check(point_ts, point_vals)
+
+    def test_incompressible(self):
+        rnd = np.random.RandomState(0)
+        point_ts = rnd.randint(0, 2 ** 31, 64)
+        point_vals = rnd.standard_normal((64, 4))
+        self._check(point_ts, point_vals)
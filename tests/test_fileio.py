@@ -0,0 +1,49 @@
+# coding: utf-8
+import os
+import tempfile
+import unittest
+
+from kenshin import fileio
+
+
+class TestFileIO(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, 'x' * 16)
+        self.fd = fd
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.path)
+
+    def test_pwritev(self):
+        fileio.pwritev(self.fd, ['ab', 'cde', 'f'], 4)
+        self.assertEqual(fileio.pread(self.fd, 16, 0), 'xxxxabcdefxxxxxx')
+        # the file offset is left untouched
+        self.assertEqual(os.lseek(self.fd, 0, os.SEEK_CUR), 16)
+
+    def test_pwritev_many_buffers(self):
+        bufs = [chr(ord('a') + i % 26) for i in range(fileio.IOV_MAX + 10)]
+        fileio.pwritev(self.fd, bufs, 0)
+        self.assertEqual(fileio.pread(self.fd, len(bufs), 0), ''.join(bufs))
+
+    def test_pread_end_of_file(self):
+        self.assertEqual(fileio.pread(self.fd, 8, 12), 'xxxx')
+        self.assertEqual(fileio.pread(self.fd, 8, 32), '')
+
+    def test_fallocate(self):
+        fileio.fallocate(self.fd, 8, 4096 * 4)
+        self.assertEqual(os.fstat(self.fd).st_size, 8 + 4096 * 4)
+        self.assertEqual(fileio.pread(self.fd, 16, 0), 'x' * 16)
+        self.assertEqual(fileio.pread(self.fd, 8, 4096), '\x00' * 8)
+
+    def test_sync(self):
+        fileio.pwrite(self.fd, 'ab', 4)
+        fileio.start_writeback(self.fd)
+        fileio.fdatasync(self.fd)
+        self.assertEqual(fileio.pread(self.fd, 16, 0), 'xxxxabxxxxxxxxxx')
+
+    def test_willneed(self):
+        self.assertTrue(fileio.willneed(self.fd, 0, 16))
+        self.assertTrue(fileio.willneed(self.fd, 4, 0))
@@ -0,0 +1,94 @@
+# coding: utf-8
+import os
+import shutil
+import struct
+import unittest
+
+from kenshin.storage import Storage
+from kenshin.consts import NULL_VALUE
+from kenshin.tools.fsck import check_file, file_tags_from_index
+
+
+class TestFsck(unittest.TestCase):
+    data_dir = '/tmp/kenshin-fsck'
+    now_ts = 1411628779
+
+    def setUp(self):
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+        os.makedirs(os.path.join(self.data_dir, '0', 'default'))
+        self.storage = Storage()
+        self.tag_list = ['sys.cpu.user', 'sys.cpu.sys', '']
+        self.path = self._create(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def _create(self, file_idx, **kwargs):
+        path = os.path.join(self.data_dir, '0', 'default', '%d.hs' % file_idx)
+        self.storage.create(path, self.tag_list, [(1, 60), (3, 60)], 1.0,
+                            'average', **kwargs)
+        points = [(self.now_ts - i, (float(i), NULL_VALUE, NULL_VALUE))
+                  for i in range(1, 100)]
+        self.storage.update(path, points, self.now_ts)
+        return path
+
+    def test_check_file(self):
+        for kwargs in [{}, {'layout': 'column', 'compression': 'gorilla'}]:
+            path = self._create(1, **kwargs)
+            report = check_file(path, now=self.now_ts)
+            self.assertEqual(report['errors'], [])
+            # sys.cpu.sys has no value
+            self.assertEqual(len(report['warnings']), 1)
+            archives = report['archives']
+            self.assertEqual([a['written'] for a in archives], [60, 33])
+            self.assertEqual(archives[0]['null_ratio'], 0.5)
+            self.assertEqual(archives[0]['last_ts'], self.now_ts - 1)
+            os.remove(path)
+
+    def test_misplaced_point(self):
+        header = self.storage.header(open(self.path, 'rb'))
+        archive = header['archive_list'][0]
+        with open(self.path, 'r+b') as f:
+            f.seek(archive['offset'] + header['point_size'] * 5)
+            f.write(struct.pack('!L', self.now_ts - 7))
+            f.seek(archive['offset'] + header['point_size'] * 6)
+            f.write(struct.pack('!L', self.now_ts + 1))
+        report = check_file(self.path, now=self.now_ts)
+        self.assertEqual(report['archives'][0]['misplaced'], 2)
+        self.assertEqual(report['archives'][0]['misaligned'], 0)
+        self.assertEqual(report['errors'],
+                         ['archive 0: 2 points out of the slot of their '
+                          'timestamp'])
+
+    def test_truncated(self):
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 8)
+        report = check_file(self.path, now=self.now_ts)
+        self.assertEqual(report['errors'], ['truncated, %d bytes, expected %d'
+                                            % (size - 8, size)])
+        self.assertNotIn('archives', report)
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(10)
+        report = check_file(self.path, now=self.now_ts)
+        self.assertTrue(report['errors'][0].startswith('unreadable header'))
+
+    def test_index(self):
+        index_file = os.path.join(self.data_dir, '0.idx')
+        with open(index_file, 'w') as f:
+            f.write('sys.cpu.user default 0 0\n')
+            f.write('sys.mem default 0 1\n')
+        instance_dir = os.path.join(self.data_dir, '0')
+        file_tags = file_tags_from_index(index_file, instance_dir)
+        self.assertEqual(file_tags,
+                         {self.path: {0: 'sys.cpu.user', 1: 'sys.mem'}})
+
+        report = check_file(self.path, file_tags[self.path], self.now_ts)
+        self.assertEqual(report['errors'],
+                         ["index: sys.mem at position 1, the file has "
+                          "'sys.cpu.sys'"])
+        report = check_file(self.path, {0: 'sys.cpu.user'}, self.now_ts)
+        self.assertEqual(report['errors'],
+                         ['index: no entry for position 1'])
@@ -70,3 +70,9 @@ class TestStorageIO(unittest.TestCase):
         io = open_.read_cnt + open_.write_cnt
         io_limit = 1152
         self.assertLessEqual(io, io_limit)
+
+        # one positioned read per propagation read (the base points are in
+        # the header), one vectored write per contiguous ring range and
+        # per archive base point.
+        self.assertLessEqual(open_.read_cnt, 148)
+        self.assertLessEqual(open_.write_cnt, 268)
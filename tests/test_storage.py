@@ -4,9 +4,11 @@ import shutil
 import struct
 import unittest
 
-from kenshin.storage import Storage
+import numpy as np
+
+from kenshin.storage import Storage, InvalidConfig, KenshinException
 from kenshin.agg import Agg
-from kenshin.utils import mkdir_p, roundup
+from kenshin.utils import mkdir_p, roundup, group_by_file
 from kenshin.consts import NULL_VALUE
 
 
@@ -34,6 +36,22 @@ class TestStorageBase(unittest.TestCase):
     def _gen_val(i, num=2):
         return [10 * j + i for j in range(num)]
 
+    def _create_v1(self, path):
+        """
+        Copy the file at self.path into a version 1 file at `path`.
+        """
+        metric_name, tag_list, archive_list, xff, agg_name = self.basic_setup[:5]
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+            f.seek(header['archive_list'][0]['offset'])
+            data = f.read()
+        inter_tag_list = tag_list + ['N' * header['reserved_size']]
+        packed_header, _ = Storage.pack_header(inter_tag_list, archive_list,
+                                               xff, agg_name)
+        with open(path, 'wb') as f:
+            f.write(packed_header + data)
+
+
 class TestStorage(TestStorageBase):
 
     def _basic_setup(self):
@@ -58,7 +76,7 @@ class TestStorage(TestStorageBase):
         self.assertEqual(path, '/x/y/a/b/c.hs')
 
     def test_header(self):
-        metric_name, tag_list, archive_list, x_files_factor, agg_name = self.basic_setup
+        metric_name, tag_list, archive_list, x_files_factor, agg_name = self.basic_setup[:5]
         with open(self.path, 'rb') as f:
             header = self.storage.header(f)
 
@@ -84,6 +102,27 @@ class TestStorage(TestStorageBase):
         expected = (time_info, vals)
         self.assertEqual(series[1:], expected)
 
+    def test_fetch_header_copy(self):
+        now_ts = 1411628779
+        fetches = [
+            lambda: self.storage.fetch(self.path, now_ts - 5, now=now_ts),
+            lambda: self.storage.fetch(self.path, now_ts - 5, now=now_ts,
+                                       step=3),
+            lambda: self.storage.fetch_many(self.path, [0, 1], now_ts - 5,
+                                            now=now_ts),
+            lambda: self.storage.fetch_aggregate(self.path, [0, 1], 'sum',
+                                                 now_ts - 5, now=now_ts),
+        ]
+        for fetch in fetches:
+            header = fetch()[0]
+            header['tag_list'].append('x')
+            header['archive_list'][0]['count'] = 0
+            header['archive_list'].pop()
+            header['agg_id'] = None
+            # the cached header is left alone
+            with open(self.path, 'rb') as f:
+                self.assertEqual(fetch()[0], self.storage.header(f))
+
     def test_update_propagate(self):
         now_ts = 1411628779
         num_points = 6
@@ -124,6 +163,168 @@ class TestStorage(TestStorageBase):
         expected = time_info, [(12.0, 22.0), (10.0, 20.0), (7.0, 17.0), self.null_point, self.null_point]
         self.assertEqual(series[1:], expected)
 
+    def test_update_arrays(self):
+        now_ts = 1411628779
+        num_points = 6
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, num_points+1)]
+        self.storage.update(self.path, points, now_ts)
+        with open(self.path, 'rb') as f:
+            expected = f.read()
+
+        os.remove(self.path)
+        self.storage.create(*self.basic_setup)
+        point_ts = np.array([ts for ts, _ in points])
+        point_vals = np.array([val for _, val in points], dtype=float)
+        self.storage.update(self.path, (point_ts, point_vals), now_ts)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_update_duplicate_points(self):
+        now_ts = 1411628779
+        points = [(now_ts - 1, (1, 11)), (now_ts - 2, (2, 12)),
+                  (now_ts - 1, (3, 13))]
+        self.storage.update(self.path, points, now_ts)
+
+        series = self.storage.fetch(self.path, now_ts - 2, now=now_ts)
+        self.assertEqual(series[2], [(2.0, 12.0), (3.0, 13.0)])
+
+        # the last one given wins, not the largest
+        points = [(now_ts - 1, (5, 15)), (now_ts - 1, (4, 14))]
+        self.storage.update(self.path, points, now_ts)
+        series = self.storage.fetch(self.path, now_ts - 2, now=now_ts)
+        self.assertEqual(series[2], [(2.0, 12.0), (4.0, 14.0)])
+
+    def test_prefetch(self):
+        now_ts = 1411628779
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        archive = header['archive_list'][0]
+        # only the header until the first write
+        self.assertEqual(self.storage.prefetch(self.path, now_ts - 4, now_ts),
+                         archive['offset'])
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 4)]
+        self.storage.update(self.path, points, now_ts)
+        # the whole ring at most
+        for from_ts, cnt in [(now_ts - 4, 4), (now_ts - 60, 6)]:
+            self.assertEqual(
+                self.storage.prefetch(self.path, from_ts, now_ts),
+                archive['offset'] + cnt * header['point_size'])
+
+    def test_sync_policy(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 4)]
+        self.assertRaises(InvalidConfig, self.storage.set_sync_policy, 'x')
+
+        self.storage.set_sync_policy('fdatasync')
+        self.storage.update(self.path, points, now_ts)
+        self.assertEqual(len(self.storage.pop_sync_times()), 1)
+        self.assertEqual(self.storage.pop_sync_times(), [])
+        self.assertEqual(self.storage.commit(), 0)
+
+        # one sync for the files written since the last commit
+        self.storage.set_sync_policy('group')
+        self.storage.update(self.path, points, now_ts + 1)
+        self.storage.update(self.path, points, now_ts + 2)
+        self.assertEqual(self.storage.pop_sync_times(), [])
+        self.assertEqual(self.storage.commit(), 1)
+        self.assertEqual(len(self.storage.pop_sync_times()), 1)
+        self.assertEqual(self.storage.commit(), 0)
+
+    def test_fetch_column(self):
+        now_ts = 1411628779
+        num_points = 5
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, num_points+1)]
+        points[1] = (now_ts - 2, (NULL_VALUE, 12))
+        self.storage.update(self.path, points, now_ts)
+
+        from_ts = now_ts - num_points
+        tag_list = self.basic_setup[1]
+        for metric in (1, tag_list[1]):
+            _, time_info, timestamps, values = self.storage.fetch_column(
+                self.path, metric, from_ts, now=now_ts)
+            self.assertEqual(time_info, (from_ts, now_ts, 1))
+            self.assertEqual(timestamps.tolist(), range(from_ts, now_ts))
+            self.assertEqual(values.tolist(), [15., 14., 13., 12., 11.])
+
+        _, _, _, values = self.storage.fetch_column(
+            self.path, 0, from_ts - 1, now=now_ts)
+        self.assertTrue(np.isnan(values[0]))
+        self.assertTrue(np.isnan(values[-2]))
+        self.assertEqual(values[-1], 1.)
+
+    def test_fetch_column_empty_metric(self):
+        now_ts = 1411628779
+        from_ts = 1411628775
+        _, _, _, values = self.storage.fetch_column(
+            self.path, 0, from_ts, now=now_ts)
+        self.assertEqual(len(values), now_ts - from_ts)
+        self.assertTrue(np.isnan(values).all())
+
+    def test_fetch_many(self):
+        now_ts = 1411628779
+        num_points = 5
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, num_points+1)]
+        self.storage.update(self.path, points, now_ts)
+
+        from_ts = now_ts - num_points
+        tag_list = self.basic_setup[1]
+        _, time_info, timestamps, values = self.storage.fetch_many(
+            self.path, [tag_list[1], 0], from_ts, now=now_ts)
+        self.assertEqual(time_info, (from_ts, now_ts, 1))
+        self.assertEqual(len(values), 2)
+        self.assertEqual(values[0].tolist(), [15., 14., 13., 12., 11.])
+        self.assertEqual(values[1].tolist(), [5., 4., 3., 2., 1.])
+
+    def test_fetch_aggregate(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 6)]
+        points[1] = (now_ts - 2, (NULL_VALUE, 12))
+        points[2] = (now_ts - 3, (NULL_VALUE, NULL_VALUE))
+        self.storage.update(self.path, points, now_ts)
+
+        from_ts = now_ts - 5
+        expected = {
+            'sum': [20., 18., None, 12., 12.],
+            'average': [10., 9., None, 12., 6.],
+            'max': [15., 14., None, 12., 11.],
+            'min': [5., 4., None, 12., 1.],
+            'last': [15., 14., None, 12., 11.],
+        }
+        for func, vals in expected.items():
+            _, time_info, timestamps, values = self.storage.fetch_aggregate(
+                self.path, [0, 1], func, from_ts, now=now_ts)
+            self.assertEqual(time_info, (from_ts, now_ts, 1))
+            self.assertEqual(timestamps.tolist(), range(from_ts, now_ts))
+            self.assertEqual([None if np.isnan(v) else v for v in values],
+                             vals)
+
+        # the order of the metrics matters to 'last' only
+        values = self.storage.fetch_aggregate(
+            self.path, [1, 0], 'last', from_ts, now=now_ts)[3]
+        self.assertEqual(values[:2].tolist(), [5., 4.])
+        self.assertRaises(KenshinException, self.storage.fetch_aggregate,
+                          self.path, [0, 1], 'median', from_ts, now=now_ts)
+
+    def test_group_by_file(self):
+        tag_list = self.basic_setup[1]
+        link_dir = os.path.join(self.data_dir, 'link', '0')
+        mkdir_p(link_dir)
+        paths = []
+        for metric in tag_list + ['sys.mem']:
+            path = os.path.join(link_dir, metric + '.hs')
+            os.symlink(self.path, path)
+            paths.append(path)
+        other_path = os.path.join(self.data_dir, 'other.hs')
+        os.symlink('/tmp/kenshin/other/1.hs', other_path)
+
+        groups = group_by_file(paths[:2] + [other_path] + paths[2:])
+        expected = [
+            (self.path, [(paths[0], tag_list[0]), (paths[1], tag_list[1]),
+                         (paths[2], 'sys.mem')]),
+            ('/tmp/kenshin/other/1.hs', [(other_path, None)]),
+        ]
+        self.assertEqual(groups.items(), expected)
+
     def test_fetch_empty_metric(self):
         now_ts = 1411628779
         from_ts = 1411628775
@@ -132,6 +333,21 @@ class TestStorage(TestStorageBase):
         expected = time_info, [self.null_point] * (now_ts - from_ts)
         self.assertEqual(series[1:], expected)
 
+    def test_fetch_wrap_around(self):
+        now_ts = 1411628779
+        for i in range(3):
+            points = [(now_ts + 4 * i - j, self._gen_val(4 * i - j))
+                      for j in range(4)]
+            self.storage.update(self.path, points, now_ts + 4 * i)
+
+        now_ts += 8
+        from_ts = now_ts - 5
+        series = self.storage.fetch(self.path, from_ts, now=now_ts)
+        time_info = (from_ts, now_ts, 1)
+        vals = [tuple(map(float, self._gen_val(i))) for i in range(3, 8)]
+        expected = time_info, vals
+        self.assertEqual(series[1:], expected)
+
     def print_file_content(self):
         with open(self.path) as f:
             header = self.storage.header(f)
@@ -204,6 +420,29 @@ class TestLostPoint(TestStorageBase):
         expected = (time_info, values)
         self.assertEqual(series[1:], expected)
 
+    def test_deferred_propagate(self):
+        now_ts = 1411628779
+        sync_path = self.path + '.sync'
+        shutil.copy(self.path, sync_path)
+
+        dirty_ranges = []
+        for point_seeds in [range(30, 45), range(15, 30), range(15)]:
+            points = [(now_ts - i, self._gen_val(i)) for i in point_seeds]
+            mtime = now_ts - point_seeds[-1]
+            self.storage.update(sync_path, list(points), now_ts, mtime)
+            rs = self.storage.update(self.path, list(points), now_ts, mtime,
+                                     propagate=False)
+            dirty_ranges.append(rs)
+
+        from_ts = now_ts - 60 - 1
+        series = self.storage.fetch(self.path, from_ts, now=now_ts)
+        self.assertEqual(series[2], [self.null_point] * 21)
+
+        for timestamp_range in dirty_ranges:
+            self.storage.propagate(self.path, timestamp_range)
+        with open(self.path, 'rb') as f, open(sync_path, 'rb') as sync_f:
+            self.assertEqual(f.read(), sync_f.read())
+
     def test_basic_update(self):
         now_ts = 1411628779
         point_seeds = [1, 2, 4, 5]
@@ -255,3 +494,657 @@ class TestMultiArchive(TestStorageBase):
         values = [(26.0, 36.0, 46.0), (20.0, 30.0, 40.0)]
         expected = (time_info, values)
         self.assertEqual(series[1:], expected)
+
+    def test_update_history(self):
+        metric_name = 'sys.cpu.sys'
+        self.storage.create(metric_name, *self.basic_setup[1:])
+        path = self.storage.gen_path(self.data_dir, metric_name)
+        higher = self.storage.header(open(path, 'rb'))['archive_list'][0]
+        read_slots = self.storage._read_slots
+        reads = []
+
+        def _read_slots(fd, header, archive, first_idx, cnt):
+            reads.append(archive['offset'])
+            return read_slots(fd, header, archive, first_idx, cnt)
+        self.storage._read_slots = _read_slots
+
+        now_ts = 1411628760
+        history = []
+        higher_reads = 0
+        for i in range(6):
+            points = [(now_ts + j, self._gen_val(j % 7, num=3))
+                      for j in range(i * 10, i * 10 + 10)]
+            del reads[:]
+            self.storage.update(self.path, points, now_ts + i * 10 + 10)
+            higher_reads += reads.count(higher['offset'])
+            del reads[:]
+            self.storage.update(path, points, now_ts + i * 10 + 10,
+                                history=history)
+            # the history covers the windows after the first points
+            if i > 0:
+                self.assertNotIn(higher['offset'], reads)
+            history.extend(points)
+        self.assertTrue(higher_reads > 1)
+
+        with open(self.path, 'rb') as f1, open(path, 'rb') as f2:
+            data1, data2 = f1.read(), f2.read()
+        size = higher['offset']
+        self.assertEqual(data1[size:], data2[size:])
+
+    def _consolidate(self, series, agg_step):
+        (from_ts, until_ts, step), values = series[1:]
+        points = dict(zip(range(from_ts, until_ts, step), values))
+        rs = []
+        for ts in range(from_ts, until_ts, agg_step):
+            group = [points.get(t, self.null_point)
+                     for t in range(ts, ts + agg_step, step)]
+            rs.append(tuple(min(v for v in col if v is not None)
+                            if any(v is not None for v in col) else None
+                            for col in zip(*group)))
+        return (from_ts, until_ts, agg_step), rs
+
+    def test_fetch_consolidated(self):
+        # aligned to all the steps used below
+        now_ts = 1411628760
+        points = [(now_ts - i, self._gen_val(i % 7, num=3))
+                  for i in range(1, 60) if i % 11]
+        self.storage.update(self.path, points, now_ts)
+        from_ts = now_ts - 60
+
+        # not an archive precision, the 1s points are aggregated by two
+        series = self.storage.fetch(self.path, from_ts, now=now_ts, step=2)
+        raw_series = self.storage.fetch(self.path, from_ts, now=now_ts)
+        self.assertEqual(series[1:], self._consolidate(raw_series, 2))
+
+        # the 6s archive is read as is
+        series = self.storage.fetch(self.path, from_ts, now=now_ts,
+                                    max_points=10)
+        self.assertEqual(series[1][2], 6)
+        self.assertEqual(len(series[2]), 10)
+
+        # then aggregated by two
+        raw_series = series
+        series = self.storage.fetch(self.path, from_ts, now=now_ts,
+                                    max_points=5)
+        self.assertEqual(series[1:], self._consolidate(raw_series, 12))
+
+        _, time_info, timestamps, values = self.storage.fetch_many(
+            self.path, [2, 0], from_ts, now=now_ts, max_points=5)
+        self.assertEqual(time_info, series[1])
+        self.assertEqual(timestamps.tolist(), range(*time_info))
+        for vals, col in zip(values, [2, 0]):
+            self.assertEqual([None if np.isnan(v) else v for v in vals],
+                             [v[col] for v in series[2]])
+
+
+class TestColumnStorage(TestStorage):
+    """
+    Run the storage tests against a version 2 (columnar) file.
+    """
+
+    def _basic_setup(self):
+        return TestStorage._basic_setup(self) + ['column']
+
+    def test_header_version(self):
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual(header['version'], 2)
+        self.assertEqual(header['layout'], 'column')
+
+    def test_same_data_as_row_layout(self):
+        metric_name, tag_list, archive_list, xff, agg_name, _ = self.basic_setup
+        self.storage.create('sys.cpu.row', tag_list, archive_list, xff, agg_name)
+        row_path = self.storage.gen_path(self.data_dir, 'sys.cpu.row')
+
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 10)]
+        self.storage.update(self.path, list(points), now_ts)
+        self.storage.update(row_path, list(points), now_ts)
+
+        with open(self.path, 'rb') as f, open(row_path, 'rb') as row_f:
+            header, row_header = Storage.header(f), Storage.header(row_f)
+            content, row_content = f.read(), row_f.read()
+        self.assertEqual(row_header['layout'], 'row')
+        for archive, row_archive in zip(header['archive_list'],
+                                        row_header['archive_list']):
+            point_ts, point_vals = Storage.archive_arrays(content, header,
+                                                          archive)
+            row_ts, row_vals = Storage.archive_arrays(row_content, row_header,
+                                                      row_archive)
+            self.assertEqual(point_ts.tolist(), row_ts.tolist())
+            self.assertEqual(point_vals.tolist(), row_vals.tolist())
+            self.assertEqual(
+                Storage.pack_archive(header, archive, point_ts, point_vals)[0],
+                content[archive['offset']: archive['offset'] + archive['size']])
+
+    def test_add_tag_keep_layout(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 4)]
+        self.storage.update(self.path, points, now_ts)
+        # too long to fit in the reserved space, moved to the tag table
+        self.storage.add_tag('x' * 1024, self.path, 0)
+        series = self.storage.fetch(self.path, now_ts - 3, now=now_ts)
+        self.assertEqual(series[0]['layout'], 'column')
+        self.assertEqual(series[2], [(3.0, 13.0), (2.0, 12.0), (1.0, 11.0)])
+
+
+class TestColumnLostPoint(TestLostPoint):
+
+    def _basic_setup(self):
+        return TestLostPoint._basic_setup(self) + ['column']
+
+
+class TestCompressedStorage(TestStorage):
+    """
+    Run the storage tests against a file with compressed archives.
+    """
+
+    def _basic_setup(self):
+        return TestStorage._basic_setup(self) + ['row', 'gorilla']
+
+    def test_header_compression(self):
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual(header['compression'], 'gorilla')
+        self.assertEqual([a['compressed'] for a in header['archive_list']],
+                         [False, True])
+
+
+class TestCompressedLostPoint(TestLostPoint):
+
+    def _basic_setup(self):
+        return TestLostPoint._basic_setup(self) + ['column', 'gorilla']
+
+
+class TestCompressedMultiArchive(TestMultiArchive):
+
+    def _basic_setup(self):
+        return TestMultiArchive._basic_setup(self) + ['row', 'gorilla']
+
+
+class TestCompressedBlocks(TestStorageBase):
+
+    def _basic_setup(self):
+        metric_name = 'sys.cpu.user'
+        tag_list = ['host=webserver01,cpu=0', 'host=webserver01,cpu=1']
+        archive_list = [(1, 1000), (10, 1000)]
+        return [metric_name, tag_list, archive_list, 1.0, 'average', 'row',
+                'gorilla']
+
+    def setUp(self):
+        TestStorageBase.setUp(self)
+        metric_name, tag_list, archive_list, xff, agg_name = self.basic_setup[:5]
+        self.storage.create('sys.cpu.raw', tag_list, archive_list, xff,
+                            agg_name)
+        self.raw_path = self.storage.gen_path(self.data_dir, 'sys.cpu.raw')
+
+    def test_same_data_as_uncompressed(self):
+        now_ts = 1411628779
+        for i in range(0, 900, 100):
+            points = [(now_ts - 900 + j, self._gen_val(j % 7))
+                      for j in range(i, i + 100)]
+            ts = now_ts - 900 + i + 100
+            self.storage.update(self.path, list(points), ts)
+            self.storage.update(self.raw_path, list(points), ts)
+
+        for from_ts in [now_ts - 5000, now_ts - 900, now_ts - 300]:
+            self.assertEqual(
+                self.storage.fetch(self.path, from_ts, now=now_ts)[1:],
+                self.storage.fetch(self.raw_path, from_ts, now=now_ts)[1:])
+
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+            block_lengths = self.storage._read_block_index(
+                f.fileno(), header['archive_list'][1])
+        # 90 lower points written, in the first of 8 blocks
+        self.assertEqual(len(block_lengths), 8)
+        self.assertTrue(block_lengths[0] > 0)
+        self.assertFalse(block_lengths[1:].any())
+        self.assertTrue(os.stat(self.path).st_blocks <
+                        os.stat(self.raw_path).st_blocks)
+
+
+class TestFloat32Storage(TestStorage):
+    """
+    Run the storage tests against a file of float32 values.
+    """
+
+    def _basic_setup(self):
+        return TestStorage._basic_setup(self) + ['row', 'none', 'float32']
+
+    def test_header_value_type(self):
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual(header['value_type'], 'float32')
+        self.assertEqual(header['point_size'], 4 + 4 * 2)
+        self.assertEqual(os.path.getsize(self.path),
+                         header['header_size'] + (6 + 6) * header['point_size'])
+
+    def test_single_precision(self):
+        now_ts = 1411628779
+        points = [(now_ts - 1, (0.1, NULL_VALUE))]
+        self.storage.update(self.path, points, now_ts)
+        _, _, timestamps, values = self.storage.fetch_many(
+            self.path, [0, 1], now_ts - 1, now=now_ts)
+        self.assertEqual(values[0].tolist(), [float(np.float32(0.1))])
+        self.assertTrue(np.isnan(values[1]).all())
+
+
+class TestFloat32LostPoint(TestLostPoint):
+
+    def _basic_setup(self):
+        return TestLostPoint._basic_setup(self) + ['column', 'gorilla',
+                                                   'float32']
+
+
+class TestBaseTimestamp(TestStorageBase):
+
+    def _basic_setup(self):
+        metric_name = 'sys.cpu.user'
+        # the empty tag leaves reserved space in the header
+        tag_list = ['host=webserver01,cpu=0', '']
+        archive_list = [(1, 60), (3, 60)]
+        return [metric_name, tag_list, archive_list, 1.0, 'min']
+
+    def test_header_base_ts(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 10)]
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual([a['base_ts'] for a in header['archive_list']],
+                         [0, 0])
+
+        self.storage.update(self.path, points, now_ts)
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+            content = f.read()
+        for archive in header['archive_list']:
+            point_ts, _ = Storage.archive_arrays(content, header, archive)
+            self.assertEqual(archive['base_ts'], point_ts[0])
+        self.assertEqual(header['archive_list'][0]['base_ts'], now_ts - 9)
+
+    def test_migrate_header(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(10, 20)]
+        self.storage.update(self.path, list(points), now_ts)
+        v1_path = self.path + '.v1'
+        self._create_v1(v1_path)
+        with open(v1_path, 'rb') as f:
+            v1_header = self.storage.header(f)
+        self.assertEqual(v1_header['version'], 1)
+        self.assertEqual(self.storage.fetch(v1_path, now_ts - 20, now=now_ts)[1:],
+                         self.storage.fetch(self.path, now_ts - 20, now=now_ts)[1:])
+
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 10)]
+        self.storage.update(self.path, list(points), now_ts)
+        self.storage.update(v1_path, list(points), now_ts)
+        with open(v1_path, 'rb') as f, open(self.path, 'rb') as new_f:
+            header, new_header = self.storage.header(f), self.storage.header(new_f)
+        self.assertEqual(header['version'], 2)
+        self.assertEqual(header['header_size'], v1_header['header_size'])
+        self.assertEqual(header['tag_list'], v1_header['tag_list'])
+        self.assertEqual([a['base_ts'] for a in header['archive_list']],
+                         [a['base_ts'] for a in new_header['archive_list']])
+        self.assertEqual(self.storage.fetch(v1_path, now_ts - 20, now=now_ts)[1:],
+                         self.storage.fetch(self.path, now_ts - 20, now=now_ts)[1:])
+
+
+class TestTagTable(TestStorageBase):
+
+    def _basic_setup(self):
+        metric_name = 'sys.cpu.user'
+        tag_list = ['host=webserver01,cpu=0', '']
+        archive_list = [(1, 60), (3, 60)]
+        return [metric_name, tag_list, archive_list, 1.0, 'min']
+
+    def test_add_tag_overflow(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 4)]
+        self.storage.update(self.path, points, now_ts)
+        with open(self.path, 'rb') as f:
+            old_header = self.storage.header(f)
+
+        self.storage.add_tag('x' * 1024, self.path, 1)
+        with open(self.path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual(header['tag_list'], [old_header['tag_list'][0],
+                                              'x' * 1024])
+        self.assertEqual(header['header_size'], old_header['header_size'])
+        self.assertEqual(header['archive_list'], old_header['archive_list'])
+        self.assertEqual(os.path.getsize(self.path),
+                         header['data_end'] + 4 + len('\t'.join(
+                             header['tag_list'] + [''])))
+
+        # replaced (and emptied) in place
+        self.storage.add_tag('y' * 10, self.path, 1)
+        self.storage.update(self.path, [(now_ts, self._gen_val(0))], now_ts)
+        series = self.storage.fetch(self.path, now_ts - 3, now=now_ts + 1)
+        self.assertEqual(series[0]['tag_list'][1], 'y' * 10)
+        self.assertEqual(series[2], [(3.0, 13.0), (2.0, 12.0), (1.0, 11.0),
+                                     (0.0, 10.0)])
+        self.storage.set_tags(self.path, ['a', ''])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.storage.header(f)['tag_list'], ['a', ''])
+        self.assertRaises(KenshinException, self.storage.set_tags, self.path,
+                          ['a'])
+
+    def test_migrate_v1_overflow(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 4)]
+        self.storage.update(self.path, points, now_ts)
+        v1_path = self.path + '.v1'
+        self._create_v1(v1_path)
+        with open(v1_path, 'rb') as f:
+            v1_header = self.storage.header(f)
+
+        self.storage.add_tag('x' * 1024, v1_path, 1)
+        with open(v1_path, 'rb') as f:
+            header = self.storage.header(f)
+        self.assertEqual(header['version'], 2)
+        self.assertEqual(header['header_size'], v1_header['header_size'])
+        self.assertEqual(header['tag_list'][1], 'x' * 1024)
+        self.assertEqual(self.storage.fetch(v1_path, now_ts - 3, now=now_ts)[1:],
+                         self.storage.fetch(self.path, now_ts - 3, now=now_ts)[1:])
+
+
+class TestBackfill(TestStorageBase):
+
+    def _basic_setup(self):
+        metric_name = 'sys.cpu.user'
+        tag_list = ['host=webserver01,cpu=0', 'host=webserver01,cpu=1']
+        archive_list = [(1, 60), (3, 60), (6, 60)]
+        return [metric_name, tag_list, archive_list, 1.0, 'average']
+
+    def setUp(self):
+        TestStorageBase.setUp(self)
+        self.storage.create('sys.cpu.sync', *self.basic_setup[1:])
+        self.sync_path = self.storage.gen_path(self.data_dir, 'sys.cpu.sync')
+
+    def test_same_data_as_update(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i % 7)) for i in range(300, 0, -1)]
+        points[-5] = (points[-5][0], (NULL_VALUE, 1.0))
+        self.storage.update(self.sync_path, list(points), now_ts)
+
+        # the lower archives get what propagation did write
+        archive_points = [
+            (np.array([ts for ts, _ in points]),
+             np.array([val for _, val in points], dtype=float))]
+        for archive in [(3, 60), (6, 60)]:
+            series = self.storage.fetch_many(self.sync_path, [0, 1],
+                                             now_ts - archive[0] * 60,
+                                             now=now_ts)
+            vals = np.array(series[3]).T
+            written = ~np.isnan(vals).all(1)
+            vals[np.isnan(vals)] = NULL_VALUE
+            archive_points.append((series[2][written], vals[written]))
+        self.storage.backfill(self.path, archive_points)
+
+        for from_ts in [now_ts - 60, now_ts - 180, now_ts - 360]:
+            self.assertEqual(
+                self.storage.fetch(self.path, from_ts, now=now_ts)[1:],
+                self.storage.fetch(self.sync_path, from_ts, now=now_ts)[1:])
+
+    def test_fill_lower(self):
+        now_ts = 1411628779
+        # aligned to the lowest precision, so that no lower point is partial
+        ts = np.arange(now_ts - now_ts % 6 - 60, now_ts - now_ts % 6)
+        vals = np.column_stack([ts % 7, ts % 5]).astype(float)
+        vals[3] = NULL_VALUE
+        self.storage.backfill(self.path, [(ts, vals)], fill_lower=True)
+
+        series = self.storage.fetch(self.path, ts[0], now=ts[-1] + 1)
+        self.assertEqual(series[2], [tuple(v) if v[0] != NULL_VALUE else
+                                     (None, None) for v in vals.tolist()])
+        # every archive is aggregated from the one above it
+        for step, from_ts in [(3, now_ts - 120), (6, now_ts - 300)]:
+            series = self.storage.fetch(self.path, from_ts, now=now_ts)
+            self.assertEqual(series[1][2], step)
+            expected = []
+            for t in range(*series[1]):
+                group = vals[(ts >= t) & (ts < t + step)]
+                group = group[group[:, 0] != NULL_VALUE]
+                expected.append(tuple(group.mean(0)) if len(group)
+                                else (None, None))
+            self.assertEqual(series[2], expected)
+            ts = np.arange(*series[1])
+            vals = np.array([v if v[0] is not None else (NULL_VALUE,) * 2
+                             for v in series[2]], dtype=float)
+
+    def test_keep_newest_points(self):
+        now_ts = 1411628779
+        ts = np.arange(now_ts - 200, now_ts - 10)
+        vals = np.column_stack([ts % 7, ts % 5]).astype(float)
+        self.storage.backfill(self.path, [(ts, vals)])
+        series = self.storage.fetch(self.path, now_ts - 70, now_ts - 10,
+                                    now=now_ts - 10)
+        self.assertEqual(series[2], [tuple(v) for v in vals[-60:].tolist()])
+
+        # merged with the points already written
+        self.storage.update(self.path, [(now_ts - 1, self._gen_val(1))], now_ts)
+        ts = np.arange(now_ts - 10, now_ts - 1)
+        vals = np.column_stack([ts % 7, ts % 5]).astype(float)
+        self.storage.backfill(self.path, [(ts, vals)])
+        series = self.storage.fetch(self.path, now_ts - 10, now=now_ts)
+        expected = [tuple(v) for v in vals.tolist()] + [(1.0, 11.0)]
+        self.assertEqual(series[2], expected)
+        self.assertRaises(KenshinException, self.storage.backfill, self.path,
+                          [None] * 4)
+
+    def test_keep_newer_written_points(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 6)]
+        self.storage.update(self.path, points, now_ts)
+        expected = self.storage.fetch(self.path, now_ts - 5, now=now_ts)
+
+        # older than the retention from the written points, or than the
+        # points in their slots
+        for ts in [np.arange(now_ts - 605, now_ts - 600),
+                   np.arange(now_ts - 65, now_ts - 60)]:
+            vals = np.column_stack([ts % 7, ts % 5]).astype(float)
+            self.storage.backfill(self.path, [(ts, vals)])
+            self.assertEqual(
+                self.storage.fetch(self.path, now_ts - 5, now=now_ts),
+                expected)
+
+
+class TestCompressedBackfill(TestBackfill):
+
+    def _basic_setup(self):
+        return TestBackfill._basic_setup(self) + ['column', 'gorilla']
+
+
+class TestTieredStorage(TestStorageBase):
+
+    def _basic_setup(self):
+        metric_name = 'sys.cpu.user'
+        tag_list = ['host=webserver01,cpu=0', '']
+        archive_list = [(1, 60), (3, 60), (6, 60)]
+        return [metric_name, tag_list, archive_list, 1.0, 'average']
+
+    def setUp(self):
+        TestStorageBase.setUp(self)
+        self.cold_path = os.path.join(self.data_dir, 'cold', 'user.hs')
+        self.storage.create('sys.cpu.tiered', *self.basic_setup[1:],
+                            cold_path=self.cold_path)
+        self.tiered_path = self.storage.gen_path(self.data_dir,
+                                                 'sys.cpu.tiered')
+
+    def _header(self, path):
+        with open(path, 'rb') as f:
+            return self.storage.header(f)
+
+    def test_create(self):
+        header = self._header(self.tiered_path)
+        self.assertEqual(header['cold_path'], self.cold_path)
+        self.assertEqual([a['sec_per_point'] for a in header['archive_list']],
+                         [1])
+        cold_header = self._header(self.cold_path)
+        self.assertEqual(cold_header['cold_path'], None)
+        self.assertEqual(cold_header['tag_list'], header['tag_list'])
+        self.assertEqual(
+            [a['sec_per_point'] for a in cold_header['archive_list']], [3, 6])
+        self.assertRaises(InvalidConfig, self.storage.create, 'sys.cpu.bad',
+                          *self.basic_setup[1:], cold_path=self.cold_path,
+                          hot_archive_cnt=3)
+
+    def test_same_data_as_single_file(self):
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i % 7)) for i in range(1, 300)]
+        for path in [self.path, self.tiered_path]:
+            self.storage.update(path, points[200:], now_ts)
+            self.storage.update(path, points[30:200], now_ts)
+            # deferred, then propagated to the companion file
+            dirty_range = self.storage.update(path, points[:30], now_ts,
+                                              propagate=False)
+            self.storage.propagate(path, dirty_range)
+
+        for from_ts in [now_ts - 60, now_ts - 180, now_ts - 360]:
+            expected = self.storage.fetch(self.path, from_ts, now=now_ts)
+            self.assertEqual(
+                self.storage.fetch(self.tiered_path, from_ts, now=now_ts)[1:],
+                expected[1:])
+            np.testing.assert_array_equal(
+                self.storage.fetch_many(self.tiered_path, [0], from_ts,
+                                        now=now_ts)[3][0],
+                self.storage.fetch_many(self.path, [0], from_ts,
+                                        now=now_ts)[3][0])
+
+    def test_backfill(self):
+        now_ts = 1411628779
+        ts = np.arange(now_ts - now_ts % 6 - 60, now_ts - now_ts % 6)
+        vals = np.column_stack([ts % 7, ts % 5]).astype(float)
+        for path in [self.path, self.tiered_path]:
+            self.storage.backfill(path, [(ts, vals)], fill_lower=True)
+        for from_ts in [now_ts - 60, now_ts - 180, now_ts - 360]:
+            self.assertEqual(
+                self.storage.fetch(self.tiered_path, from_ts, now=now_ts)[1:],
+                self.storage.fetch(self.path, from_ts, now=now_ts)[1:])
+
+    def test_set_tags(self):
+        self.storage.add_tag('host=webserver01,cpu=1', self.tiered_path, 1)
+        self.assertEqual(self._header(self.cold_path)['tag_list'],
+                         ['host=webserver01,cpu=0', 'host=webserver01,cpu=1'])
+        self.storage.set_tags(self.tiered_path, ['', 'x' * 1024])
+        self.assertEqual(self._header(self.cold_path)['tag_list'],
+                         ['', 'x' * 1024])
+        self.assertEqual(self._header(self.tiered_path)['cold_path'],
+                         self.cold_path)
+
+    def test_set_cold_path(self):
+        new_cold_path = os.path.join(self.data_dir, 'cold', 'u.hs')
+        os.rename(self.cold_path, new_cold_path)
+        self.storage.set_cold_path(self.tiered_path, new_cold_path)
+        header = self._header(self.tiered_path)
+        self.assertEqual(header['cold_path'], new_cold_path)
+        self.assertEqual(header['cold_path_size'], len(self.cold_path))
+        self.assertRaises(KenshinException, self.storage.set_cold_path,
+                          self.tiered_path, new_cold_path + '.longer')
+
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 120)]
+        self.storage.update(self.tiered_path, points, now_ts)
+        series = self.storage.fetch(self.tiered_path, now_ts - 120,
+                                    now=now_ts)
+        self.assertEqual(series[0]['cold_path'], None)
+        self.assertEqual(series[1][2], 3)
+
+
+class TestFetchParallel(TestStorageBase):
+
+    def _basic_setup(self):
+        metric_name = 'sys.cpu.user'
+        tag_list = ['host=webserver01,cpu=0', 'host=webserver01,cpu=1']
+        archive_list = [(1, 60), (3, 60)]
+        return [metric_name, tag_list, archive_list, 1.0, 'average']
+
+    def test_fetch_parallel(self):
+        now_ts = 1411628779
+        paths = []
+        for i in range(10):
+            metric_name = 'sys.cpu.user%d' % i
+            self.storage.create(metric_name, *self.basic_setup[1:])
+            path = self.storage.gen_path(self.data_dir, metric_name)
+            points = [(now_ts - j, self._gen_val(i + j)) for j in range(1, 30)]
+            self.storage.update(path, points, now_ts)
+            paths.append(path)
+
+        requests = [(path, now_ts - 20 * (i % 3 + 1), now_ts, now_ts)
+                    for i, path in enumerate(reversed(paths))]
+        requests.append((paths[0], now_ts - 60, now_ts, now_ts, 5))
+        expected = [self.storage.fetch(*req) for req in requests]
+        self.assertEqual(self.storage.fetch_parallel(requests, workers=4),
+                         expected)
+
+        requests.insert(3, (self.path + '.missing', now_ts - 20, now_ts))
+        self.assertRaises(IOError, self.storage.fetch_parallel, requests)
+
+    def test_fetch_aggregate_paths(self):
+        now_ts = 1411628760
+        paths = []
+        for i, archive_list in enumerate([[(1, 60), (3, 60)],
+                                          [(1, 60), (3, 60)],
+                                          [(2, 60), (6, 60)]]):
+            metric_name = 'sys.cpu.user%d' % i
+            self.storage.create(metric_name, self.basic_setup[1], archive_list,
+                                1.0, 'average')
+            path = self.storage.gen_path(self.data_dir, metric_name)
+            points = [(now_ts - j, self._gen_val(i + j)) for j in range(1, 30)]
+            self.storage.update(path, points, now_ts)
+            link_dir = os.path.join(self.data_dir, 'link', str(i))
+            mkdir_p(link_dir)
+            for metric in self.basic_setup[1]:
+                link = os.path.join(link_dir, metric + '.hs')
+                os.symlink(path, link)
+                paths.append(link)
+
+        from_ts = now_ts - 12
+        for func in ('sum', 'average', 'max', 'last'):
+            # the common step of 1s and 2s points is 2s
+            series = [self.storage.fetch_many(
+                path, [0, 1], from_ts, now=now_ts, step=2)[3]
+                for path in sorted(set(os.path.realpath(p) for p in paths))]
+            values = np.array([v for vals in series for v in vals])
+            valid = ~np.isnan(values)
+            expected = Agg.np_agg_func_dict[func](values, valid, 0)
+
+            time_info, timestamps, values = (
+                self.storage.fetch_aggregate_paths(
+                    paths, func, from_ts, now=now_ts, workers=2))
+            self.assertEqual(time_info, (from_ts, now_ts, 2))
+            self.assertEqual(timestamps.tolist(), range(from_ts, now_ts, 2))
+            self.assertEqual(values.tolist(), expected.tolist())
+
+        self.assertRaises(KenshinException,
+                          self.storage.fetch_aggregate_paths,
+                          [self.path], 'sum', from_ts, now=now_ts)
+
+
+class TestAllocation(TestStorageBase):
+
+    def _basic_setup(self):
+        metric_name = 'sys.cpu.user'
+        tag_list = ['host=webserver01,cpu=0', 'host=webserver01,cpu=1']
+        archive_list = [(1, 6000), (60, 6000)]
+        return [metric_name, tag_list, archive_list, 1.0, 'min', 'row',
+                'none', 'float64', 'fallocate']
+
+    def test_sparse(self):
+        self.storage.create('sys.cpu.sparse', *self.basic_setup[1:-1],
+                            allocation='sparse')
+        sparse_path = self.storage.gen_path(self.data_dir, 'sys.cpu.sparse')
+        st, sparse_st = os.stat(self.path), os.stat(sparse_path)
+        self.assertEqual(st.st_size, sparse_st.st_size)
+        self.assertTrue(sparse_st.st_blocks < st.st_blocks)
+        with open(self.path, 'rb') as f, open(sparse_path, 'rb') as sparse_f:
+            self.assertEqual(f.read(), sparse_f.read())
+
+        now_ts = 1411628779
+        points = [(now_ts - i, self._gen_val(i)) for i in range(1, 4)]
+        self.storage.update(sparse_path, points, now_ts)
+        series = self.storage.fetch(sparse_path, now_ts - 3, now=now_ts)
+        self.assertEqual(series[2], [(3.0, 13.0), (2.0, 12.0), (1.0, 11.0)])
+
+    def test_invalid_allocation(self):
+        self.assertRaises(InvalidConfig, self.storage.create, 'sys.cpu.x',
+                          *self.basic_setup[1:-1], allocation='zero')
@@ -0,0 +1,68 @@
+# coding: utf-8
+import os
+import shutil
+import unittest
+
+from kenshin.storage import Storage
+from kenshin.utils import mkdir_p
+from rurouni import writer
+
+
+class TestRollupScheduler(unittest.TestCase):
+    data_dir = '/tmp/kenshin'
+
+    def setUp(self):
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+        mkdir_p(self.data_dir)
+        self.storage = Storage(data_dir=self.data_dir)
+        self.storage.create('sys.cpu.user', ['a', 'b'], [(10, 4320), (60, 2880)],
+                            0.5, 'average')
+        self.path = self.storage.gen_path(self.data_dir, 'sys.cpu.user')
+        self.scheduler = type(writer.RollupScheduler)()
+        # the propagate timeunit of the archives
+        self.scheduler.getTimeunit = lambda schema_name: 30
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_pop_due_ranges(self):
+        self.scheduler.add('default', self.path, (1411628700, 1411628745))
+        self.assertEqual(self.scheduler.popDueRanges(),
+                         [(self.path, (1411628700, 1411628745))])
+        # the last timeunit is kept until it is complete
+        self.assertEqual(self.scheduler.popDueRanges(), [])
+        self.assertEqual(self.scheduler.popDueRanges(force=True),
+                         [(self.path, (1411628730, 1411628745))])
+
+        # an end aligned to the timeunit leaves nothing pending
+        self.scheduler.add('default', self.path, (1411628700, 1411628760))
+        self.assertEqual(self.scheduler.popDueRanges(),
+                         [(self.path, (1411628700, 1411628760))])
+        self.assertEqual(self.scheduler.dirty_ranges, {})
+        self.assertEqual(self.scheduler.popDueRanges(force=True), [])
+
+    def test_force_run(self):
+        now_ts = 1411628760
+        sync_path = self.path + '.sync'
+        shutil.copy(self.path, sync_path)
+
+        # flushes of 3 points, the last one ending on a timeunit
+        for start in range(now_ts - 600, now_ts, 30):
+            points = [(ts, (float(ts % 70), 1.0))
+                      for ts in range(start + 10, start + 40, 10)]
+            mtime = start + 10
+            self.storage.update(sync_path, list(points), now_ts, mtime)
+            rs = self.storage.update(self.path, list(points), now_ts, mtime,
+                                     propagate=False)
+            self.scheduler.add('default', self.path, rs)
+            self.scheduler.run()
+        self.scheduler.run(force=True)
+
+        for path in [self.path, sync_path]:
+            _, time_info, vals = self.storage.fetch(path, now_ts - 600,
+                                                    now=now_ts + 86400)
+            self.assertEqual(time_info[2], 60)
+            self.assertEqual(sum(1 for v in vals if v[0] is not None), 10)
+        with open(self.path, 'rb') as f, open(sync_path, 'rb') as sync_f:
+            self.assertEqual(f.read(), sync_f.read())